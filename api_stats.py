@@ -0,0 +1,164 @@
+"""
+Instrumentation of the Galaxy API calls made by the harness.
+
+The make_*_request methods of a GalaxyInstance, used by every bioblend client, are wrapped so that each call is
+recorded by endpoint (method and URL path, with encoded ids replaced by {id}) and by harness phase (e.g. upload, wf).
+For each endpoint the number of calls, a latency histogram, the HTTP statuses and the response bytes are kept, so that
+the overhead of the harness polling can be told apart from the time spent by Galaxy.
+
+GET responses are measured as received. The other methods are decoded by bioblend, so their size is measured on the
+decoded JSON body, and failed calls take the status of the bioblend.ConnectionError raised.
+"""
+
+# Import dependencies
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import bioblend
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Encoded Galaxy ids in URL paths
+ENCODED_ID = re.compile(r'/[0-9a-f]{16}(?=/|$)')
+
+REQUEST_METHODS = ('get', 'post', 'put', 'patch', 'delete')
+
+
+class ApiStats:
+
+    def __init__(self):
+        self.current_phase = 'setup'
+        self.endpoints = dict()
+        self.start = time.time()
+        # Start time of each phase, in order, for the phase durations
+        self.phase_starts = [(self.current_phase, self.start)]
+        # Calls are recorded from the upload and metrics thread pools too
+        self.lock = threading.Lock()
+
+    def set_phase(self, phase):
+        with self.lock:
+            self.current_phase = phase
+            self.phase_starts.append((phase, time.time()))
+
+    def phase_seconds(self):
+        """Time spent in each phase so far, the current phase included
+
+        :return: Seconds by phase
+        :rtype: dict
+        """
+        with self.lock:
+            phase_starts = list(self.phase_starts)
+        ends = [start for _, start in phase_starts[1:]] + [time.time()]
+        seconds = dict()
+        for (phase, start), end in zip(phase_starts, ends):
+            seconds[phase] = seconds.get(phase, 0.0) + end - start
+        return seconds
+
+    @contextmanager
+    def phase(self, phase):
+        previous = self.current_phase
+        self.set_phase(phase)
+        try:
+            yield self
+        finally:
+            self.set_phase(previous)
+
+    @staticmethod
+    def endpoint(method, url):
+        path = ENCODED_ID.sub('/{id}', urlparse(url).path)
+        return f'{method.upper()} {path}'
+
+    def record(self, method, url, seconds, status, response_bytes):
+        key = (self.current_phase, self.endpoint(method, url))
+        with self.lock:
+            stats = self.endpoints.get(key)
+            if stats is None:
+                stats = {
+                    'count':0,
+                    'total_seconds':0.0,
+                    'max_seconds':0.0,
+                    'latency_buckets':[0] * (len(LATENCY_BUCKETS) + 1),
+                    'statuses':dict(),
+                    'response_bytes':0
+                }
+                self.endpoints[key] = stats
+            stats['count'] += 1
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['latency_buckets'][next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), -1)] += 1
+            stats['statuses'][str(status)] = stats['statuses'].get(str(status), 0) + 1
+            stats['response_bytes'] += response_bytes
+
+    def summary(self):
+        """Recorded calls grouped by phase and endpoint, with totals for each phase
+
+        :return: Summary of the recorded calls
+        :rtype: dict
+        """
+        with self.lock:
+            phases = dict()
+            for (phase, endpoint), stats in sorted(self.endpoints.items()):
+                phase_summary = phases.setdefault(phase, {'count':0, 'total_seconds':0.0, 'response_bytes':0, 'endpoints':dict()})
+                phase_summary['endpoints'][endpoint] = {**stats, 'mean_seconds':stats['total_seconds'] / stats['count'],
+                                                        'statuses':dict(stats['statuses'])}
+                phase_summary['count'] += stats['count']
+                phase_summary['total_seconds'] += stats['total_seconds']
+                phase_summary['response_bytes'] += stats['response_bytes']
+
+        return {
+            'latency_buckets':[*LATENCY_BUCKETS, 'inf'],
+            'elapsed_seconds':time.time() - self.start,
+            'count':sum(p['count'] for p in phases.values()),
+            'phases':phases
+        }
+
+    def dump(self, output_file):
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=4)
+
+
+def response_size(response):
+    if hasattr(response, 'content'):
+        return response.status_code, len(response.content or b'')
+    try:
+        return 200, len(json.dumps(response))
+    except (TypeError, ValueError):
+        return 200, 0
+
+
+def instrument(galaxy_instance, api_stats=None):
+    """Record every API call made through a GalaxyInstance
+
+    :param galaxy_instance: Galaxy instance whose calls are recorded
+    :type galaxy_instance: bioblend.galaxy.GalaxyInstance
+    :param api_stats: Collector of the calls, defaults to None (a new one)
+    :type api_stats: ApiStats, optional
+    :return: Collector of the calls
+    :rtype: ApiStats
+    """
+    api_stats = api_stats or ApiStats()
+
+    def wrap(method, request):
+        def instrumented_request(url, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                response = request(url, *args, **kwargs)
+            except bioblend.ConnectionError as e:
+                api_stats.record(method, url, time.perf_counter() - start, e.status_code, len(e.body or ''))
+                raise
+            status, size = response_size(response)
+            api_stats.record(method, url, time.perf_counter() - start, status, size)
+            return response
+        return instrumented_request
+
+    for method in REQUEST_METHODS:
+        request = getattr(galaxy_instance, f'make_{method}_request', None)
+        if request is not None:
+            setattr(galaxy_instance, f'make_{method}_request', wrap(method, request))
+
+    return api_stats
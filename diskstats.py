@@ -0,0 +1,279 @@
+#! /usr/bin/env python3
+"""
+Lightweight disk I/O sampler reading /proc/diskstats (and optionally /proc/stat) at a configurable rate.
+
+It only depends on the Python standard library, so it can be copied and run on the Galaxy VM as a replacement of
+dstat. Samples are written as fixed-size little-endian binary records with monotonic timestamps, and the recorded
+file can be converted to the same CSV layout written by dstat, which is what plots.py expects. The UTC offset of the
+recording host is kept in the header, so that the CSV times are the local times of that host, as with dstat, wherever
+the recording is converted.
+
+Record samples (until interrupted or for a given duration):
+
+    $ ./diskstats.py record -d vdb1 -r 50 -o diskstats.bin
+
+Convert a recording to a dstat-like CSV file:
+
+    $ ./diskstats.py convert -i diskstats.bin -o dstat_out.csv
+"""
+
+# Import dependencies
+import argparse
+import signal
+import struct
+import time
+from datetime import datetime, timedelta, timezone
+
+# File layout: header followed by one record per sample
+MAGIC = b'DSKS'
+VERSION = 2
+HEADER_FORMAT = '<4sHBd32sdQi'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+DISK_RECORD_FORMAT = '<QQQQQ'
+CPU_RECORD_FORMAT = '<QQQQ'
+SECTOR_SIZE = 512
+
+# Time column of the CSV output: dstat's format, with milliseconds since several samples are taken every second
+CSV_TIME_FORMAT = '%d-%m %H:%M:%S.%f'
+
+################################################################################
+# COMMAND LINE OPTIONS
+def cli_options():
+    parser = argparse.ArgumentParser(description='Sample disk I/O from /proc/diskstats')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record = subparsers.add_parser('record', help='Record samples to a binary file')
+    record.add_argument('-d', '--device', dest='device', default='vdb1', help='Device to monitor (as named in /proc/diskstats)')
+    record.add_argument('-r', '--rate', dest='rate', default=10, type=float, help='Samples per second')
+    record.add_argument('--duration', dest='duration', default=None, type=float, help='Seconds to record (default: until interrupted)')
+    record.add_argument('--no-cpu', dest='cpu', default=True, action='store_false', help='If set, /proc/stat is not sampled')
+    record.add_argument('-o', '--output', dest='output_file', default='diskstats.bin', help='Output binary file')
+    convert = subparsers.add_parser('convert', help='Convert a binary recording to a dstat-like CSV file')
+    convert.add_argument('-i', '--input', dest='input_file', default='diskstats.bin', help='Input binary file')
+    convert.add_argument('-o', '--output', dest='output_file', default='dstat_out.csv', help='Output CSV file')
+    return parser.parse_args()
+
+
+################################################################################
+# SAMPLING
+
+def read_diskstats(device):
+    """Read the cumulative counters of a device from /proc/diskstats
+
+    :param device: Device name, e.g. 'vdb1'
+    :type device: str
+    :return: Reads completed, sectors read, writes completed, sectors written
+    :rtype: tuple of int
+    """
+    with open('/proc/diskstats', 'r') as f:
+        for line in f:
+            fields = line.split()
+            if fields[2] == device:
+                return int(fields[3]), int(fields[5]), int(fields[7]), int(fields[9])
+    raise ValueError(f'Device {device} not found in /proc/diskstats')
+
+
+def read_cpustats():
+    """Read the cumulative CPU counters (in clock ticks) from the first line of /proc/stat
+
+    :return: User, system, idle and iowait ticks
+    :rtype: tuple of int
+    """
+    with open('/proc/stat', 'r') as f:
+        fields = [int(x) for x in f.readline().split()[1:]]
+    user, nice, system, idle, iowait, irq, softirq = fields[:7]
+    return user + nice, system + irq + softirq, idle, iowait
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def record(device, output_file, rate=10, duration=None, cpu=True):
+    """Sample /proc/diskstats (and /proc/stat) at a fixed rate and append binary records to the output file
+
+    :param device: Device name, e.g. 'vdb1'
+    :type device: str
+    :param output_file: Path of the binary output file
+    :type output_file: str
+    :param rate: Samples per second, defaults to 10
+    :type rate: float, optional
+    :param duration: Seconds to record, defaults to None (until interrupted)
+    :type duration: float, optional
+    :param cpu: Whether to sample /proc/stat too, defaults to True
+    :type cpu: bool, optional
+    """
+    # Stop cleanly when killed
+    signal.signal(signal.SIGTERM, interrupt)
+
+    period_ns = int(1e9 / rate)
+    start_ns = time.monotonic_ns()
+    wall_start = time.time()
+    utc_offset = int(datetime.fromtimestamp(wall_start).astimezone().utcoffset().total_seconds())
+    read_diskstats(device)
+
+    with open(output_file, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, int(cpu), rate, device.encode()[:32], wall_start, start_ns, utc_offset))
+        sample = 0
+        last_flush = start_ns
+        try:
+            while duration is None or sample / rate <= duration:
+                now_ns = time.monotonic_ns()
+                packed = struct.pack(DISK_RECORD_FORMAT, now_ns, *read_diskstats(device))
+                if cpu:
+                    packed += struct.pack(CPU_RECORD_FORMAT, *read_cpustats())
+                f.write(packed)
+
+                # Flush about once per second, so the file can be followed while it is written
+                if now_ns - last_flush >= 1e9:
+                    f.flush()
+                    last_flush = now_ns
+
+                sample += 1
+                time.sleep(max(0, (start_ns + sample * period_ns - time.monotonic_ns()) / 1e9))
+        except KeyboardInterrupt:
+            pass
+
+
+################################################################################
+# READING
+
+def parse_header(data, input_file):
+    magic, version = struct.unpack_from('<4sH', data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{input_file} is not a diskstats recording (version {VERSION})')
+    _, _, cpu, rate, device, wall_start, start_ns, utc_offset = struct.unpack_from(HEADER_FORMAT, data)
+    header = {
+        'cpu':bool(cpu),
+        'rate':rate,
+        'device':device.rstrip(b'\0').decode(),
+        'wall_start':wall_start,
+        'start_ns':start_ns,
+        'utc_offset':utc_offset
+    }
+    record_format = DISK_RECORD_FORMAT + (CPU_RECORD_FORMAT[1:] if cpu else '')
+    return header, record_format
+
+
+def read_records(input_file):
+    """Read a binary recording
+
+    :param input_file: Path of the binary file written by 'record'
+    :type input_file: str
+    :return: Header dictionary and list of raw records (tuples of cumulative counters)
+    :rtype: tuple
+    """
+    with open(input_file, 'rb') as f:
+        data = f.read()
+    header, record_format = parse_header(data, input_file)
+    record_size = struct.calcsize(record_format)
+    # Ignore a trailing partial record of a file still being written
+    end = HEADER_SIZE + (len(data) - HEADER_SIZE) // record_size * record_size
+    records = list(struct.iter_unpack(record_format, data[HEADER_SIZE:end]))
+
+    return header, records
+
+
+def read_last_records(input_file, count=2):
+    """Read the last complete records of a binary recording, without reading the whole file
+
+    :param input_file: Path of the binary file written by 'record'
+    :type input_file: str
+    :param count: Number of records, defaults to 2 (enough for the latest rates)
+    :type count: int, optional
+    :return: Header dictionary and list of raw records (tuples of cumulative counters)
+    :rtype: tuple
+    """
+    with open(input_file, 'rb') as f:
+        header, record_format = parse_header(f.read(HEADER_SIZE), input_file)
+        record_size = struct.calcsize(record_format)
+        # Ignore a trailing partial record of a file still being written
+        size = f.seek(0, 2)
+        end = HEADER_SIZE + (size - HEADER_SIZE) // record_size * record_size
+        start = max(HEADER_SIZE, end - count * record_size)
+        f.seek(start)
+        records = list(struct.iter_unpack(record_format, f.read(end - start)))
+
+    return header, records
+
+
+def read_samples(input_file):
+    """Convert a binary recording to rates, with the same columns used by the dstat output:
+    'read_tps', 'write_tps', 'rMB/s', 'wMB/s' (in bytes per second, as written by dstat) and 'time'.
+    If CPU was sampled, 'usr', 'sys', 'idl' and 'wai' percentages are added.
+
+    :param input_file: Path of the binary file written by 'record'
+    :type input_file: str
+    :return: Dictionary of columns, with one value per interval between two records
+    :rtype: dict of lists
+    """
+    header, records = read_records(input_file)
+    return compute_rates(header, records)
+
+
+def host_time(header, epoch):
+    """Convert an epoch to the local time of the host that made the recording, not of the one reading it
+
+    :param header: Header of the recording
+    :type header: dict
+    :param epoch: Seconds since the epoch
+    :type epoch: float
+    :return: Naive local time of the recording host
+    :rtype: datetime
+    """
+    return datetime.fromtimestamp(epoch, timezone(timedelta(seconds=header['utc_offset']))).replace(tzinfo=None)
+
+
+def compute_rates(header, records):
+    columns = ['read_tps', 'write_tps', 'rMB/s', 'wMB/s', 'time']
+    if header['cpu']:
+        columns += ['usr', 'sys', 'idl', 'wai']
+    samples = {column: [] for column in columns}
+
+    for previous, current in zip(records, records[1:]):
+        elapsed = (current[0] - previous[0]) / 1e9
+        delta = [c - p for c, p in zip(current[1:], previous[1:])]
+        samples['read_tps'].append(delta[0] / elapsed)
+        samples['rMB/s'].append(delta[1] * SECTOR_SIZE / elapsed)
+        samples['write_tps'].append(delta[2] / elapsed)
+        samples['wMB/s'].append(delta[3] * SECTOR_SIZE / elapsed)
+        samples['time'].append(host_time(header, header['wall_start'] + (current[0] - header['start_ns']) / 1e9))
+        if header['cpu']:
+            ticks = sum(delta[4:]) or 1
+            for column, value in zip(['usr', 'sys', 'idl', 'wai'], delta[4:]):
+                samples[column].append(100 * value / ticks)
+
+    return samples
+
+
+def write_dstat_csv(input_file, output_file):
+    """Write a binary recording as a CSV file with the same layout of 'dstat --disk-tps -d -t -o'
+
+    :param input_file: Path of the binary file written by 'record'
+    :type input_file: str
+    :param output_file: Path of the CSV output file
+    :type output_file: str
+    """
+    header, records = read_records(input_file)
+    samples = compute_rates(header, records)
+    device = header['device']
+    with open(output_file, 'w') as f:
+        f.write('"diskstats.py CSV output"\n')
+        f.write(f'"Rate:","{header["rate"]}"\n')
+        f.write(f'"Device:","{device}"\n')
+        f.write(f'"Date:","{host_time(header, header["wall_start"]).strftime("%d %b %Y %H:%M:%S")}"\n')
+        f.write('\n')
+        f.write(f'"dsk/{device}","","dsk/{device}","","system"\n')
+        f.write('"reads","writs","read","writ","time"\n')
+        for i in range(len(samples['time'])):
+            f.write(f"{samples['read_tps'][i]:.3f},{samples['write_tps'][i]:.3f},{samples['rMB/s'][i]:.3f},"
+                    f"{samples['wMB/s'][i]:.3f},\"{samples['time'][i].strftime(CSV_TIME_FORMAT)[:-3]}\"\n")
+
+
+if __name__ == '__main__':
+
+    options = cli_options()
+
+    if options.command == 'record':
+        record(options.device, options.output_file, options.rate, options.duration, options.cpu)
+    else:
+        write_dstat_csv(options.input_file, options.output_file)
@@ -1,34 +1,273 @@
+import json
+import os
+import shlex
 import subprocess
+import tempfile
+import threading
 import time
+from datetime import datetime
+from pathlib import Path
+
+import diskstats
+
+# Lines written by dstat before the first sample: 4 info lines, a blank line and 2 header rows
+DSTAT_HEADER_LINES = 7
+
+
+def parse_sample_time(value):
+    # dstat writes whole seconds, diskstats.py also milliseconds
+    return datetime.strptime(value, diskstats.CSV_TIME_FORMAT if '.' in value else '%d-%m %H:%M:%S')
 
 
 class SSHClient:
 
-    def __init__(self, ssh_key, ssh_user, endpoint_ip):
-        self.ssh_key = ssh_key
+    def __init__(self, ssh_key, ssh_user, endpoint_ip, control_dir=None):
+        self.ssh_key = os.path.expanduser(ssh_key)
         self.ssh_user = ssh_user
         self.endpoint = endpoint_ip
+        self.target = f'{self.ssh_user}@{self.endpoint}'
+        # %C is expanded by ssh to a hash of the connection parameters, keeping the socket path short
+        self.control_path = os.path.join(control_dir or tempfile.gettempdir(), 'bioblend-test-%C')
+        # Serialize commands so they reach the Galaxy VM in the order they are issued
+        self.lock = threading.Lock()
+        # A master already running (e.g. started by another harness process) is reused but never stopped
+        self.started_master = False
+
+    def ssh_options(self, master=False):
+        # Commands reuse the master connection if it is up, and connect on their own otherwise, never leaving a
+        # background master behind. ssh keeps the first value given for an option, so the master sets its own
+        if master:
+            return ['-i', self.ssh_key, '-o', 'ControlMaster=yes', '-o', f'ControlPath={self.control_path}',
+                    '-o', 'ControlPersist=yes']
+        return ['-i', self.ssh_key, '-o', 'ControlMaster=no', '-o', f'ControlPath={self.control_path}']
+
+    def is_open(self):
+        check_cmd = ['ssh', '-o', f'ControlPath={self.control_path}', '-O', 'check', self.target]
+        return subprocess.run(check_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+    def open(self):
+        # Start the master connection in background, every following command and file transfer reuses it
+        if not self.is_open():
+            master_cmd = ['ssh', *self.ssh_options(master=True), '-f', '-N', self.target]
+            subprocess.run(master_cmd, check=True)
+            self.started_master = True
+
+    def close(self):
+        if not self.started_master:
+            return
+        self.started_master = False
+        exit_cmd = ['ssh', '-o', f'ControlPath={self.control_path}', '-O', 'exit', self.target]
+        subprocess.run(exit_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def run_command(self, cmd, wait=True):
-        cmd = f'ssh -i {self.ssh_key} {self.ssh_user}@{self.endpoint} "{cmd}"'
-        if wait:
-            subprocess.Popen(cmd, shell=True).wait()
-        else:
-            subprocess.Popen(cmd, shell=True)
+        # Commands not waited for are detached on the Galaxy VM, so the ssh call itself always returns
+        if not wait:
+            cmd = f'nohup sh -c {shlex.quote(cmd)} > /dev/null 2>&1 &'
+        with self.lock:
+            return subprocess.run(['ssh', *self.ssh_options(), self.target, cmd]).returncode
+
+    def check_output(self, cmd):
+        with self.lock:
+            return subprocess.run(['ssh', *self.ssh_options(), self.target, cmd], stdout=subprocess.PIPE,
+                                  check=True, text=True).stdout
+
+    def stream_command(self, cmd, stdout):
+        # Long running command whose output is written to stdout while it is produced
+        with self.lock:
+            return subprocess.Popen(['ssh', *self.ssh_options(), self.target, cmd], stdout=stdout)
+
+    def put_file(self, local_path, remote_path):
+        scp_cmd = ['scp', *self.ssh_options(), local_path, f'{self.target}:{remote_path}']
+        with self.lock:
+            return subprocess.run(scp_cmd).returncode
 
     def install_dstat(self):
-        self.run_command("sudo yum install -y dstat")
+        return self.run_command("sudo yum install -y dstat")
 
     def prepare_dstat_dir(self, dstat_output_dir):
         self.output_dir = dstat_output_dir
-        self.run_command(f"rm -rf {self.output_dir}; mkdir -p {self.output_dir}")
+        return self.run_command(f"rm -rf {self.output_dir}; mkdir -p {self.output_dir}")
 
     def run_dstat(self, device, dstat_output_file):
-        self.run_command(f"dstat --disk-tps -d -t --noheaders -o {self.output_dir}/{dstat_output_file} -D {device} > /dev/null", wait=False)
+        return self.run_command(f"dstat --disk-tps -d -t --noheaders -o {self.output_dir}/{dstat_output_file} -D {device} > /dev/null", wait=False)
 
     def kill_dstat(self):
-        self.run_command("pkill -9 dstat > /dev/null")
+        return self.run_command("pkill -9 dstat > /dev/null")
 
     def get_dstat_out(self, path):
-        scp_cmd = f'scp -r -i {self.ssh_key} {self.ssh_user}@{self.endpoint}:{self.output_dir} {path}'
-        subprocess.Popen(scp_cmd, shell=True).wait()
+        scp_cmd = ['scp', '-r', *self.ssh_options(), f'{self.target}:{self.output_dir}', path]
+        with self.lock:
+            return subprocess.run(scp_cmd).returncode
+
+
+class DstatStream:
+    """Single dstat sampler per run, tailed over the SSH connection into a local file.
+
+    Phase boundaries are recorded as timestamped markers taken from the Galaxy VM clock, so that the
+    per-phase CSV files (e.g. dstat_out_upload.csv, dstat_out_wf.csv) can be derived from the stream.
+    """
+
+    def __init__(self, ssh_client, device, remote_dir, local_dir, output_file='dstat_out.csv'):
+        self.ssh_client = ssh_client
+        self.device = device
+        self.remote_dir = remote_dir
+        self.local_dir = local_dir
+        self.output_file = output_file
+        self.markers = []
+        self.tail = None
+
+    @property
+    def local_path(self):
+        return f'{self.local_dir}/{self.output_file}'
+
+    @property
+    def csv_path(self):
+        return self.local_path
+
+    def start_sampler(self):
+        self.ssh_client.kill_dstat()
+        self.ssh_client.prepare_dstat_dir(self.remote_dir)
+        self.ssh_client.run_dstat(self.device, dstat_output_file=self.output_file)
+
+    def stop_sampler(self):
+        self.ssh_client.kill_dstat()
+
+    def start(self):
+        # Start the sampler on the Galaxy VM
+        self.start_sampler()
+
+        # Copy samples to the local file as soon as the sampler writes them
+        Path(self.local_dir).mkdir(parents=True, exist_ok=True)
+        self.local_file = open(self.local_path, 'wb')
+        # Without a pty the remote tail is not hung up when the local ssh ends, keep its pid to stop it
+        remote_path = f'{self.remote_dir}/{self.output_file}'
+        self.tail = self.ssh_client.stream_command(f'echo $$ > {self.remote_dir}/tail.pid; exec tail -c +1 -F {remote_path} 2> /dev/null',
+                                                   stdout=self.local_file)
+
+    def mark(self, phase):
+        remote_time = self.ssh_client.check_output("date '+%Y-%m-%d %H:%M:%S'").strip()
+        self.markers.append({'phase':phase, 'time':remote_time})
+
+        # Write markers right away so a crashed run keeps them
+        with open(f'{self.local_dir}/dstat_markers.json', 'w', encoding='utf-8') as f:
+            json.dump(self.markers, f, ensure_ascii=False, indent=4)
+
+    def stop(self, flush_seconds=2):
+        self.stop_sampler()
+        if self.tail is not None:
+            # Leave tail the time to forward the last samples
+            time.sleep(flush_seconds)
+            self.ssh_client.run_command(f'kill $(cat {self.remote_dir}/tail.pid) 2> /dev/null')
+            self.tail.terminate()
+            self.tail.wait()
+            self.local_file.close()
+            self.tail = None
+
+    def latest_sample(self, tail_bytes=4096):
+        """Rates of the last sample streamed so far, as written by dstat: 'read_tps', 'write_tps', 'rMB/s' and 'wMB/s'
+        (in bytes per second).
+
+        :param tail_bytes: Bytes read from the end of the local file, defaults to 4096
+        :type tail_bytes: int, optional
+        :return: Rates of the last complete sample, None if there is none yet
+        :rtype: dict
+        """
+        with open(self.local_path, 'rb') as f:
+            f.seek(max(0, f.seek(0, 2) - tail_bytes))
+            lines = f.read().decode(errors='replace').split('\n')[:-1]
+        for line in reversed(lines):
+            try:
+                values = [float(value) for value in line.split(',')[:4]]
+            except ValueError:
+                continue
+            if len(values) == 4:
+                return dict(zip(['read_tps', 'write_tps', 'rMB/s', 'wMB/s'], values))
+        return None
+
+    def split(self, phases=('upload', 'wf')):
+        """Write one dstat CSV file for each phase, containing the samples between its marker and the next one.
+
+        :param phases: Phases for which a dstat_out_<phase>.csv file is written, defaults to ('upload', 'wf')
+        :type phases: tuple of str, optional
+        """
+        with open(self.csv_path, 'r') as f:
+            lines = f.readlines()
+        header, samples = lines[:DSTAT_HEADER_LINES], lines[DSTAT_HEADER_LINES:]
+        markers = [(datetime.strptime(m['time'], '%Y-%m-%d %H:%M:%S'), m['phase']) for m in self.markers]
+        if not markers:
+            return
+
+        outputs = {phase: open(f'{self.local_dir}/dstat_out_{phase}.csv', 'w') for phase in phases}
+        for output in outputs.values():
+            output.writelines(header)
+
+        # dstat timestamps have no year, take it from the first marker and follow year changes
+        year = markers[0][0].year
+        previous_month = None
+        current = None
+        next_marker = 0
+        for line in samples:
+            if not line.strip():
+                continue
+            sample_time = parse_sample_time(line.rstrip().rsplit(',', 1)[-1].strip('"'))
+            if previous_month is None and sample_time.month > markers[0][0].month + 6:
+                year -= 1
+            elif previous_month is not None and sample_time.month < previous_month:
+                year += 1
+            previous_month = sample_time.month
+            sample_time = sample_time.replace(year=year)
+
+            while next_marker < len(markers) and sample_time >= markers[next_marker][0]:
+                current = markers[next_marker][1]
+                next_marker += 1
+            if current in outputs:
+                outputs[current].write(line)
+
+        for output in outputs.values():
+            output.close()
+
+
+class DiskstatsStream(DstatStream):
+    """Streaming collector using the diskstats.py sampler instead of dstat.
+
+    The sampler script is copied to the Galaxy VM, so neither dstat nor a RHEL-family host is needed, and disk
+    counters can be sampled at a higher rate than dstat's 1 second. The binary stream is converted to a dstat-like
+    CSV file before the per-phase outputs are derived.
+    """
+
+    def __init__(self, ssh_client, device, remote_dir, local_dir, rate=10, output_file='diskstats.bin'):
+        super().__init__(ssh_client, device, remote_dir, local_dir, output_file)
+        self.rate = rate
+
+    @property
+    def csv_path(self):
+        return f'{self.local_dir}/dstat_out.csv'
+
+    def start_sampler(self):
+        self.stop_sampler()
+        self.ssh_client.prepare_dstat_dir(self.remote_dir)
+        self.ssh_client.put_file(diskstats.__file__, f'{self.remote_dir}/diskstats.py')
+        self.ssh_client.run_command(f'python3 {self.remote_dir}/diskstats.py record -d {self.device} -r {self.rate} '
+                                    f'-o {self.remote_dir}/{self.output_file}', wait=False)
+
+    def stop_sampler(self):
+        # The bracket keeps pkill from matching the shell running it
+        self.ssh_client.run_command("pkill -f '[d]iskstats.py record' > /dev/null")
+
+    def latest_sample(self, tail_bytes=None):
+        header, records = diskstats.read_last_records(self.local_path)
+        samples = diskstats.compute_rates(header, records)
+        if not samples['time']:
+            return None
+        return {column: values[-1] for column, values in samples.items() if column != 'time'}
+
+    def split(self, phases=('upload', 'wf')):
+        diskstats.write_dstat_csv(self.local_path, self.csv_path)
+        super().split(phases)
@@ -3,56 +3,230 @@
 # Import dependencies
 import argparse
 import bioblend.galaxy
+import hashlib
 import json
+import os
 import time
+from datetime import datetime
+
+from api_stats import instrument
+
+# Tool shed repository statuses that end an installation
+INSTALLED_STATUS = 'Installed'
+FAILED_STATUSES = ('Error', 'Uninstalled', 'Deactivated')
+
+# Keys identifying a tool shed repository revision
+REPO_KEYS = ('tool_shed', 'owner', 'name', 'changeset_revision')
 
 # COMMAND LINE OPTIONS
 def cli_options():
     parser = argparse.ArgumentParser(description='Galaxy install all workflows tools using bioblend')
     parser.add_argument('--endpoint', dest='galaxy_server', default='http://localhost', help='Galaxy server URL')
     parser.add_argument('--api-key', dest='api_key', default='not_very_secret_api_key', help='Galaxy user API key')
-    parser.add_argument('--wf-path', default='./workflows/test_workflow.ga', dest='wf_path', help='Workflow path')
+    parser.add_argument('--wf-path', default=['./workflows/test_workflow.ga'], nargs='+', dest='wf_paths', help='Workflow paths, or directories in which all the workflows are found')
+    parser.add_argument('--parallel', default=False, dest='parallel', action='store_true', help='If set, all install requests are submitted up front and watched by a single poller')
+    parser.add_argument('--poll-interval', default=5, type=float, dest='poll_interval', help='Seconds between two checks of the installed repositories')
+    parser.add_argument('--timeout', default=3600, type=float, dest='timeout', help='Seconds after which tools still not installed are reported as failed (for each tool when not in parallel mode)')
+    parser.add_argument('--api-stats', default=None, dest='api_stats_file', help='If set, the Galaxy API calls are recorded and summarized in this JSON file')
+    parser.add_argument('--manifest', default=None, dest='manifest_file', help='If set, the planned repositories and their installation outcome are written to this JSON file')
     return parser.parse_args()
 
+def find_workflows(wf_paths):
+
+    # Workflow files given directly, and all the workflows found in the directories given
+    if isinstance(wf_paths, str):
+        wf_paths = [wf_paths]
+    workflows = list()
+    for wf_path in wf_paths:
+        if os.path.isdir(wf_path):
+            for root, _, files in sorted(os.walk(wf_path)):
+                workflows += [os.path.join(root, f) for f in sorted(files) if f.endswith('.ga')]
+        else:
+            workflows.append(wf_path)
+    return list(dict.fromkeys(workflows))
+
+def repo_key(repo):
+    return tuple(repo[key] for key in REPO_KEYS)
+
+def wf_steps(wf_dict):
+
+    # Steps of the workflow and of its subworkflows
+    for step in wf_dict['steps'].values():
+        yield step
+        if 'subworkflow' in step:
+            yield from wf_steps(step['subworkflow'])
+
 def wf_tools_repo(wf_path):
 
-    tool_list = list()
+    tool_list = dict()
     with open(wf_path, 'r') as f:
         wf_dict = json.load(f)
-    for i,o in wf_dict['steps'].items():
-        try:
-            install_info = o['tool_shed_repository']
-            if install_info not in tool_list:
-                tool_list.append(install_info)
-        except:
-            pass
-    return tool_list
+    for step in wf_steps(wf_dict):
+        install_info = step.get('tool_shed_repository')
+        if install_info is not None:
+            tool_list.setdefault(repo_key(install_info), install_info)
+    return list(tool_list.values())
+
+def repo_statuses(installed_repos):
+
+    # Galaxy may keep old Uninstalled or Error rows next to the Installed one of the same revision
+    statuses = dict()
+    for repo in installed_repos:
+        if statuses.get(repo_key(repo)) != INSTALLED_STATUS:
+            statuses[repo_key(repo)] = repo['status']
+    return statuses
+
+def plan_install(install_tools, wf_paths):
+
+    # De-duplicated repositories required by all the workflows
+    workflows = dict()
+    planned = dict()
+    for wf_path in find_workflows(wf_paths):
+        with open(wf_path, 'rb') as f:
+            sha1 = hashlib.sha1(f.read()).hexdigest()
+        repos = wf_tools_repo(wf_path)
+        workflows[wf_path] = {'sha1':sha1, 'repositories':['/'.join(repo_key(repo)) for repo in repos]}
+        for repo in repos:
+            planned.setdefault(repo_key(repo), repo)
+
+    # Compare with a single snapshot of the installed repositories
+    installed = {repo_key(repo) for repo in install_tools.get_repositories() if repo.get('status') == INSTALLED_STATUS}
+    missing = [repo for key, repo in planned.items() if key not in installed]
+    print(f'{len(planned)} repositories required by {len(workflows)} workflows, {len(planned) - len(missing)} already installed, {len(missing)} to install.')
+
+    return workflows, planned, missing
+
+def submit_install(install_tools, repo):
+    try:
+        install_tools.install_repository_revision('https://'+repo['tool_shed'],repo['name'],repo['owner'],repo['changeset_revision'],True,True,True,True,None)
+    except bioblend.ConnectionError as e:
+        # Galaxy may reject a request for a repository being installed by a previous request, the poller tells
+        print(f"Install request of tool {repo['name']} failed: {e}")
+    print(f"Installing tool {repo['name']} and its dependencies...")
 
-def install_tools(galaxy_server,api_key,wf_path):
+def write_manifest(manifest_file, galaxy_server, workflows, planned, missing, finished, failed, elapsed):
+    missing_keys = {repo_key(repo) for repo in missing}
+    repositories = list()
+    for key, repo in planned.items():
+        if key in failed:
+            status = f'failed: {failed[key]}'
+        elif key in finished:
+            status = 'installed'
+        elif key in missing_keys:
+            status = 'not installed'
+        else:
+            status = 'already installed'
+        repositories.append({**{k: repo[k] for k in REPO_KEYS}, 'status':status, 'seconds':finished.get(key)})
+
+    manifest = {
+        'galaxy_server':galaxy_server,
+        'created':datetime.now().isoformat(timespec='seconds'),
+        'seconds':elapsed,
+        'workflows':workflows,
+        'repositories':repositories
+    }
+    with open(manifest_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+
+def install_tools(galaxy_server,api_key,wf_paths,poll_interval=5,timeout=3600,api_stats_file=None,manifest_file=None):
 
 
     # Define Galaxy instance
     gi = bioblend.galaxy.GalaxyInstance(url=galaxy_server, key=api_key)
-    
+    api_stats = instrument(gi) if api_stats_file else None
+
     #install galaxy tools
     install_tools = bioblend.galaxy.toolshed.ToolShedClient(gi)
-    wf_repos = wf_tools_repo(wf_path)
-    for i in wf_repos:
-        tool_name = i['name']
-        changeset_revision = i['changeset_revision']
-        try:
-            install_tools.install_repository_revision('https://'+i['tool_shed'],tool_name,i['owner'],changeset_revision,True,True,True,True,None)
-        except bioblend.ConnectionError:
-            pass
-        print(f'Installing tool {tool_name} and its dependencies...')
-        status = ''
-        while status != 'Installed':
-            installed_repos = install_tools.get_repositories()
-            status = [repo['status'] for repo in installed_repos if repo['name']==tool_name and repo['changeset_revision']==changeset_revision][0]
-            time.sleep(5)
-        print(f'Tool {tool_name} installed successfully.')
+    start = time.time()
+    finished = dict()
+    failed = dict()
+    try:
+        if api_stats is not None:
+            api_stats.set_phase('plan')
+        workflows, planned, missing = plan_install(install_tools, wf_paths)
+
+        # One tool at a time, each watched until it is installed, fails or times out
+        for i in missing:
+            offset = time.time() - start
+            tool_finished, tool_failed = submit_and_watch(install_tools, [i], poll_interval, timeout, api_stats)
+            finished.update({tool: offset + seconds for tool, seconds in tool_finished.items()})
+            failed.update(tool_failed)
+        if manifest_file:
+            write_manifest(manifest_file, galaxy_server, workflows, planned, missing, finished, failed, time.time() - start)
+        return finished, failed
+    finally:
+        if api_stats is not None:
+            api_stats.dump(api_stats_file)
+
+def install_tools_parallel(galaxy_server, api_key, wf_paths, poll_interval=5, timeout=3600, api_stats_file=None, manifest_file=None):
+
+    # Define Galaxy instance
+    gi = bioblend.galaxy.GalaxyInstance(url=galaxy_server, key=api_key)
+    api_stats = instrument(gi) if api_stats_file else None
+    install_tools = bioblend.galaxy.toolshed.ToolShedClient(gi)
+
+    try:
+        start = time.time()
+        if api_stats is not None:
+            api_stats.set_phase('plan')
+        workflows, planned, missing = plan_install(install_tools, wf_paths)
+        finished, failed = submit_and_watch(install_tools, missing, poll_interval, timeout, api_stats)
+        if manifest_file:
+            write_manifest(manifest_file, galaxy_server, workflows, planned, missing, finished, failed, time.time() - start)
+        return finished, failed
+    finally:
+        if api_stats is not None:
+            api_stats.dump(api_stats_file)
+
+def submit_and_watch(install_tools, repos, poll_interval=5, timeout=3600, api_stats=None):
+
+    # Submit all install requests up front
+    if api_stats is not None:
+        api_stats.set_phase('install')
+    start = time.time()
+    pending = set()
+    for i in repos:
+        submit_install(install_tools, i)
+        pending.add(repo_key(i))
+
+    # Watch every pending tool against a single snapshot of the repositories per tick
+    if api_stats is not None:
+        api_stats.set_phase('poll')
+    finished = dict()
+    failed = dict()
+    while pending:
+        statuses = repo_statuses(install_tools.get_repositories())
+        elapsed = time.time() - start
+        for tool in sorted(pending):
+            status = statuses.get(tool)
+            if status == INSTALLED_STATUS:
+                finished[tool] = elapsed
+                print(f'Tool {tool[2]} installed successfully after {elapsed:.0f}s.')
+            elif status in FAILED_STATUSES:
+                failed[tool] = status
+                print(f'Tool {tool[2]} failed to install: {status}.')
+        pending -= finished.keys() | failed.keys()
+        if pending and elapsed > timeout:
+            for tool in pending:
+                failed[tool] = f'not installed after {timeout:.0f}s (status: {statuses.get(tool)})'
+                print(f'Tool {tool[2]} failed to install: {failed[tool]}.')
+            break
+        if pending:
+            time.sleep(poll_interval)
+
+    # Report
+    print(f'Installed {len(finished)} tools in {time.time() - start:.0f}s.')
+    for (_, _, tool_name, changeset_revision), status in failed.items():
+        print(f'FAILED: {tool_name} ({changeset_revision}): {status}')
+
+    return finished, failed
 
 if __name__ == '__main__':
     options = cli_options()
-    install_tools(options.galaxy_server,options.api_key,options.wf_path)
+    if options.parallel:
+        _, failed = install_tools_parallel(options.galaxy_server,options.api_key,options.wf_paths,options.poll_interval,options.timeout,options.api_stats_file,options.manifest_file)
+    else:
+        _, failed = install_tools(options.galaxy_server,options.api_key,options.wf_paths,options.poll_interval,options.timeout,options.api_stats_file,options.manifest_file)
+    if failed:
+        raise SystemExit(1)
 
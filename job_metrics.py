@@ -0,0 +1,137 @@
+"""
+Galaxy job metrics collection.
+
+Job metrics are reported by the metrics plugins enabled on the Galaxy server (core, cgroup, cpuinfo, meminfo, ...),
+and both the plugins and the order of their entries change from one server configuration to another. Entries are
+therefore picked by plugin and name, and converted to a stable schema: every job has all the fields below, set to
+None when the plugin reporting them is not enabled. Every metric reported by the server is kept as well, grouped by
+plugin, together with the keys historically written to the jobs metrics files (tool_id, runtime_value,
+runtime_raw_value, start, end).
+"""
+
+# Import dependencies
+from concurrent.futures import ThreadPoolExecutor
+
+import bioblend.galaxy
+
+# Version of the per-job schema, increased whenever a field changes meaning
+JOB_METRICS_SCHEMA = 2
+
+# Typed fields: field -> (type, [(plugin, name, scale), ...]), the first metric reported by the server is used
+JOB_METRICS_FIELDS = {
+    'galaxy_slots':(int, [('core', 'galaxy_slots', 1)]),
+    'galaxy_memory_mb':(int, [('core', 'galaxy_memory_mb', 1)]),
+    'runtime_seconds':(float, [('core', 'runtime_seconds', 1)]),
+    'start_epoch':(float, [('core', 'start_epoch', 1)]),
+    'end_epoch':(float, [('core', 'end_epoch', 1)]),
+    'cpu_time_seconds':(float, [('cgroup', 'cpuacct.usage', 1e-9), ('cgroup', 'cpu.stat.usage_usec', 1e-6)]),
+    'cpu_user_seconds':(float, [('cgroup', 'cpu.stat.user_usec', 1e-6)]),
+    'cpu_system_seconds':(float, [('cgroup', 'cpu.stat.system_usec', 1e-6)]),
+    'memory_peak_bytes':(int, [('cgroup', 'memory.max_usage_in_bytes', 1), ('cgroup', 'memory.peak', 1)]),
+    'memory_limit_bytes':(int, [('cgroup', 'memory.limit_in_bytes', 1), ('cgroup', 'memory.max', 1)]),
+    'memory_failcnt':(int, [('cgroup', 'memory.failcnt', 1), ('cgroup', 'memory.events.max', 1)]),
+    'memory_oom_kills':(int, [('cgroup', 'memory.oom_control.oom_kill', 1), ('cgroup', 'memory.events.oom_kill', 1)]),
+    'io_read_bytes':(int, [('cgroup', 'io.stat.rbytes', 1)]),
+    'io_write_bytes':(int, [('cgroup', 'io.stat.wbytes', 1)]),
+    'host_processor_count':(int, [('cpuinfo', 'processor_count', 1)]),
+    'host_memory_kb':(int, [('meminfo', 'total_memory', 1)])
+}
+
+
+def typed_value(raw_value):
+    """Convert a raw metric value, reported by Galaxy as a string, to int or float when possible
+
+    :param raw_value: Raw value of the metric
+    :type raw_value: str
+    :return: Converted value, or the raw value if it is not a number
+    :rtype: int, float or str
+    """
+    for cast in (int, float):
+        try:
+            return cast(raw_value)
+        except (TypeError, ValueError):
+            pass
+    return raw_value
+
+
+def parse_job_metrics(raw_job_metrics):
+    """Group the raw metrics of a job by plugin and name and extract the typed fields
+
+    :param raw_job_metrics: Metrics returned by JobsClient.get_metrics
+    :type raw_job_metrics: list of dict
+    :return: Typed fields, each set to None if not reported, and all the metrics grouped by plugin
+    :rtype: dict
+    """
+    metrics = dict()
+    for metric in raw_job_metrics:
+        metrics.setdefault(metric.get('plugin', 'unknown'), dict())[metric['name']] = typed_value(metric.get('raw_value'))
+
+    job_metrics = dict()
+    for field, (cast, sources) in JOB_METRICS_FIELDS.items():
+        job_metrics[field] = None
+        for plugin, name, scale in sources:
+            value = metrics.get(plugin, dict()).get(name)
+            if isinstance(value, (int, float)):
+                job_metrics[field] = cast(value * scale)
+                break
+
+    job_metrics['metrics'] = metrics
+    return job_metrics
+
+
+def legacy_job_metrics(raw_job_metrics):
+    """Keys written to the jobs metrics files before the typed schema, set to None if the core plugin is missing"""
+    core = {metric['name']: metric for metric in raw_job_metrics if metric.get('plugin') == 'core'}
+    runtime = core.get('runtime_seconds', dict())
+    return {
+        'runtime_value':runtime.get('value'),
+        'runtime_raw_value':runtime.get('raw_value'),
+        'start':core.get('start_epoch', dict()).get('value'),
+        'end':core.get('end_epoch', dict()).get('value')
+    }
+
+
+def collect_job_metrics(job_client, job, step=None):
+    job_id = job['id']
+
+    # Wait for the job to be finished
+    job_client.wait_for_job(job_id)
+
+    # Get raw job metrics
+    raw_job_metrics = job_client.get_metrics(job_id)
+
+    # Keep the legacy keys first, followed by the typed schema
+    job_metrics = {'tool_id':job['tool_id'], **legacy_job_metrics(raw_job_metrics)}
+    job_metrics['schema'] = JOB_METRICS_SCHEMA
+
+    # Creation time (UTC, as reported by Galaxy) and workflow step of the job, to join jobs to the workflow DAG
+    job_metrics['create_time'] = job.get('create_time')
+    job_metrics['order_index'] = step.get('order_index') if step else None
+    job_metrics['step_label'] = step.get('workflow_step_label') if step else None
+    job_metrics.update(parse_job_metrics(raw_job_metrics))
+
+    return job_metrics
+
+
+def get_job_metrics(galaxy_instance, history_id, invocation_id=None, workers=8):
+    job_client = bioblend.galaxy.jobs.JobsClient(galaxy_instance)
+    history_jobs = job_client.get_jobs(history_id=history_id)
+
+    # Define filter for jobs, keeping the invocation step of each job
+    if invocation_id is not None:
+        invocation_client = bioblend.galaxy.invocations.InvocationClient(galaxy_instance)
+        invocation_steps = invocation_client.show_invocation(invocation_id)['steps']
+        job_steps = {step['job_id']: step for step in invocation_steps if step.get('job_id')}
+    else:
+        job_steps = {job['id']: None for job in history_jobs}
+
+    jobs = [job for job in history_jobs if job['id'] in job_steps]
+
+    # Wait for jobs and fetch their metrics with bounded concurrency
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(jobs)), 1)) as executor:
+        futures = {job['id']: executor.submit(collect_job_metrics, job_client, job, job_steps[job['id']]) for job in jobs}
+
+    # Build dictionary with metrics for each job, keeping the history order
+    jobs_metrics = {job_id: future.result() for job_id, future in futures.items()}
+
+    return jobs_metrics
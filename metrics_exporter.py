@@ -0,0 +1,192 @@
+"""
+Live progress of a run in the OpenMetrics text format, so that a long run can be scraped by Prometheus (or any
+compatible collector) and stopped early instead of waiting for the final stats.
+
+The exporter serves GET /metrics from a daemon thread of the harness with:
+- the jobs of the tracked histories and invocations by state, queried from Galaxy when scraped (cached for a few
+  seconds, with its own GalaxyInstance so that scrapes are not counted among the harness API calls)
+- the seconds spent in each phase of the run and the current phase
+- the Galaxy API calls made by the harness and their total time, by phase and endpoint
+- the rates of the last sample of the disk sampler streamed by dstat.py
+"""
+
+# Import dependencies
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import bioblend.galaxy
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# Job states always exposed, so that dashboards get a zero instead of a missing series
+JOB_STATES = ('new', 'queued', 'running', 'ok', 'error', 'paused', 'deleted')
+
+# Disk sampler columns, as written by dstat, and the gauges exposing them
+DISK_GAUGES = [
+    ('read_tps', 'disk_reads_per_second', 'Read requests per second of the last disk sample'),
+    ('write_tps', 'disk_writes_per_second', 'Write requests per second of the last disk sample'),
+    ('rMB/s', 'disk_read_bytes_per_second', 'Bytes read per second of the last disk sample'),
+    ('wMB/s', 'disk_written_bytes_per_second', 'Bytes written per second of the last disk sample')
+]
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricFamily:
+
+    def __init__(self, name, metric_type, help_text):
+        self.name = f'bioblend_test_{name}'
+        self.metric_type = metric_type
+        self.help_text = help_text
+        self.samples = []
+
+    def add(self, value, suffix='', **labels):
+        self.samples.append((suffix, labels, value))
+        return self
+
+    def render(self):
+        lines = [f'# TYPE {self.name} {self.metric_type}', f'# HELP {self.name} {self.help_text}']
+        for suffix, labels, value in self.samples:
+            label_text = ','.join(f'{key}="{escape(label)}"' for key, label in labels.items())
+            lines.append(f'{self.name}{suffix}{{{label_text}}} {value}' if label_text else f'{self.name}{suffix} {value}')
+        return lines
+
+
+class MetricsExporter:
+
+    def __init__(self, galaxy_instance, api_stats, port, host='', jobs_cache_seconds=5):
+        # Jobs are queried with a separate, not instrumented, Galaxy instance
+        self.galaxy_instance = bioblend.galaxy.GalaxyInstance(url=galaxy_instance.base_url, key=galaxy_instance.key)
+        self.api_stats = api_stats
+        self.port = port
+        self.host = host
+        self.jobs_cache_seconds = jobs_cache_seconds
+        self.tracked = dict()
+        self.dstat_stream = None
+        self.jobs = None
+        self.jobs_time = 0
+        self.jobs_errors = 0
+        self.server = None
+        # Invocations are tracked from the load mode threads, scrapes are served concurrently
+        self.lock = threading.Lock()
+        self.jobs_lock = threading.Lock()
+
+    def start(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f'Metrics exported on http://{self.host or "0.0.0.0"}:{self.server.server_address[1]}/metrics')
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def track(self, history_id, invocation_id=None):
+        """Count the jobs of a history, or only those of its invocation once it is given
+
+        :param history_id: History id
+        :type history_id: str
+        :param invocation_id: Invocation id, defaults to None (all the jobs of the history)
+        :type invocation_id: str, optional
+        """
+        with self.lock:
+            self.tracked[history_id] = invocation_id
+            self.jobs_time = 0
+
+    def watch_disk(self, dstat_stream):
+        self.dstat_stream = dstat_stream
+
+    def job_states(self):
+        # Query Galaxy at most once every jobs_cache_seconds, keeping the last counts if it fails
+        with self.jobs_lock:
+            if time.time() - self.jobs_time < self.jobs_cache_seconds:
+                return self.jobs
+            with self.lock:
+                tracked = dict(self.tracked)
+            try:
+                jobs = dict.fromkeys(JOB_STATES, 0)
+                for history_id, invocation_id in tracked.items():
+                    if invocation_id is None:
+                        history_jobs = self.galaxy_instance.jobs.get_jobs(history_id=history_id)
+                    else:
+                        history_jobs = self.galaxy_instance.jobs.get_jobs(invocation_id=invocation_id)
+                    for job in history_jobs:
+                        jobs[job['state']] = jobs.get(job['state'], 0) + 1
+                self.jobs = jobs
+            except Exception:
+                # Galaxy being unreachable must not break the scrape nor the run
+                self.jobs_errors += 1
+            self.jobs_time = time.time()
+            return self.jobs
+
+    def disk_sample(self):
+        if self.dstat_stream is None:
+            return None
+        try:
+            return self.dstat_stream.latest_sample()
+        except Exception:
+            # Nothing streamed yet, or a sample being written
+            return None
+
+    def render(self):
+        families = []
+
+        jobs = self.job_states()
+        if jobs is not None:
+            family = MetricFamily('jobs', 'gauge', 'Jobs of the tracked histories and invocations by state')
+            families.append(family)
+            for state, count in sorted(jobs.items()):
+                family.add(count, state=state)
+        families.append(MetricFamily('jobs_query_errors', 'counter', 'Failed queries of the jobs to Galaxy').add(self.jobs_errors, '_total'))
+        families.append(MetricFamily('tracked_histories', 'gauge', 'Histories whose jobs are counted').add(len(self.tracked)))
+
+        if self.api_stats is not None:
+            phase_seconds = self.api_stats.phase_seconds()
+            family = MetricFamily('phase_seconds', 'gauge', 'Seconds spent in each phase of the run, the current one included')
+            families.append(family)
+            for phase, seconds in phase_seconds.items():
+                family.add(f'{seconds:.3f}', phase=phase)
+            families.append(MetricFamily('current_phase', 'gauge', 'Phase the run is in').add(1, phase=self.api_stats.current_phase))
+            families.append(MetricFamily('run_seconds', 'gauge', 'Seconds since the start of the run').add(f'{sum(phase_seconds.values()):.3f}'))
+
+            calls = MetricFamily('api_calls', 'counter', 'Galaxy API calls made by the harness')
+            seconds = MetricFamily('api_call_seconds', 'counter', 'Time spent in the Galaxy API calls made by the harness')
+            response_bytes = MetricFamily('api_response_bytes', 'counter', 'Bytes of the Galaxy API responses')
+            families += [calls, seconds, response_bytes]
+            for phase, phase_summary in self.api_stats.summary()['phases'].items():
+                for endpoint, stats in phase_summary['endpoints'].items():
+                    calls.add(stats['count'], '_total', phase=phase, endpoint=endpoint)
+                    seconds.add(f"{stats['total_seconds']:.6f}", '_total', phase=phase, endpoint=endpoint)
+                    response_bytes.add(stats['response_bytes'], '_total', phase=phase, endpoint=endpoint)
+
+        sample = self.disk_sample()
+        if sample is not None:
+            for column, name, help_text in DISK_GAUGES:
+                families.append(MetricFamily(name, 'gauge', help_text).add(f'{sample[column]:.3f}', device=self.dstat_stream.device))
+
+        lines = [line for family in families for line in family.render()]
+        return '\n'.join(lines + ['# EOF']) + '\n'
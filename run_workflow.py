@@ -3,14 +3,46 @@
 # Import dependencies
 import argparse
 import bioblend.galaxy
+import hashlib
 import json
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import os
 from urllib.parse import urlparse
+from bioblend.galaxy.datasets import DatasetStateException, DatasetTimeoutException
 
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__)))
-from dstat import SSHClient
+from dstat import SSHClient, DstatStream, DiskstatsStream
+from job_metrics import get_job_metrics
+from api_stats import instrument
+from metrics_exporter import MetricsExporter
+
+# History keeping the input datasets cached across runs
+INPUTS_HISTORY_NAME = 'bioblend_test inputs'
+
+# Data library through which files already on the Galaxy host are linked, without copying them
+LINKED_INPUTS_LIBRARY_NAME = 'bioblend_test linked inputs'
+
+# Tag of the histories created by the harness, the only ones purged by --clean-histories
+HARNESS_HISTORY_TAG = 'bioblend_test'
+
+# Seconds left to Galaxy to remove the files of the purged histories in the background, before the run starts
+PURGE_SETTLE_SECONDS = 30
+
+# Dataset states used when waiting for a whole history
+DATASET_PENDING_STATES = ('new', 'upload', 'queued', 'running', 'setting_metadata')
+DATASET_ERROR_STATES = ('error', 'failed_metadata')
+
+# Resumable uploads of local files: directory keeping the URLs of interrupted uploads, retries of a failed chunk
+TUS_STORAGE_DIR = '~/.bioblend_test_tus'
+TUS_RETRIES = 3
+TUS_RETRY_DELAY = 5
+
+# Percentiles of the invocation latency and of the job queue wait reported in load mode
+LOAD_PERCENTILES = (50, 90, 95, 99)
 
 ################################################################################
 # COMMAND LINE OPTIONS
@@ -19,87 +51,364 @@ def cli_options():
     parser.add_argument('--endpoint', dest='endpoint', default='http://localhost', help='Galaxy server URL')
     parser.add_argument('--api-key', dest='api_key', default='not_very_secret_api_key', help='Galaxy user API key')
     parser.add_argument('--history-name', default='wf-test', dest='history_name', help='New history name')
-    parser.add_argument('--clean-histories', default=False, dest='clean_histories', action='store_true', help='If set, all histories will be deleted before running the workflow')
-    parser.add_argument('-i', dest='wf_inputs_path', default='./inputs/input_files.json', help="JSON file containing input files URLs")
+    parser.add_argument('--clean-histories', default=False, dest='clean_histories', action='store_true', help='If set, the histories created by previous runs will be purged before running the workflow')
+    parser.add_argument('-i', dest='wf_inputs_path', default='./inputs/input_files.json', help="JSON file containing input files URLs, local paths or paths on the Galaxy host")
     parser.add_argument('--wf-path', default='./workflows/test_workflow.ga', dest='wf_path', help='Workflow path')
     parser.add_argument('--disk-metrics', default=False, dest='log_disk_metrics', action='store_true', help='If set, disk metrics are logged with dstat')
     parser.add_argument('--ssh-user', default='Pietro', dest='ssh_user', help='Galaxy vm ssh user')
     parser.add_argument('--ssh-key', default='~/.ssh/laniakea-robot.key', dest='ssh_key', help='Galaxy vm ssh key')
     parser.add_argument('--dstat-output-dir', default='~/dstat_out', dest='dstat_output_dir', help='dstat output dir')
     parser.add_argument('--dstat-device', default='vdb1', dest='dstat_device', help='dstat device to monitor')
+    parser.add_argument('--disk-sampler', default='dstat', choices=['dstat', 'diskstats'], dest='disk_sampler', help='Disk metrics sampler: dstat or the built-in /proc/diskstats sampler')
+    parser.add_argument('--sample-rate', default=10, type=float, dest='sample_rate', help='Samples per second of the diskstats sampler')
+    parser.add_argument('--input-cache', default=False, dest='input_cache', action='store_true', help='If set, input files already uploaded to the inputs history are copied instead of uploaded again')
+    parser.add_argument('--no-workflow-cache', default=True, dest='workflow_cache', action='store_false', help='If set, the workflow is imported again even if it was already imported with the same content')
+    parser.add_argument('--upload-workers', default=None, type=int, dest='upload_workers', help='Maximum number of concurrent uploads (default: all files at once)')
+    parser.add_argument('--upload-chunk-size', default=10, type=float, dest='upload_chunk_size', help='Size in MB of the chunks in which local input files are uploaded')
+    parser.add_argument('--metrics-workers', default=8, type=int, dest='metrics_workers', help='Maximum number of jobs whose metrics are fetched concurrently')
+    parser.add_argument('--api-stats', default=False, dest='log_api_stats', action='store_true', help='If set, the Galaxy API calls are recorded and summarized in api_stats.json')
+    parser.add_argument('--purge-workers', default=8, type=int, dest='purge_workers', help='Maximum number of histories purged concurrently')
+    parser.add_argument('--purge-settle', default=PURGE_SETTLE_SECONDS, type=float, dest='purge_settle', help='Seconds waited after the histories are purged, while Galaxy removes their files in the background')
+    parser.add_argument('--concurrency', default=None, type=int, dest='concurrency', help='If set, the workflow is invoked this many times concurrently, each in its own history, and throughput and latency are reported (load mode)')
+    parser.add_argument('--ramp-up', default=0, type=float, dest='ramp_up', help='Seconds over which the concurrent invocations are started evenly (load mode)')
+    parser.add_argument('--metrics-port', default=None, type=int, dest='metrics_port', help='If set, live jobs states, phase durations, API calls and disk samples are exported on this port in the OpenMetrics format')
     parser.add_argument('--metrics-output-dir', default='.', dest='metrics_output_dir', help="Path in which jobs metrics are written")
     return parser.parse_args()
 
 
-def upload_and_build_data_input(inputs_path, galaxy_instance, history_id, workflow_id):
+def import_workflow(galaxy_instance, wf_path, workflow_cache=True):
+    start = time.time()
+
+    # Look for a workflow imported from a .ga file with the same content
+    workflow_id = None
+    if workflow_cache:
+        with open(wf_path, 'rb') as f:
+            content = f.read()
+        tag = 'wf_sha1:' + hashlib.sha1(content).hexdigest()
+        for workflow in galaxy_instance.workflows.get_workflows():
+            if tag in workflow.get('tags', []):
+                workflow_id = workflow['id']
+                break
+    looked_up = time.time()
+
+    # Import the workflow only if it changed, tagging it with its content hash
+    cache_hit = workflow_id is not None
+    if not cache_hit:
+        if workflow_cache:
+            workflow_dict = json.loads(content)
+            workflow_dict['tags'] = workflow_dict.get('tags', []) + [tag]
+            workflow_id = galaxy_instance.workflows.import_workflow_dict(workflow_dict)['id']
+        else:
+            workflow_id = galaxy_instance.workflows.import_workflow_from_local_path(wf_path)['id']
+    imported = time.time()
+
+    import_times = {
+        'lookup_seconds':looked_up - start,
+        'import_seconds':imported - looked_up,
+        'cached':cache_hit
+    }
+    print(f"Workflow {workflow_id}{' (cached)' if cache_hit else ''}: looked up in {import_times['lookup_seconds']:.2f}s, imported in {import_times['import_seconds']:.2f}s")
+    return workflow_id, import_times
+
+
+def write_run_metrics(run_metrics, output_file, update=False):
+    # With update, metrics written earlier in the same run (e.g. the cleanup) are kept
+    Path(os.path.dirname(output_file) or '.').mkdir(parents=True, exist_ok=True)
+    if update and os.path.exists(output_file):
+        with open(output_file, 'r', encoding='utf-8') as f:
+            run_metrics = {**json.load(f), **run_metrics}
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(run_metrics, f, ensure_ascii=False, indent=4)
+
+
+def get_workflow_inputs_map(galaxy_instance, workflow_id):
+    # Resolve the label -> input step map with a single API call
+    wf_inputs = galaxy_instance.workflows.show_workflow(workflow_id)['inputs']
+    return {wf_input['label']: step_id for step_id, wf_input in wf_inputs.items()}
+
+
+def upload_file(galaxy_instance, history_id, file_name, file_options, chunk_size=10):
+    # Local files are sent by the harness, the others are fetched by Galaxy from their URL
+    if 'path' in file_options:
+        return upload_local_file(galaxy_instance, history_id, file_name, file_options, chunk_size)
+
+    start = time.time()
+
+    # Submit upload, the dataset is waited for together with the others of the history
+    upload = galaxy_instance.tools.put_url(file_options['url'], history_id=history_id, file_name=file_name, file_type=file_options['file_type'])
+    upload_id = upload['outputs'][0]['id']
+    submitted = time.time()
+
+    upload_times = {
+        'start_epoch':start,
+        'submit_seconds':submitted - start
+    }
+    return upload_id, upload_times
+
+
+def upload_local_file(galaxy_instance, history_id, file_name, file_options, chunk_size=10):
+    path = os.path.abspath(os.path.expanduser(file_options['path']))
+    start = time.time()
+
+    # Send the file in chunks to the tus endpoint, resuming from the last chunk received if a previous upload failed.
+    # Each file keeps its upload URL in its own storage file, as files are uploaded by concurrent threads. The URL
+    # belongs to a Galaxy server, so the storage is kept by server and file
+    storage_dir = os.path.expanduser(TUS_STORAGE_DIR)
+    Path(storage_dir).mkdir(parents=True, exist_ok=True)
+    storage = f"{storage_dir}/{hashlib.sha1(f'{galaxy_instance.base_url}|{path}'.encode()).hexdigest()}.json"
+    try:
+        uploader = galaxy_instance.get_tus_uploader(path, storage=storage, chunk_size=int(chunk_size * 1e6))
+    except bioblend.ConnectionError as e:
+        # The upload to resume is unknown to Galaxy (e.g. restarted or its tus directory cleaned): start a new one
+        print(f"Upload {file_name}: cannot resume the previous upload ({e}), uploading again")
+        os.remove(storage)
+        uploader = galaxy_instance.get_tus_uploader(path, storage=storage, chunk_size=int(chunk_size * 1e6))
+    uploader.retries = TUS_RETRIES
+    uploader.retry_delay = TUS_RETRY_DELAY
+    resumed_bytes = uploader.offset
+    uploader.upload()
+    transferred = time.time()
+
+    # Create the dataset from the uploaded file
+    upload = galaxy_instance.tools.post_to_fetch(path, history_id, uploader.session_id, file_name=file_name, file_type=file_options['file_type'])
+    upload_id = upload['outputs'][0]['id']
+    submitted = time.time()
+
+    # The upload is complete, a new upload of the same file must not resume it
+    uploader.url_storage.close()
+    os.remove(storage)
+
+    file_size = uploader.get_file_size()
+    transfer_seconds = transferred - start
+    upload_times = {
+        'start_epoch':start,
+        'submit_seconds':submitted - start,
+        'transfer_seconds':transfer_seconds,
+        'bytes':file_size,
+        'resumed_bytes':resumed_bytes,
+        'MB/s':(file_size - resumed_bytes) / 1e6 / transfer_seconds if transfer_seconds > 0 else None
+    }
+    return upload_id, upload_times
+
+
+def input_cache_tag(file_options):
+    # Inputs are identified by their checksum if given, otherwise by their URL or local path
+    source = file_options.get('sha1') or file_options.get('url') or os.path.abspath(os.path.expanduser(file_options['path']))
+    return 'cache:' + hashlib.sha1(f"{source}|{file_options['file_type']}".encode()).hexdigest()
+
+
+def get_inputs_history(galaxy_instance):
+    histories = galaxy_instance.histories.get_histories(name=INPUTS_HISTORY_NAME)
+    if histories:
+        return histories[0]['id']
+    return galaxy_instance.histories.create_history(name=INPUTS_HISTORY_NAME)['id']
+
+
+def get_cached_inputs(galaxy_instance, inputs_history_id):
+    # Map cache tags to the datasets already uploaded in the inputs history
+    contents = galaxy_instance.histories.show_history(inputs_history_id, contents=True, deleted=False, details='all')
+    cached = dict()
+    for dataset in contents:
+        if dataset.get('state') == 'ok':
+            for tag in dataset.get('tags', []):
+                if tag.startswith('cache:'):
+                    cached[tag] = dataset['id']
+    return cached
+
+
+def copy_cached_file(galaxy_instance, history_id, inputs_history_id, cached_inputs, file_name, file_options, chunk_size=10):
+    start = time.time()
+
+    # Upload the file to the inputs history only if it is not there yet
+    tag = input_cache_tag(file_options)
+    cache_hit = tag in cached_inputs
+    if cache_hit:
+        dataset_id = cached_inputs[tag]
+    else:
+        dataset_id, _ = upload_file(galaxy_instance, inputs_history_id, file_name, file_options, chunk_size)
+        galaxy_instance.histories.update_dataset(inputs_history_id, dataset_id, tags=[tag])
+    submitted = time.time()
+
+    # Copy the dataset to the run history, without copying its data
+    copy = galaxy_instance.histories.copy_dataset(history_id, dataset_id, source='hda')
+    copied = time.time()
+
+    upload_times = {
+        'start_epoch':start,
+        'submit_seconds':submitted - start,
+        'copy_seconds':copied - start,
+        'cached':cache_hit
+    }
+    return copy['id'], upload_times
+
+
+def get_linked_inputs_library(galaxy_instance):
+    libraries = galaxy_instance.libraries.get_libraries(name=LINKED_INPUTS_LIBRARY_NAME)
+    if libraries:
+        return libraries[0]['id']
+    return galaxy_instance.libraries.create_library(LINKED_INPUTS_LIBRARY_NAME)['id']
+
+
+def get_linked_files(galaxy_instance, library_id):
+    # Map the paths on the Galaxy host to the library datasets already linking them
+    linked = dict()
+    for item in galaxy_instance.libraries.show_library(library_id, contents=True):
+        if item['type'] == 'file':
+            dataset = galaxy_instance.libraries.show_dataset(library_id, item['id'])
+            if dataset.get('state') == 'ok' and dataset.get('file_name'):
+                linked[dataset['file_name']] = item['id']
+    return linked
+
+
+def link_server_file(galaxy_instance, history_id, library_id, linked_files, file_name, file_options):
+    start = time.time()
+
+    # Link the file into the data library only if it is not linked yet
+    server_path = file_options['server_path']
+    cache_hit = server_path in linked_files
+    if cache_hit:
+        dataset_id = linked_files[server_path]
+    else:
+        dataset_id = galaxy_instance.libraries.upload_from_galaxy_filesystem(library_id, server_path, file_type=file_options['file_type'],
+                                                                             link_data_only='link_to_files')[0]['id']
+        galaxy_instance.libraries.wait_for_dataset(library_id, dataset_id, interval=1)
+    submitted = time.time()
+
+    # Import the library dataset to the run history as an HDA, still pointing to the file on the Galaxy host
+    hda = galaxy_instance.histories.upload_dataset_from_library(history_id, dataset_id)
+    imported = time.time()
+
+    upload_times = {
+        'start_epoch':start,
+        'submit_seconds':submitted - start,
+        'import_seconds':imported - start,
+        'linked':True,
+        'cached':cache_hit
+    }
+    return hda['id'], upload_times
+
+
+def upload_inputs(galaxy_instance, history_id, workflow_id, inputs_dict, workers=None, input_cache=False, chunk_size=10, wait=True):
+    # Map workflow input labels to their input steps only once
+    wf_inputs = get_workflow_inputs_map(galaxy_instance, workflow_id)
+
+    # Look for inputs already uploaded in a previous run
+    if input_cache:
+        inputs_history_id = get_inputs_history(galaxy_instance)
+        cached_inputs = get_cached_inputs(galaxy_instance, inputs_history_id)
+
+    # Look for files of the Galaxy host already linked in a previous run
+    if any('server_path' in file_options for file_options in inputs_dict.values()):
+        library_id = get_linked_inputs_library(galaxy_instance)
+        linked_files = get_linked_files(galaxy_instance, library_id)
+
+    # Submit the uploads with bounded concurrency, by default all files are submitted at the same time.
+    # Workers do not wait for their dataset, so that Galaxy fetches the files while the next ones are submitted
+    data = dict()
+    upload_times = dict()
+    max_workers = workers or max(len(inputs_dict), 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict()
+        for file_name, file_options in inputs_dict.items():
+            # Files of the Galaxy host are linked, never copied nor cached
+            if 'server_path' in file_options:
+                future = executor.submit(link_server_file, galaxy_instance, history_id, library_id, linked_files, file_name, file_options)
+            elif input_cache:
+                future = executor.submit(copy_cached_file, galaxy_instance, history_id, inputs_history_id, cached_inputs,
+                                         file_name, file_options, chunk_size)
+            else:
+                future = executor.submit(upload_file, galaxy_instance, history_id, file_name, file_options, chunk_size)
+            futures[future] = file_name
+        for future in as_completed(futures):
+            file_name = futures[future]
+            upload_id, upload_times[file_name] = future.result()
+            upload_times[file_name]['dataset_id'] = upload_id
+            data[wf_inputs[file_name]] = {'id':upload_id, 'src':'hda'}
+
+    # Wait for all the datasets of the history at once, taking the time each one was ready
+    if wait:
+        ready = wait_for_dataset(galaxy_instance, history_id)
+        set_finish_times(upload_times, ready)
+        print_upload_times(upload_times)
+
+    return data, upload_times
+
+
+def set_finish_times(upload_times, ready):
+    # Time from the start of each upload to its dataset being ready, with the ready times of wait_for_dataset
+    for times in upload_times.values():
+        times['finish_seconds'] = ready[times['dataset_id']] - times['start_epoch']
+
+
+def print_upload_times(upload_times):
+    for file_name, times in upload_times.items():
+        cached = ' (linked)' if times.get('linked') else ''
+        cached += ' (cached)' if times.get('cached') else ''
+        throughput = f", {times['MB/s']:.1f} MB/s" if times.get('MB/s') is not None else ''
+        finished = f", finished in {times['finish_seconds']:.2f}s" if 'finish_seconds' in times else ''
+        print(f"Upload {file_name}{cached}: submitted in {times['submit_seconds']:.2f}s{finished}{throughput}")
+
+
+def upload_and_build_data_input(inputs_path, galaxy_instance, history_id, workflow_id, workers=None, input_cache=False,
+                                chunk_size=10, run_metrics_file=None):
     with open(inputs_path, 'r') as f:
         inputs_dict = json.load(f)
-    data = dict()
-    for file_name, file_options in inputs_dict.items():
-        file_url = file_options['url']
-        file_type = file_options['file_type']
-        upload = galaxy_instance.tools.put_url(file_url, history_id=history_id, file_name=file_name, file_type=file_type)
-        upload_id = upload['outputs'][0]['id']
-        wf_input = galaxy_instance.workflows.get_workflow_inputs(workflow_id, label=file_name)[0]
-        data[wf_input] = {'id':upload_id, 'src':'hda'}
-
-    # Wait for dataset
-    wait_for_dataset(galaxy_instance, history_id)
-
-    return data
 
+    # Submit the uploads and wait for the datasets
+    data, upload_times = upload_inputs(galaxy_instance, history_id, workflow_id, inputs_dict, workers, input_cache, chunk_size)
 
-def wait_for_dataset(galaxy_instance, history_id):
-    dataset_client = bioblend.galaxy.datasets.DatasetClient(galaxy_instance)
-    all_datasets = dataset_client.get_datasets(history_id=history_id)
-    for dataset in all_datasets:
-        dataset_client.wait_for_dataset(dataset['id'])
+    # Keep the upload times (and throughput of local files) with the other run metrics
+    if run_metrics_file:
+        write_run_metrics({'uploads':upload_times}, run_metrics_file, update=True)
 
-
-def get_job_metrics(galaxy_instance, history_id, invocation_id):
-    job_client = bioblend.galaxy.jobs.JobsClient(galaxy_instance)
-    history_jobs = job_client.get_jobs(history_id=history_id)
-
-    # Define filter for jobs
-    if invocation_id is not None:
-        invocation_client = bioblend.galaxy.invocations.InvocationClient(galaxy_instance)
-        invocation_steps = invocation_client.show_invocation(invocation_id)['steps']
-        jobs_filter = [step['job_id'] for step in invocation_steps]
-    else:
-        jobs_filter = [job['id'] for job in history_jobs]
-
-    jobs_metrics = dict()
-
-    for job in history_jobs:
-        job_id = job['id']
-        if job_id in jobs_filter:
-            # Wait for the job to be finished
-            job_client.wait_for_job(job_id)
-
-            # Get raw job metrics
-            raw_job_metrics = job_client.get_metrics(job_id)
-            start_job_metrics = list(filter(lambda x: x['title']=='Job Start Time', raw_job_metrics))[0]
-            end_job_metrics = list(filter(lambda x: x['title']=='Job End Time', raw_job_metrics))[0]
-            runtime_job_metrics = list(filter(lambda x: x['title']=='Job Runtime (Wall Clock)', raw_job_metrics))[0]
-
-            # Take useful job metrics
-            job_metrics = {
-                'tool_id':job['tool_id'],
-                'runtime_value':runtime_job_metrics['value'],
-                'runtime_raw_value':runtime_job_metrics['raw_value'],
-                'start':start_job_metrics['value'],
-                'end':end_job_metrics['value']
-            }
-
-            # Build dictionary with metrics for each job
-            jobs_metrics[job_id] = job_metrics
-
-    return jobs_metrics
+    return data
 
 
-def write_jobs_metrics(galaxy_instance, history_id, output_file, invocation_id=None):
+def wait_for_dataset(galaxy_instance, history_id, interval=1, max_interval=30, backoff=1.5, maxwait=12000):
+    history_client = bioblend.galaxy.histories.HistoryClient(galaxy_instance)
+    start = time.time()
+    api_calls = 0
+    poll_interval = interval
+    last_pending = None
+    ready = dict()
+
+    # Poll the aggregate state of the history until every dataset is in a terminal state
+    while True:
+        state_ids = history_client.show_history(history_id)['state_ids']
+        api_calls += 1
+        now = time.time()
+        for state, dataset_ids in state_ids.items():
+            if state not in DATASET_PENDING_STATES:
+                for dataset_id in dataset_ids:
+                    ready.setdefault(dataset_id, now)
+
+        # Fail on the first errored dataset
+        errored = [dataset_id for state in DATASET_ERROR_STATES for dataset_id in state_ids.get(state, [])]
+        if errored:
+            raise DatasetStateException(f"Dataset {errored[0]} in history {history_id} is in error state")
+
+        pending = sum(len(state_ids.get(state, [])) for state in DATASET_PENDING_STATES)
+        if pending == 0:
+            break
+
+        if time.time() - start > maxwait:
+            raise DatasetTimeoutException(f"Datasets in history {history_id} not ready after {maxwait} seconds")
+
+        # Back off while nothing changes, poll quickly again as soon as datasets make progress
+        if pending != last_pending:
+            poll_interval = interval
+        else:
+            poll_interval = min(poll_interval * backoff, max_interval)
+        last_pending = pending
+        time.sleep(poll_interval)
+
+    print(f"Datasets in history {history_id} ready after {time.time() - start:.2f}s ({api_calls} API calls)")
+    return ready
+
+
+def write_jobs_metrics(galaxy_instance, history_id, output_file, invocation_id=None, workers=8):
     # Get upload jobs metrics
-    upload_jobs_metrics = get_job_metrics(galaxy_instance, history_id, invocation_id)
+    upload_jobs_metrics = get_job_metrics(galaxy_instance, history_id, invocation_id, workers)
 
     # Write upload job metrics to file
     output_dir = os.path.dirname(output_file)
@@ -107,87 +416,349 @@ def write_jobs_metrics(galaxy_instance, history_id, output_file, invocation_id=N
     with open(output_file,'w', encoding='utf-8') as f:
         json.dump(upload_jobs_metrics, f, ensure_ascii=False, indent=4)
 
-def clean_histories_files(galaxy_instance, ssh_client):
-    # Purge histories
-    history_client = bioblend.galaxy.histories.HistoryClient(galaxy_instance)
-    for history in history_client.get_histories():
-        history_client.delete_history(history['id'], purge=True)
+    return upload_jobs_metrics
 
-    # Clean files leftovers
-    ssh_client.run_command('sudo rm /export/galaxy/database/tmp/*url* /export/galaxy/database/files/000/*')
+def disk_usage(galaxy_instance):
+    return galaxy_instance.users.get_current_user().get('total_disk_usage') or 0
 
 
-def create_history(galaxy_instance, history_name, clean_histories=False):
-    # Delete all histories to ensure there's enough free space
+def clean_histories_files(galaxy_instance, workers=8, settle=PURGE_SETTLE_SECONDS):
+    start = time.time()
+    usage = disk_usage(galaxy_instance)
+
+    # Purge only the histories created by the harness, never the cached inputs
+    history_client = bioblend.galaxy.histories.HistoryClient(galaxy_instance)
+    histories = [history for history in history_client.get_histories(keys=['id', 'name', 'tags'])
+                 if HARNESS_HISTORY_TAG in history.get('tags', []) and history['name'] != INPUTS_HISTORY_NAME]
+
+    # Purge histories with bounded concurrency
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(histories)), 1)) as executor:
+        futures = [executor.submit(history_client.delete_history, history['id'], purge=True) for history in histories]
+        for future in as_completed(futures):
+            future.result()
+
+    # Galaxy flags the datasets as purged, and updates the history sizes and the user disk usage, as soon as the
+    # purge is requested, but removes their files in the background. No API tells when the files are gone, so wait a
+    # fixed time to keep this deletion I/O out of the disk metrics of the run
+    if histories and settle > 0:
+        time.sleep(settle)
+
+    # Freed according to the disk usage accounting of Galaxy, not measured on disk. Files shared with the cached
+    # inputs or linked from a data library are not counted
+    cleanup = {
+        'histories':len(histories),
+        'bytes_freed':usage - disk_usage(galaxy_instance),
+        'settle_seconds':settle if histories else 0,
+        'seconds':time.time() - start
+    }
+    print(f"Purged {cleanup['histories']} histories, {cleanup['bytes_freed'] / 1e6:.1f} MB freed according to Galaxy, in {cleanup['seconds']:.2f}s")
+    return cleanup
+
+
+def create_history(galaxy_instance, history_name, clean_histories=False, purge_workers=8, purge_settle=PURGE_SETTLE_SECONDS):
+    # Purge the histories of previous runs to ensure there's enough free space
     if clean_histories:
-        history_client = bioblend.galaxy.histories.HistoryClient(galaxy_instance)
-        for history in history_client.get_histories():
-            history_client.delete_history(history['id'], purge=True)
+        clean_histories_files(galaxy_instance, purge_workers, purge_settle)
 
+    # Tag the history, so that only the harness histories are purged
     new_hist = galaxy_instance.histories.create_history(name=history_name)
+    galaxy_instance.histories.update_history(new_hist['id'], tags=[HARNESS_HISTORY_TAG])
 
     return new_hist['id']
 
 
-def run_workflow(galaxy_instance, history_id, wf_path, wf_inputs_path, log_disk_metrics=False,
-                 metrics_output_dir=None, dstat_output_dir=None, device=None, ssh_client=None):
-    
-    # Prepare endpoint to log disk metrics with dstat
-    if log_disk_metrics:
+def mark_phase(phase, dstat_stream=None, api_stats=None):
+    # Record the start of a phase in the disk samples and in the API calls
+    if dstat_stream is not None:
+        dstat_stream.mark(phase)
+    if api_stats is not None:
+        api_stats.set_phase(phase)
+
+
+def start_disk_sampler(ssh_client, device, dstat_output_dir, metrics_output_dir, disk_sampler='dstat', sample_rate=10):
+    # Stream dstat (or the diskstats sampler) for the whole run into the metrics directory
+    local_dstat_dir = f"{metrics_output_dir}/{os.path.basename(dstat_output_dir.rstrip('/'))}"
+    if disk_sampler == 'diskstats':
+        dstat_stream = DiskstatsStream(ssh_client, device, dstat_output_dir, local_dstat_dir, rate=sample_rate)
+    else:
         ssh_client.install_dstat()
-        ssh_client.kill_dstat()
-        ssh_client.prepare_dstat_dir(dstat_output_dir)
-    
-    # Import workflow from file
-    wf = galaxy_instance.workflows.import_workflow_from_local_path(wf_path)
-    workflow_id = wf['id']
-    
-    # Start logging disk metrics for upload
-    if log_disk_metrics:
-        ssh_client.run_dstat(device, dstat_output_file='dstat_out_upload.csv')
+        dstat_stream = DstatStream(ssh_client, device, dstat_output_dir, local_dstat_dir)
+    dstat_stream.start()
+    return dstat_stream
 
-    # Upload input data and build dictionary for workflow
-    workflow_data = upload_and_build_data_input(wf_inputs_path, galaxy_instance, history_id, workflow_id)
 
-    # Stop dstat, write upload jobs metrics and restart dstat for wf disk monitoring
-    if log_disk_metrics:
-        ssh_client.kill_dstat()
-        write_jobs_metrics(galaxy_instance, history_id, output_file=f'{metrics_output_dir}/upload_jobs_metrics.json')
-        ssh_client.run_dstat(device, dstat_output_file='dstat_out_wf.csv')
-    
-    # Invoke workflow
-    wf_invocation = galaxy_instance.workflows.invoke_workflow(workflow_id, workflow_data, history_id=history_id)
-    wf_invocation_id = wf_invocation['id']
-    invocation_client = bioblend.galaxy.invocations.InvocationClient(galaxy_instance)
-    invocation_client.wait_for_invocation(wf_invocation_id)
+def run_workflow(galaxy_instance, history_id, wf_path, wf_inputs_path, log_disk_metrics=False,
+                 metrics_output_dir=None, dstat_output_dir=None, device=None, ssh_client=None, upload_workers=None,
+                 metrics_workers=8, disk_sampler='dstat', sample_rate=10, input_cache=False, workflow_cache=True,
+                 api_stats=None, upload_chunk_size=10, exporter=None):
 
-    # Stop dstat and write wf jobs metrics
+    # Prepare endpoint to log disk metrics with a single sampler streamed for the whole run
+    dstat_stream = None
     if log_disk_metrics:
-        write_jobs_metrics(galaxy_instance, history_id, output_file=f'{metrics_output_dir}/wf_jobs_metrics.json', invocation_id=wf_invocation_id)
-        ssh_client.kill_dstat()
-        ssh_client.get_dstat_out(metrics_output_dir)
-    wf_result = get_job_metrics(galaxy_instance, history_id, wf_invocation_id)
+        dstat_stream = start_disk_sampler(ssh_client, device, dstat_output_dir, metrics_output_dir, disk_sampler, sample_rate)
+        if exporter is not None:
+            exporter.watch_disk(dstat_stream)
+
+    try:
+        # Import workflow from file, reusing the one already imported if its content did not change
+        mark_phase('import', api_stats=api_stats)
+        workflow_id, import_times = import_workflow(galaxy_instance, wf_path, workflow_cache)
+        run_metrics_file = f'{metrics_output_dir}/run_metrics.json' if metrics_output_dir else None
+        if run_metrics_file:
+            write_run_metrics({'workflow_import':import_times}, run_metrics_file, update=True)
+
+        # Mark the start of the upload phase
+        mark_phase('upload', dstat_stream, api_stats)
+
+        # Upload input data and build dictionary for workflow
+        workflow_data = upload_and_build_data_input(wf_inputs_path, galaxy_instance, history_id, workflow_id, upload_workers,
+                                                    input_cache, upload_chunk_size, run_metrics_file)
+
+        # Write upload jobs metrics and mark the start of the workflow phase
+        if log_disk_metrics:
+            mark_phase('upload_metrics', dstat_stream, api_stats)
+            write_jobs_metrics(galaxy_instance, history_id, output_file=f'{metrics_output_dir}/upload_jobs_metrics.json', workers=metrics_workers)
+        mark_phase('wf', dstat_stream, api_stats)
+
+        # Invoke workflow
+        wf_invocation = galaxy_instance.workflows.invoke_workflow(workflow_id, workflow_data, history_id=history_id)
+        wf_invocation_id = wf_invocation['id']
+        if exporter is not None:
+            exporter.track(history_id, wf_invocation_id)
+        invocation_client = bioblend.galaxy.invocations.InvocationClient(galaxy_instance)
+        invocation_client.wait_for_invocation(wf_invocation_id)
+
+        # Write wf jobs metrics and mark the end of the run
+        mark_phase('wf_metrics', api_stats=api_stats)
+        if log_disk_metrics:
+            wf_result = write_jobs_metrics(galaxy_instance, history_id, output_file=f'{metrics_output_dir}/wf_jobs_metrics.json',
+                                           invocation_id=wf_invocation_id, workers=metrics_workers)
+        else:
+            wf_result = get_job_metrics(galaxy_instance, history_id, wf_invocation_id, metrics_workers)
+        mark_phase('end', dstat_stream, api_stats)
+    finally:
+        # Stop dstat and derive the per-phase dstat outputs, also when the run fails
+        if dstat_stream is not None:
+            dstat_stream.stop()
+            dstat_stream.split(phases=('upload', 'wf'))
+
     print("WORKFLOW SUCCEDED WITH THE FOLLOWING STATS:")
     wf_stats = json.dumps(wf_result, indent=4, sort_keys=True)
     print(wf_stats)
 
 
+def percentiles(values, quantiles=LOAD_PERCENTILES):
+    # Linearly interpolated percentiles and maximum, None when there are no values
+    values = sorted(values)
+    result = dict()
+    for q in quantiles:
+        if not values:
+            result[f'p{q}'] = None
+            continue
+        position = (len(values) - 1) * q / 100
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        result[f'p{q}'] = values[lower] + (values[upper] - values[lower]) * (position - lower)
+    result['max'] = values[-1] if values else None
+    return result
+
+
+def galaxy_epoch(galaxy_time):
+    # Galaxy reports creation and update times in UTC, without time zone
+    return datetime.fromisoformat(galaxy_time).replace(tzinfo=timezone.utc).timestamp()
+
+
+def job_queue_wait(job_metrics):
+    # Time from the job creation (UTC, as reported by Galaxy) to its start
+    if not job_metrics.get('create_time') or job_metrics.get('start_epoch') is None:
+        return None
+    return job_metrics['start_epoch'] - galaxy_epoch(job_metrics['create_time'])
+
+
+def run_invocation(galaxy_instance, workflow_id, workflow_data, history_name, delay=0, metrics_workers=8, exporter=None):
+    # Wait for the ramp-up start of this invocation
+    time.sleep(delay)
+    history_id = create_history(galaxy_instance, history_name)
+
+    # Invoke workflow in its own history. Submission and end are both taken from the Galaxy clock, so that the clock
+    # skew between the harness and the Galaxy VM does not end up in the latency
+    invocation = galaxy_instance.workflows.invoke_workflow(workflow_id, workflow_data, history_id=history_id)
+    invocation_id = invocation['id']
+    submitted = galaxy_epoch(invocation['create_time'])
+    if exporter is not None:
+        exporter.track(history_id, invocation_id)
+    invocation_client = bioblend.galaxy.invocations.InvocationClient(galaxy_instance)
+    invocation_client.wait_for_invocation(invocation_id)
+
+    # Wait for every job of the invocation, collecting its metrics
+    jobs_metrics = get_job_metrics(galaxy_instance, history_id, invocation_id, metrics_workers)
+    ends = [job_metrics['end_epoch'] for job_metrics in jobs_metrics.values() if job_metrics.get('end_epoch') is not None]
+    finished = max(ends) if ends else None
+
+    invocation = {
+        'history_id':history_id,
+        'invocation_id':invocation_id,
+        'submitted':submitted,
+        'finished':finished,
+        'latency_seconds':finished - submitted if finished is not None else None,
+        'jobs':len(jobs_metrics)
+    }
+    if finished is None:
+        # Without the core metrics plugin the end of the jobs is unknown
+        print(f"Invocation {invocation_id}: {len(jobs_metrics)} jobs finished, no job end time reported")
+    else:
+        print(f"Invocation {invocation_id}: {len(jobs_metrics)} jobs finished after {invocation['latency_seconds']:.2f}s")
+    return invocation, jobs_metrics
+
+
+def summarize_load(invocations, jobs, concurrency, ramp_up=0):
+    # Throughput over the window from the first submission to the last job end
+    completed = [invocation for invocation in invocations if 'error' not in invocation]
+    # Invocations without any job end time are counted as completed, but left out of the window and the latencies
+    timed = [invocation for invocation in completed if invocation['finished'] is not None]
+    window = max(i['finished'] for i in timed) - min(i['submitted'] for i in timed) if timed else 0
+    hours = window / 3600
+    queue_waits = [job['queue_wait_seconds'] for job in jobs.values() if job['queue_wait_seconds'] is not None]
+
+    return {
+        'concurrency':concurrency,
+        'ramp_up_seconds':ramp_up,
+        'invocations':len(invocations),
+        'completed':len(completed),
+        'failed':len(invocations) - len(completed),
+        'jobs':len(jobs),
+        'window_seconds':window,
+        'invocations_per_hour':len(completed) / hours if hours else None,
+        'jobs_per_hour':len(jobs) / hours if hours else None,
+        'latency_seconds':percentiles([invocation['latency_seconds'] for invocation in timed]),
+        'queue_wait_seconds':percentiles(queue_waits)
+    }
+
+
+def run_load(galaxy_instance, history_id, history_name, wf_path, wf_inputs_path, concurrency, ramp_up=0,
+             log_disk_metrics=False, metrics_output_dir=None, dstat_output_dir=None, device=None, ssh_client=None,
+             upload_workers=None, metrics_workers=8, disk_sampler='dstat', sample_rate=10, input_cache=False,
+             workflow_cache=True, api_stats=None, upload_chunk_size=10, exporter=None):
+
+    # Prepare endpoint to log disk metrics with a single sampler streamed for the whole load window
+    dstat_stream = None
+    if log_disk_metrics:
+        dstat_stream = start_disk_sampler(ssh_client, device, dstat_output_dir, metrics_output_dir, disk_sampler, sample_rate)
+        if exporter is not None:
+            exporter.watch_disk(dstat_stream)
+
+    try:
+        # Import workflow from file, reusing the one already imported if its content did not change
+        mark_phase('import', api_stats=api_stats)
+        workflow_id, import_times = import_workflow(galaxy_instance, wf_path, workflow_cache)
+        run_metrics_file = f'{metrics_output_dir}/run_metrics.json' if metrics_output_dir else None
+        if run_metrics_file:
+            write_run_metrics({'workflow_import':import_times}, run_metrics_file, update=True)
+
+        # Upload input data once, every invocation reads it from this history
+        mark_phase('upload', dstat_stream, api_stats)
+        workflow_data = upload_and_build_data_input(wf_inputs_path, galaxy_instance, history_id, workflow_id, upload_workers,
+                                                    input_cache, upload_chunk_size, run_metrics_file)
+        if log_disk_metrics:
+            mark_phase('upload_metrics', dstat_stream, api_stats)
+            write_jobs_metrics(galaxy_instance, history_id, output_file=f'{metrics_output_dir}/upload_jobs_metrics.json', workers=metrics_workers)
+        mark_phase('wf', dstat_stream, api_stats)
+
+        # Start the invocations evenly over the ramp-up, each in its own history
+        invocations = []
+        jobs = dict()
+        wf_jobs_metrics = dict()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(run_invocation, galaxy_instance, workflow_id, workflow_data, f'{history_name}-{i + 1}',
+                                       ramp_up * i / max(concurrency - 1, 1), metrics_workers, exporter): i
+                       for i in range(concurrency)}
+            for future in as_completed(futures):
+                try:
+                    invocation, jobs_metrics = future.result()
+                except Exception as e:
+                    # A failed job or invocation only ends that invocation
+                    print(f'Invocation {futures[future] + 1} failed: {e}')
+                    invocations.append({'index':futures[future] + 1, 'error':str(e)})
+                    continue
+                invocations.append({'index':futures[future] + 1, **invocation})
+                wf_jobs_metrics.update(jobs_metrics)
+                for job_id, job_metrics in jobs_metrics.items():
+                    jobs[job_id] = {
+                        'invocation_id':invocation['invocation_id'],
+                        'tool_id':job_metrics['tool_id'],
+                        'queue_wait_seconds':job_queue_wait(job_metrics),
+                        'runtime_seconds':job_metrics.get('runtime_seconds')
+                    }
+        mark_phase('end', dstat_stream, api_stats)
+    finally:
+        # Stop dstat and derive the per-phase dstat outputs, also when the run fails
+        if dstat_stream is not None:
+            dstat_stream.stop()
+            dstat_stream.split(phases=('upload', 'wf'))
+
+    # Write the jobs of every invocation together, as for a single run, and the load report
+    invocations.sort(key=lambda invocation: invocation['index'])
+    summary = summarize_load(invocations, jobs, concurrency, ramp_up)
+    if log_disk_metrics:
+        write_run_metrics(wf_jobs_metrics, f'{metrics_output_dir}/wf_jobs_metrics.json')
+    write_run_metrics({'summary':summary, 'invocations':invocations, 'jobs':jobs}, f"{metrics_output_dir or '.'}/load_metrics.json")
+
+    print("LOAD TEST FINISHED WITH THE FOLLOWING STATS:")
+    print(json.dumps(summary, indent=4))
+    return summary
+
+
 def run_galaxy_tools(endpoint, api_key, history_name, wf_path, wf_inputs_path, clean_histories=False,
                      log_disk_metrics=False, metrics_output_dir=None, dstat_output_dir=None,
-                     device=None, ssh_key=None, ssh_user=None):
+                     device=None, ssh_key=None, ssh_user=None, upload_workers=None, metrics_workers=8,
+                     disk_sampler='dstat', sample_rate=10, input_cache=False, workflow_cache=True,
+                     log_api_stats=False, concurrency=None, ramp_up=0, purge_workers=8, upload_chunk_size=10,
+                     metrics_port=None, purge_settle=PURGE_SETTLE_SECONDS):
 
     galaxy_instance = bioblend.galaxy.GalaxyInstance(url=endpoint, key=api_key)
 
-    endpoint_ip = urlparse(endpoint).netloc
-    ssh_client = SSHClient(ssh_key, ssh_user, endpoint_ip)
+    # Record the API calls of the whole run, the exporter reads the phases and calls from the same record
+    api_stats = instrument(galaxy_instance) if log_api_stats or metrics_port else None
 
-    if clean_histories:
-        clean_histories_files(galaxy_instance, ssh_client)
+    # Export the run progress live
+    exporter = MetricsExporter(galaxy_instance, api_stats, metrics_port).start() if metrics_port else None
 
-    history_id = create_history(galaxy_instance, history_name, clean_histories)
+    endpoint_ip = urlparse(endpoint).netloc
+    ssh_client = SSHClient(ssh_key, ssh_user, endpoint_ip)
 
-    run_workflow(galaxy_instance, history_id, wf_path, wf_inputs_path, log_disk_metrics,
-                 metrics_output_dir, dstat_output_dir, device, ssh_client)
+    # Open the SSH connection once, every command of the run reuses it
+    if log_disk_metrics:
+        ssh_client.open()
+
+    try:
+        # Purge the histories of previous runs before the disk metrics are collected
+        cleanup = clean_histories_files(galaxy_instance, purge_workers, purge_settle) if clean_histories else None
+        if metrics_output_dir:
+            write_run_metrics({'cleanup':cleanup}, f'{metrics_output_dir}/run_metrics.json')
+
+        # In load mode this history only keeps the inputs shared by the invocations
+        history_id = create_history(galaxy_instance, history_name)
+        if exporter is not None:
+            exporter.track(history_id)
+
+        if concurrency:
+            run_load(galaxy_instance, history_id, history_name, wf_path, wf_inputs_path, concurrency, ramp_up,
+                     log_disk_metrics, metrics_output_dir, dstat_output_dir, device, ssh_client, upload_workers,
+                     metrics_workers, disk_sampler, sample_rate, input_cache, workflow_cache, api_stats, upload_chunk_size, exporter)
+        else:
+            run_workflow(galaxy_instance, history_id, wf_path, wf_inputs_path, log_disk_metrics,
+                         metrics_output_dir, dstat_output_dir, device, ssh_client, upload_workers,
+                         metrics_workers, disk_sampler, sample_rate, input_cache, workflow_cache, api_stats, upload_chunk_size, exporter)
+    finally:
+        if log_disk_metrics:
+            ssh_client.close()
+        if exporter is not None:
+            exporter.stop()
+
+        # Write the API calls summary, also when the run fails
+        if log_api_stats:
+            Path(metrics_output_dir or '.').mkdir(parents=True, exist_ok=True)
+            api_stats.dump(f"{metrics_output_dir or '.'}/api_stats.json")
 
 
 if __name__ == '__main__':
@@ -195,4 +766,7 @@ if __name__ == '__main__':
     options = cli_options()
 
     run_galaxy_tools(options.endpoint, options.api_key, options.history_name, options.wf_path, options.wf_inputs_path, options.clean_histories,
-                     options.log_disk_metrics, options.metrics_output_dir, options.dstat_output_dir, options.dstat_device, options.ssh_key, options.ssh_user)
+                     options.log_disk_metrics, options.metrics_output_dir, options.dstat_output_dir, options.dstat_device, options.ssh_key, options.ssh_user,
+                     options.upload_workers, options.metrics_workers, options.disk_sampler, options.sample_rate,
+                     options.input_cache, options.workflow_cache, options.log_api_stats, options.concurrency, options.ramp_up,
+                     options.purge_workers, options.upload_chunk_size, options.metrics_port, options.purge_settle)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the overhead of the harness itself, run against the local fake Galaxy of fake_galaxy.py so that the
+numbers do not depend on a Galaxy VM, on the network or on the tools. Since the simulated job times are known exactly,
+the time the harness spends after the jobs end can be measured:
+1. API calls of each run, by phase (import, upload, wf, wf_metrics)
+2. Polling latency: time from the end of the last upload job to the end of the wait for the uploaded datasets
+3. Metrics latency: time from the end of the last workflow job to the workflow jobs metrics written
+4. Time and API calls of the tool installation, sequential and parallel (install_tools_from_wf.py)
+"""
+
+# Dependencies
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import bioblend.galaxy
+import pandas as pd
+
+from fake_galaxy import serve
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from api_stats import instrument
+from install_tools_from_wf import install_tools, install_tools_parallel
+from run_workflow import create_history, import_workflow, mark_phase, upload_and_build_data_input, write_jobs_metrics
+
+
+
+################################################################################
+# COMMAND LINE OPTIONS
+
+def cli_options():
+    parser = argparse.ArgumentParser(description='Benchmark the harness overhead against a local fake Galaxy')
+    parser.add_argument('--wf-path', default='../workflows/test_workflow.ga', dest='wf_path', help='Workflow path')
+    parser.add_argument('-i', dest='wf_inputs_path', default='./input_files.json', help='JSON file containing input files URLs')
+    parser.add_argument('--runs', default=3, type=int, dest='runs', help='Number of workflow runs')
+    parser.add_argument('--config', default=None, dest='config', help='JSON file with the simulated times of the fake Galaxy')
+    parser.add_argument('--upload-workers', default=None, type=int, dest='upload_workers', help='Maximum number of concurrent uploads (default: all files at once)')
+    parser.add_argument('--metrics-workers', default=8, type=int, dest='metrics_workers', help='Maximum number of jobs whose metrics are fetched concurrently')
+    parser.add_argument('--poll-interval', default=1, type=float, dest='poll_interval', help='Seconds between two checks of the installed repositories')
+    parser.add_argument('--skip-install', default=False, dest='skip_install', action='store_true', help='If set, the tool installation is not benchmarked')
+    parser.add_argument('-o', '--output', default=None, dest='output_file', help='Output JSON file with the results')
+    return parser.parse_args()
+
+
+
+################################################################################
+# BENCHMARKS
+
+def last_job_end(galaxy, history_id, upload):
+    """End time of the last upload (or workflow) job of a history of the fake Galaxy
+
+    :param galaxy: State of the fake Galaxy
+    :type galaxy: FakeGalaxy
+    :param history_id: History id
+    :type history_id: str
+    :param upload: Whether to consider the upload jobs or the workflow jobs
+    :type upload: bool
+    :return: Epoch of the last job end
+    :rtype: float
+    """
+    with galaxy.lock:
+        return max(job['end'] for job in galaxy.jobs.values()
+                   if job['history_id'] == history_id and (job['tool_id'] == 'upload1') == upload)
+
+
+def bench_run(server, wf_path, wf_inputs_path, output_dir, index, upload_workers=None, metrics_workers=8):
+    """Run the workflow once as run_workflow.py does, without disk metrics, and measure the harness overhead
+
+    :param server: Fake Galaxy server, as returned by fake_galaxy.serve
+    :type server: ThreadingHTTPServer
+    :param wf_path: Workflow path
+    :type wf_path: str
+    :param wf_inputs_path: JSON file containing input files URLs
+    :type wf_inputs_path: str
+    :param output_dir: Directory in which the jobs metrics are written
+    :type output_dir: str
+    :param index: Run number
+    :type index: int
+    :param upload_workers: Maximum number of concurrent uploads, defaults to None (all files at once)
+    :type upload_workers: int, optional
+    :param metrics_workers: Maximum number of jobs whose metrics are fetched concurrently, defaults to 8
+    :type metrics_workers: int, optional
+    :return: Elapsed time, API calls by phase and latencies of the run
+    :rtype: dict
+    """
+    galaxy_instance = bioblend.galaxy.GalaxyInstance(url=server.url, key='fake')
+    api_stats = instrument(galaxy_instance)
+    start = time.time()
+
+    history_id = create_history(galaxy_instance, f'bench-{index}')
+    mark_phase('import', api_stats=api_stats)
+    workflow_id, _ = import_workflow(galaxy_instance, wf_path)
+
+    mark_phase('upload', api_stats=api_stats)
+    workflow_data = upload_and_build_data_input(wf_inputs_path, galaxy_instance, history_id, workflow_id, upload_workers)
+    uploaded = time.time()
+
+    mark_phase('wf', api_stats=api_stats)
+    invocation_id = galaxy_instance.workflows.invoke_workflow(workflow_id, workflow_data, history_id=history_id)['id']
+    bioblend.galaxy.invocations.InvocationClient(galaxy_instance).wait_for_invocation(invocation_id)
+
+    mark_phase('wf_metrics', api_stats=api_stats)
+    write_jobs_metrics(galaxy_instance, history_id, f'{output_dir}/run{index}/wf_jobs_metrics.json', invocation_id, metrics_workers)
+    written = time.time()
+
+    summary = api_stats.summary()
+    return {
+        'run':index,
+        'elapsed_seconds':written - start,
+        'api_calls':summary['count'],
+        **{f'{phase}_api_calls': phase_summary['count'] for phase, phase_summary in summary['phases'].items()},
+        'upload_polling_latency':uploaded - last_job_end(server.galaxy, history_id, upload=True),
+        'metrics_latency':written - last_job_end(server.galaxy, history_id, upload=False)
+    }
+
+
+def bench_install(server, wf_path, poll_interval=1):
+    """Install the workflow tools sequentially and in parallel and measure time and API calls
+
+    :param server: Fake Galaxy server, as returned by fake_galaxy.serve
+    :type server: ThreadingHTTPServer
+    :param wf_path: Workflow path
+    :type wf_path: str
+    :param poll_interval: Seconds between two checks of the installed repositories, defaults to 1
+    :type poll_interval: float, optional
+    :return: One result per installation mode
+    :rtype: list of dict
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode, install in [('sequential', install_tools), ('parallel', install_tools_parallel)]:
+            # Every mode starts from an empty tool shed repositories list
+            with server.galaxy.lock:
+                server.galaxy.repositories.clear()
+            api_stats_file = f'{tmp_dir}/{mode}.json'
+            start = time.time()
+            install(server.url, 'fake', wf_path, poll_interval, api_stats_file=api_stats_file)
+            elapsed = time.time() - start
+            with open(api_stats_file, 'r') as f:
+                api_calls = json.load(f)['count']
+            results.append({'mode':mode, 'elapsed_seconds':elapsed, 'api_calls':api_calls})
+    return results
+
+
+
+if __name__=='__main__':
+
+    options = cli_options()
+
+    config = None
+    if options.config:
+        with open(options.config, 'r') as f:
+            config = json.load(f)
+    server = serve(config=config)
+    print(f'Fake Galaxy listening on {server.url}')
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        runs = [bench_run(server, options.wf_path, options.wf_inputs_path, output_dir, i + 1, options.upload_workers,
+                          options.metrics_workers) for i in range(options.runs)]
+    runs_df = pd.DataFrame(runs)
+    print(runs_df.to_string(index=False, float_format='%.2f'))
+    print(f"Mean: {runs_df['api_calls'].mean():.1f} API calls per run, upload polling latency {runs_df['upload_polling_latency'].mean():.2f}s, "
+          f"metrics latency {runs_df['metrics_latency'].mean():.2f}s")
+
+    install_results = []
+    if not options.skip_install:
+        install_results = bench_install(server, options.wf_path, options.poll_interval)
+        print(pd.DataFrame(install_results).to_string(index=False, float_format='%.2f'))
+
+    server.shutdown()
+
+    if options.output_file:
+        with open(options.output_file, 'w', encoding='utf-8') as f:
+            json.dump({'config':server.galaxy.config, 'runs':runs, 'install':install_results}, f, ensure_ascii=False, indent=4)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the dstat ingestion in plots.py.
+A synthetic metrics tree with the same layout produced by wf_disk_test.sh (metrics and metrics_encrypted directories,
+each with one metricsN/dstat_outN sub-directory per iteration) is written to a temporary directory, then the time
+needed to parse and filter all the dstat outputs is measured with the row by row implementation previously used by
+'filter_time' and with the current vectorized one.
+"""
+
+# Dependencies
+import argparse
+import json
+import os
+import re
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from plots import filter_time
+
+
+
+################################################################################
+# COMMAND LINE OPTIONS
+
+def cli_options():
+    parser = argparse.ArgumentParser(description='Benchmark dstat parsing and time filtering of plots.py')
+    parser.add_argument('--iterations', default=50, type=int, dest='iterations', help='Number of iterations for each VM')
+    parser.add_argument('--hours', default=1, type=float, dest='hours', help='Hours of 1 Hz dstat samples for each iteration')
+    parser.add_argument('--repeat', default=3, type=int, dest='repeat', help='Number of timed repetitions, the best one is reported')
+    return parser.parse_args()
+
+
+
+################################################################################
+# SYNTHETIC DATA
+
+DSTAT_HEADER = '''"Dstat 0.7.4 CSV output"
+"Author:","Dag Wieers <dag@wieers.com>",,,,"URL:","http://dag.wieers.com/home-made/dstat/"
+"Host:","galaxy",,,,"User:","centos"
+"Cmdline:","dstat --disk-tps -d -t --noheaders -o dstat_out_wf.csv -D vdb1",,,,"Date:","01 Jan 2022 00:00:00 UTC"
+
+"dsk/vdb1","","dsk/vdb1","","system"
+"reads","writs","read","writ","time"
+'''
+
+
+def write_iteration(directory, index, start, samples, rng):
+    """Write the metrics of a synthetic iteration: a dstat output and the workflow jobs metrics
+
+    :param directory: Directory of the iteration (e.g. metrics/metrics1)
+    :type directory: str
+    :param index: Iteration number
+    :type index: int
+    :param start: Time of the first dstat sample
+    :type start: datetime
+    :param samples: Number of dstat samples, one per second
+    :type samples: int
+    :param rng: Random number generator
+    :type rng: np.random.Generator
+    """
+    os.makedirs(f'{directory}/dstat_out{index}', exist_ok=True)
+    times = [(start + timedelta(seconds=s)).strftime('%d-%m %H:%M:%S') for s in range(samples)]
+    values = rng.exponential(scale=[5, 20, 1e6, 5e6], size=(samples, 4))
+    df = pd.DataFrame(values)
+    df['time'] = times
+    with open(f'{directory}/dstat_out{index}/dstat_out_wf.csv', 'w') as f:
+        f.write(DSTAT_HEADER)
+        df.to_csv(f, header=False, index=False, float_format='%.3f')
+
+    # The workflow runs between 10% and 90% of the recorded time
+    jobs_metrics = {
+        f'job{index}': {
+            'tool_id':'bwa_mem',
+            'runtime_value':'',
+            'runtime_raw_value':str(0.8 * samples),
+            'start':(start + timedelta(seconds=samples // 10)).strftime('%Y-%m-%d %H:%M:%S'),
+            'end':(start + timedelta(seconds=9 * samples // 10)).strftime('%Y-%m-%d %H:%M:%S')
+        }
+    }
+    with open(f'{directory}/wf_jobs_metrics.json', 'w') as f:
+        json.dump(jobs_metrics, f, indent=4)
+
+
+def write_tree(basedir, iterations, hours):
+    """Write a synthetic metrics tree with 'iterations' runs for each VM in the current year, the last one crossing
+    New Year
+
+    :param basedir: Main directory of the tree
+    :type basedir: str
+    :param iterations: Number of iterations for each VM
+    :type iterations: int
+    :param hours: Hours of 1 Hz samples for each iteration
+    :type hours: float
+    """
+    rng = np.random.default_rng(0)
+    samples = int(hours * 3600)
+    for vm in ['metrics', 'metrics_encrypted']:
+        for i in range(1, iterations + 1):
+            start = datetime(datetime.now().year, 12, 31, 23, 59, 59) - timedelta(seconds=samples // 2 + (iterations - i) * samples)
+            write_iteration(f'{basedir}/{vm}/metrics{i}', i, start, samples, rng)
+
+
+
+################################################################################
+# BENCHMARK
+
+def legacy_filter_time(df, metrics_path):
+    """Row by row implementation of 'filter_time', kept as a reference for the benchmark"""
+    df.columns = ['read_tps', 'write_tps', 'rMB/s', 'wMB/s', 'time']
+    df.loc[:,('time')] = df['time'].apply(lambda x: datetime.strptime(x,'%d-%m %H:%M:%S').replace(year=datetime.now().year))
+    with open(metrics_path,'r') as f:
+        jobs_info = json.load(f)
+    start_times = []
+    end_times = []
+    for k,v in jobs_info.items():
+        start_times.append(datetime.strptime(v['start'], '%Y-%m-%d %H:%M:%S'))
+        end_times.append(datetime.strptime(v['end'], '%Y-%m-%d %H:%M:%S'))
+    start_time = min(start_times)
+    end_time = max(end_times)
+    df = df[(df['time'] <= end_time) & (df['time'] >= start_time)].copy(deep=True)
+    df.loc[:,('time')] = list(range(0,len(df)))
+    return df
+
+
+def ingest(basedir, filter_function):
+    """Parse and filter all the dstat outputs in the tree, returning the number of samples kept"""
+    kept = 0
+    for vm in ['metrics', 'metrics_encrypted']:
+        for directory in os.listdir(f'{basedir}/{vm}'):
+            index = re.findall(r'\d+', directory)[0]
+            directory = f'{basedir}/{vm}/{directory}'
+            dstat_df = pd.read_csv(f'{directory}/dstat_out{index}/dstat_out_wf.csv', header=[0,1], skiprows=5)
+            kept += len(filter_function(dstat_df, f'{directory}/wf_jobs_metrics.json'))
+    return kept
+
+
+def best_time(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+
+if __name__=='__main__':
+
+    options = cli_options()
+
+    with tempfile.TemporaryDirectory() as basedir:
+        write_tree(basedir, options.iterations, options.hours)
+
+        legacy_time, legacy_kept = best_time(lambda: ingest(basedir, legacy_filter_time), options.repeat)
+        vectorized_time, vectorized_kept = best_time(lambda: ingest(basedir, filter_time), options.repeat)
+
+    print(f'{2 * options.iterations} iterations, {options.hours} h of 1 Hz samples each')
+    print(f'Row by row: {legacy_time:.2f}s ({legacy_kept} samples kept)')
+    print(f'Vectorized: {vectorized_time:.2f}s ({vectorized_kept} samples kept)')
+    print(f'Speedup: {legacy_time / vectorized_time:.1f}x')
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Benchmark campaign runner, replacing the serial loop of wf_disk_test.sh.
+The workflow is run several times on one or more Galaxy endpoints (e.g. the VM with and the VM without disk
+encryption) with run_workflow.py. At each iteration all the endpoints run the workflow at the same time, so their
+timelines stay aligned. Finished iterations are recorded in a checkpoint file, so that an interrupted campaign can be
+resumed. Metrics are written with the metricsN/dstat_outN layout expected by plots.py.
+
+The campaign is described by a JSON file, for example:
+
+{
+    "workflow": "../workflows/bowtie2_mapping.ga",
+    "inputs": "./input_files.json",
+    "iterations": 50,
+    "endpoints": {
+        "encrypted": {
+            "endpoint": "http://encrypted_galaxy_instance_url",
+            "api_key": "galaxy_api_key",
+            "ssh_user": "galaxy_vm_ssh_user",
+            "ssh_key": "galaxy_vm_ssh_key",
+            "device": "vdb1",
+            "output_dir": "/path/to/metrics_data/metrics_encrypted"
+        },
+        "plain": {
+            ...
+            "output_dir": "/path/to/metrics_data/metrics"
+        }
+    },
+    "options": {"disk_sampler": "dstat", "upload_workers": 2}
+}
+
+where "options" are optional keyword arguments passed to run_galaxy_tools.
+"""
+
+# Dependencies
+import argparse
+import json
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from run_workflow import run_galaxy_tools
+
+
+
+################################################################################
+# COMMAND LINE OPTIONS
+
+def cli_options():
+    parser = argparse.ArgumentParser(description='Run a workflow benchmark campaign on several Galaxy endpoints')
+    parser.add_argument('-c', '--config', dest='config', help='JSON file describing the campaign')
+    parser.add_argument('--iterations', default=None, type=int, dest='iterations', help='Number of iterations, overrides the one in the campaign file')
+    parser.add_argument('--checkpoint', default='campaign_checkpoint.json', dest='checkpoint', help='File where finished iterations are recorded')
+    parser.add_argument('--log-dir', default='campaign_logs', dest='log_dir', help='Directory where the output of each iteration is written')
+    return parser.parse_args()
+
+
+
+################################################################################
+# CAMPAIGN
+
+def load_checkpoint(checkpoint_path):
+    """Load the finished iterations of each endpoint
+
+    :param checkpoint_path: Path of the checkpoint file
+    :type checkpoint_path: str
+    :return: Set of finished iterations for each endpoint name
+    :rtype: dict
+    """
+    if not os.path.exists(checkpoint_path):
+        return dict()
+    with open(checkpoint_path, 'r') as f:
+        return {name: set(iterations) for name, iterations in json.load(f).items()}
+
+
+def write_checkpoint(checkpoint_path, finished):
+    """Write the finished iterations of each endpoint, replacing the checkpoint file atomically
+
+    :param checkpoint_path: Path of the checkpoint file
+    :type checkpoint_path: str
+    :param finished: Set of finished iterations for each endpoint name
+    :type finished: dict
+    """
+    with open(f'{checkpoint_path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump({name: sorted(iterations) for name, iterations in finished.items()}, f, indent=4)
+    os.replace(f'{checkpoint_path}.tmp', checkpoint_path)
+
+
+@contextmanager
+def redirect_output(log):
+    """Redirect the standard output and error file descriptors of the process to a log file, so that the output of the
+    ssh, scp and dstat subprocesses started by the iteration is captured too, not only the Python writes
+
+    :param log: Open log file
+    :type log: file object
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    try:
+        yield
+    finally:
+        # Restore the descriptors, the worker process runs the next iterations too
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved_fd in zip((1, 2), saved):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+
+
+def run_iteration(endpoint, iteration, workflow, inputs, log_path, options=None):
+    """Run a single iteration of the workflow on an endpoint, writing its output to a log file
+
+    :param endpoint: Endpoint description (endpoint, api_key, ssh_user, ssh_key, device, output_dir)
+    :type endpoint: dict
+    :param iteration: Iteration number
+    :type iteration: int
+    :param workflow: Path to the workflow file
+    :type workflow: str
+    :param inputs: Path to the JSON file describing the input files
+    :type inputs: str
+    :param log_path: Path of the log file of the iteration
+    :type log_path: str
+    :param options: Other keyword arguments passed to run_galaxy_tools, defaults to None
+    :type options: dict, optional
+    """
+    with open(log_path, 'w') as log, redirect_output(log):
+        run_galaxy_tools(endpoint=endpoint['endpoint'],
+                         api_key=endpoint['api_key'],
+                         history_name=f'run{iteration}',
+                         wf_path=workflow,
+                         wf_inputs_path=inputs,
+                         clean_histories=True,
+                         log_disk_metrics=True,
+                         metrics_output_dir=f"{endpoint['output_dir']}/metrics{iteration}",
+                         dstat_output_dir=f"/home/{endpoint['ssh_user']}/dstat_out{iteration}",
+                         device=endpoint['device'],
+                         ssh_key=endpoint['ssh_key'],
+                         ssh_user=endpoint['ssh_user'],
+                         **(options or dict()))
+
+
+def run_campaign(config, checkpoint_path, log_dir, iterations=None):
+    """Run the campaign: at each iteration, the workflow is run at the same time on all the endpoints which did not
+    already finish that iteration.
+
+    :param config: Campaign description
+    :type config: dict
+    :param checkpoint_path: Path of the checkpoint file
+    :type checkpoint_path: str
+    :param log_dir: Directory where the output of each iteration is written
+    :type log_dir: str
+    :param iterations: Number of iterations, defaults to None (the one in the campaign description)
+    :type iterations: int, optional
+    :return: Failed iterations for each endpoint name
+    :rtype: dict
+    """
+    endpoints = config['endpoints']
+    iterations = iterations or config['iterations']
+    finished = load_checkpoint(checkpoint_path)
+    failed = {name: [] for name in endpoints}
+
+    for name in endpoints:
+        Path(f'{log_dir}/{name}').mkdir(parents=True, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=len(endpoints)) as executor:
+        for i in range(1, iterations + 1):
+            todo = [name for name in endpoints if i not in finished.get(name, set())]
+            if not todo:
+                continue
+
+            print(f'Iteration {i}: running wf on {", ".join(todo)}...', flush=True)
+            futures = {name: executor.submit(run_iteration, endpoints[name], i, config['workflow'], config['inputs'],
+                                             f'{log_dir}/{name}/run{i}.log', config.get('options'))
+                       for name in todo}
+
+            for name, future in futures.items():
+                try:
+                    future.result()
+                    finished.setdefault(name, set()).add(i)
+                except Exception:
+                    failed[name].append(i)
+                    print(f'Iteration {i} failed on {name}:\n{traceback.format_exc()}', flush=True)
+
+            # Record finished iterations, a new run of the campaign resumes from here
+            write_checkpoint(checkpoint_path, finished)
+            print(f'Iteration {i} terminated', flush=True)
+
+    return {name: iterations for name, iterations in failed.items() if iterations}
+
+
+
+if __name__=='__main__':
+
+    options = cli_options()
+
+    with open(options.config, 'r') as f:
+        config = json.load(f)
+
+    failed = run_campaign(config, options.checkpoint, options.log_dir, options.iterations)
+
+    for name, iterations in failed.items():
+        print(f'FAILED on {name}: iterations {", ".join(map(str, iterations))}')
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Round trip check of the diskstats.py recordings through the CSV files read by the analysis scripts.
+A synthetic recording at a high sample rate, with known counters, is converted to a dstat-like CSV file, which is then
+parsed as plots.py, io_attribution.py and DstatStream.split do. The check fails if the timestamps lose their sub-second
+resolution, are not the local times of the recording host (whose UTC offset differs from the one of this machine) or
+the rates do not match the counters.
+"""
+
+# Dependencies
+import argparse
+import os
+import struct
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+from plots import parse_dstat_time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import diskstats
+from dstat import DSTAT_HEADER_LINES, parse_sample_time
+
+
+
+################################################################################
+# COMMAND LINE OPTIONS
+
+def cli_options():
+    parser = argparse.ArgumentParser(description='Check the diskstats recording -> CSV -> parsed samples round trip')
+    parser.add_argument('-r', '--rate', default=50, type=float, dest='rate', help='Samples per second of the synthetic recording')
+    parser.add_argument('--samples', default=500, type=int, dest='samples', help='Number of samples of the synthetic recording')
+    parser.add_argument('--utc-offset', default=None, type=int, dest='utc_offset', help='UTC offset in seconds of the recording host (default: 5h30 more than this machine)')
+    return parser.parse_args()
+
+
+
+################################################################################
+# CHECKS
+
+def write_recording(output_file, rate, samples, wall_start, utc_offset):
+    """Write a synthetic recording, reading 8 sectors and writing 16 sectors (in 1 and 2 requests) per sample
+
+    :param output_file: Path of the binary file
+    :type output_file: str
+    :param rate: Samples per second
+    :type rate: float
+    :param samples: Number of samples
+    :type samples: int
+    :param wall_start: Epoch of the first sample
+    :type wall_start: float
+    :param utc_offset: UTC offset in seconds of the recording host
+    :type utc_offset: int
+    """
+    period_ns = int(1e9 / rate)
+    with open(output_file, 'wb') as f:
+        f.write(struct.pack(diskstats.HEADER_FORMAT, diskstats.MAGIC, diskstats.VERSION, 0, rate, b'vdb1', wall_start, 0, utc_offset))
+        for i in range(samples):
+            f.write(struct.pack(diskstats.DISK_RECORD_FORMAT, i * period_ns, i, 8 * i, 2 * i, 16 * i))
+
+
+def check_round_trip(rate, samples, utc_offset=None):
+    """Convert a synthetic recording to CSV and parse it back, checking times and rates
+
+    :param rate: Samples per second
+    :type rate: float
+    :param samples: Number of samples
+    :type samples: int
+    :param utc_offset: UTC offset in seconds of the recording host, defaults to None (5h30 more than this machine)
+    :type utc_offset: int, optional
+    """
+    wall_start = time.time()
+    if utc_offset is None:
+        utc_offset = int(datetime.now().astimezone().utcoffset().total_seconds()) + 19800
+    host_start = datetime.fromtimestamp(wall_start, timezone(timedelta(seconds=utc_offset))).replace(tzinfo=None)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_recording(f'{tmp_dir}/diskstats.bin', rate, samples, wall_start, utc_offset)
+        diskstats.write_dstat_csv(f'{tmp_dir}/diskstats.bin', f'{tmp_dir}/dstat_out.csv')
+
+        # As read by plots.py and io_attribution.py
+        dstat_df = pd.read_csv(f'{tmp_dir}/dstat_out.csv', header=[0,1], skiprows=5)
+        dstat_df = dstat_df.set_axis(['read_tps', 'write_tps', 'rMB/s', 'wMB/s', 'time'], axis=1)
+        times = parse_dstat_time(dstat_df['time'].to_numpy(), pd.Timestamp(host_start))
+
+        # As read by DstatStream.split
+        with open(f'{tmp_dir}/dstat_out.csv', 'r') as f:
+            lines = f.readlines()[DSTAT_HEADER_LINES:]
+        split_times = [parse_sample_time(line.rstrip().rsplit(',', 1)[-1].strip('"')) for line in lines]
+
+    assert len(dstat_df) == samples - 1, f'{len(dstat_df)} samples written instead of {samples - 1}'
+    assert not times.isna().any(), 'Unparsed timestamps'
+    first = host_start + timedelta(seconds=1 / rate)
+    assert abs((times[0] - pd.Timestamp(first)).total_seconds()) < 1e-3, f'First sample at {times[0]} instead of {first} (recording host time)'
+    intervals = np.diff(times.to_numpy()).astype('timedelta64[us]').astype(float) / 1e6
+    assert np.allclose(intervals, 1 / rate, atol=1e-3), f'Sample intervals between {intervals.min()}s and {intervals.max()}s instead of {1 / rate}s'
+    split_intervals = np.array([(b - a).total_seconds() for a, b in zip(split_times, split_times[1:])])
+    assert np.allclose(split_intervals, 1 / rate, atol=1e-3), 'Sample intervals of the split phases do not match the rate'
+    expected = {'read_tps':rate, 'write_tps':2 * rate, 'rMB/s':8 * diskstats.SECTOR_SIZE * rate, 'wMB/s':16 * diskstats.SECTOR_SIZE * rate}
+    for column, value in expected.items():
+        assert np.allclose(dstat_df[column], value, rtol=1e-3), f'{column} is not {value}'
+    print(f'{samples} samples at {rate} Hz: CSV round trip ok')
+
+
+
+if __name__=='__main__':
+
+    options = cli_options()
+    check_round_trip(options.rate, options.samples, options.utc_offset)
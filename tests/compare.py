@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Regression gate comparing a candidate benchmark campaign with a stored baseline campaign (e.g. the same workflow run
+before and after a Galaxy upgrade, a storage change or an encryption change).
+Each campaign is a directory with one metricsN sub-directory per iteration, as written by wf_disk_test.sh or
+campaign.py (e.g. metrics_data/metrics). The metrics compared are:
+1. The runtime of the workflow jobs of each tool and the time from the first workflow job start to the last end (from
+   wf_jobs_metrics.json), and the same for the upload jobs (from upload_jobs_metrics.json)
+2. The read and write speed averaged over each iteration (from the dstat output, as in plots.py)
+
+For each metric (and each tool for the job runtimes, so that jobs of different tools are never pooled in one sample) a
+one-sided Mann-Whitney U test checks whether the candidate is worse than the baseline (slower, or with lower
+read/write speed). A regression is reported when the test is significant and the median changes by more
+than the metric threshold. The script exits with status 1 if there is at least one regression.
+"""
+
+# Dependencies
+import argparse
+import json
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from plots import NoJobsError, get_metrics, get_time_window
+
+# Metrics compared: name -> True if higher values are worse
+METRICS = {
+    'upload_time':True,
+    'upload_job_runtime':True,
+    'wf_time':True,
+    'wf_job_runtime':True,
+    'rMB/s':False,
+    'wMB/s':False
+}
+
+
+
+################################################################################
+# COMMAND LINE OPTIONS
+
+def cli_options():
+    parser = argparse.ArgumentParser(description='Compare a candidate benchmark campaign with a baseline campaign')
+    parser.add_argument('--baseline', dest='baseline_dir', help='Baseline campaign directory, with metrics inside (e.g. metrics_data/metrics)')
+    parser.add_argument('--candidate', dest='candidate_dir', help='Candidate campaign directory, with metrics inside')
+    parser.add_argument('--threshold', default=0.05, type=float, dest='threshold', help='Relative change of the median above which a significant worsening is a regression')
+    parser.add_argument('--metric-threshold', default=[], action='append', dest='metric_thresholds', help='Threshold of a single metric, as <metric>=<threshold> (e.g. wf_time=0.1), can be repeated')
+    parser.add_argument('--alpha', default=0.05, type=float, dest='alpha', help='Significance level of the tests')
+    parser.add_argument('--cache-dir', default=None, dest='cache_dir', help='Directory of the preprocessed metrics cache (default: <campaign>/../.plots_cache)')
+    parser.add_argument('--no-cache', default=False, dest='no_cache', action='store_true', help='If set, metrics are always parsed again and not cached')
+    parser.add_argument('--workers', default=None, type=int, dest='workers', help='Number of processes used to parse the metrics (default: number of CPUs)')
+    parser.add_argument('-o', '--output', default=None, dest='output_file', help='Output JSON report')
+    return parser.parse_args()
+
+
+
+################################################################################
+# DATA PREPROCESSING FUNCTIONS
+
+def load_phase_times(basedir, jobs_metrics_file):
+    """Load the time from the first job start to the last end of each iteration and the runtime of every job, by tool
+
+    :param basedir: Campaign directory, with one metricsN sub-directory per iteration
+    :type basedir: str
+    :param jobs_metrics_file: Name of the jobs metrics file, e.g. 'wf_jobs_metrics.json'
+    :type jobs_metrics_file: str
+    :return: Time of each iteration (s), runtimes of the jobs of each tool id (s), and the iterations skipped with the reason
+    :rtype: tuple of np.ndarray, dict and dict
+    """
+    iteration_times = []
+    job_runtimes = dict()
+    skipped = dict()
+    for directory in os.listdir(basedir):
+        if not re.findall(r'\d+', directory):
+            continue
+        path = f'{basedir}/{directory}/{jobs_metrics_file}'
+        if not os.path.exists(path):
+            continue
+        try:
+            start_time, end_time = get_time_window(path)
+        except NoJobsError as e:
+            # E.g. no upload jobs when the inputs were copied from the input cache, or only failed jobs
+            skipped[directory] = str(e)
+            continue
+        iteration_times.append((end_time - start_time).total_seconds())
+        with open(path, 'r') as f:
+            for job in json.load(f).values():
+                if job.get('runtime_raw_value') is not None:
+                    job_runtimes.setdefault(job.get('tool_id'), []).append(float(job['runtime_raw_value']))
+
+    for directory, reason in sorted(skipped.items()):
+        print(f'{reason}: iteration skipped')
+    return np.array(iteration_times), {tool_id: np.array(runtimes) for tool_id, runtimes in job_runtimes.items()}, skipped
+
+
+def load_campaign(basedir, cache_dir=None, workers=None):
+    """Load the metrics compared of a campaign
+
+    :param basedir: Campaign directory, with one metricsN sub-directory per iteration
+    :type basedir: str
+    :param cache_dir: Directory of the preprocessed iterations cache, defaults to None (no cache)
+    :type cache_dir: str, optional
+    :param workers: Number of processes used to parse the iterations, defaults to None (number of CPUs)
+    :type workers: int, optional
+    :return: Values of each metric (by tool id for the job runtimes), and the iterations skipped for each metric under 'skipped'
+    :rtype: dict
+    """
+    campaign = dict()
+    skipped = dict()
+    for phase in ['upload', 'wf']:
+        campaign[f'{phase}_time'], campaign[f'{phase}_job_runtime'], phase_skipped = load_phase_times(basedir, f'{phase}_jobs_metrics.json')
+        skipped[f'{phase}_time'] = skipped[f'{phase}_job_runtime'] = sorted(phase_skipped)
+    campaign['skipped'] = skipped
+
+    # Averaged disk metrics, parsed and cached as in plots.py
+    _, _, avg_df = get_metrics(basedir, encrypted=os.path.basename(basedir), cache_dir=cache_dir, workers=workers, plain='none')
+    for column in ['rMB/s', 'wMB/s']:
+        campaign[column] = avg_df[column].to_numpy(dtype=np.float64) if len(avg_df) else np.array([])
+
+    return campaign
+
+
+
+################################################################################
+# STATISTICAL TESTS
+
+def compare_metric(baseline, candidate, higher_is_worse=True, threshold=0.05, alpha=0.05):
+    """Test whether a metric of the candidate campaign is worse than in the baseline campaign
+
+    :param baseline: Values of the metric in the baseline campaign
+    :type baseline: np.ndarray
+    :param candidate: Values of the metric in the candidate campaign
+    :type candidate: np.ndarray
+    :param higher_is_worse: Whether higher values are worse (times) or better (speeds), defaults to True
+    :type higher_is_worse: bool, optional
+    :param threshold: Relative change of the median above which a significant worsening is a regression, defaults to 0.05
+    :type threshold: float, optional
+    :param alpha: Significance level of the test, defaults to 0.05
+    :type alpha: float, optional
+    :return: Sample sizes, medians, relative change, p-value and outcome ('regression', 'ok' or 'insufficient data')
+    :rtype: dict
+    """
+    # Missing values never reach the test
+    baseline = baseline[np.isfinite(baseline)]
+    candidate = candidate[np.isfinite(candidate)]
+    result = {
+        'baseline_n':len(baseline),
+        'candidate_n':len(candidate),
+        'baseline_median':float(np.median(baseline)) if len(baseline) else None,
+        'candidate_median':float(np.median(candidate)) if len(candidate) else None,
+        'change':None,
+        'pvalue':None,
+        'threshold':threshold,
+        'outcome':'insufficient data'
+    }
+    if len(baseline) < 2 or len(candidate) < 2:
+        return result
+
+    if result['baseline_median'] != 0:
+        result['change'] = (result['candidate_median'] - result['baseline_median']) / abs(result['baseline_median'])
+    alternative = 'greater' if higher_is_worse else 'less'
+    result['pvalue'] = float(stats.mannwhitneyu(candidate, baseline, alternative=alternative).pvalue)
+
+    regression = False
+    if result['change'] is not None:
+        worse_change = result['change'] if higher_is_worse else -result['change']
+        regression = result['pvalue'] < alpha and worse_change > threshold
+    result['outcome'] = 'regression' if regression else 'ok'
+    return result
+
+
+def compare_campaigns(baseline, candidate, threshold=0.05, metric_thresholds=None, alpha=0.05):
+    """Compare every metric of two campaigns
+
+    :param baseline: Metrics of the baseline campaign, as returned by load_campaign
+    :type baseline: dict
+    :param candidate: Metrics of the candidate campaign, as returned by load_campaign
+    :type candidate: dict
+    :param threshold: Default relative change threshold, defaults to 0.05
+    :type threshold: float, optional
+    :param metric_thresholds: Thresholds of single metrics, overriding the default one, defaults to None
+    :type metric_thresholds: dict, optional
+    :param alpha: Significance level of the tests, defaults to 0.05
+    :type alpha: float, optional
+    :return: One row per metric, and per tool id for the job runtimes, with the test result
+    :rtype: pd.DataFrame
+    """
+    metric_thresholds = metric_thresholds or dict()
+    rows = []
+    for metric, higher_is_worse in METRICS.items():
+        # Job runtimes are only compared between jobs of the same tool
+        if isinstance(baseline[metric], dict):
+            tool_ids = sorted(baseline[metric].keys() | candidate[metric].keys(), key=str)
+            samples = [(tool_id, baseline[metric].get(tool_id, np.array([])), candidate[metric].get(tool_id, np.array([])))
+                       for tool_id in tool_ids]
+        else:
+            samples = [(None, baseline[metric], candidate[metric])]
+        for tool_id, baseline_values, candidate_values in samples:
+            result = compare_metric(baseline_values, candidate_values, higher_is_worse,
+                                    metric_thresholds.get(metric, threshold), alpha)
+            rows.append({'metric':metric, 'tool_id':tool_id, **result,
+                         'baseline_skipped':len(baseline.get('skipped', dict()).get(metric, [])),
+                         'candidate_skipped':len(candidate.get('skipped', dict()).get(metric, []))})
+    return pd.DataFrame(rows)
+
+
+
+if __name__=='__main__':
+
+    options = cli_options()
+
+    metric_thresholds = dict()
+    for metric_threshold in options.metric_thresholds:
+        metric, value = metric_threshold.split('=')
+        if metric not in METRICS:
+            sys.exit(f'Unknown metric {metric}, choose among: {", ".join(METRICS)}')
+        metric_thresholds[metric] = float(value)
+
+    campaigns = dict()
+    for name, basedir in [('baseline', options.baseline_dir), ('candidate', options.candidate_dir)]:
+        basedir = basedir.rstrip('/')
+        cache_dir = None if options.no_cache else (options.cache_dir or f'{os.path.dirname(basedir) or "."}/.plots_cache')
+        campaigns[name] = load_campaign(basedir, cache_dir, options.workers)
+
+    report = compare_campaigns(campaigns['baseline'], campaigns['candidate'], options.threshold, metric_thresholds, options.alpha)
+    print(report.to_string(index=False, float_format='%.4g'))
+
+    if options.output_file:
+        with open(options.output_file, 'w', encoding='utf-8') as f:
+            json.dump(report.replace({np.nan:None}).to_dict(orient='records'), f, ensure_ascii=False, indent=4)
+
+    regressions = [metric if tool_id is None else f'{metric} ({tool_id})'
+                   for metric, tool_id in report.loc[report['outcome'] == 'regression', ['metric', 'tool_id']].itertuples(index=False)]
+    if regressions:
+        print(f'REGRESSION: {", ".join(regressions)}')
+        sys.exit(1)
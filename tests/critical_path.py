@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Critical path and queue wait analysis of a workflow run, from the metrics written by run_workflow.py.
+The steps of the workflow DAG are read from the .ga file (their 'input_connections') and joined to the workflow jobs
+in wf_jobs_metrics.json through the invocation step order index. For each step the queue wait (job creation to job
+start) and the run time are computed, together with:
+1. The critical path: the chain of steps, each one waiting for the last finished of its parents, ending with the last
+   job of the run
+2. The parallelism achieved over time (number of jobs running at the same time)
+3. The idle slot-time: slots available on the Galaxy server during the run which were not used by any job
+
+The per-step table is written as a CSV file and a Gantt-style figure (queue wait and run time of each step, with the
+parallelism below) is saved next to the other plots.
+"""
+
+# Dependencies
+import argparse
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+
+
+################################################################################
+# COMMAND LINE OPTIONS
+
+def cli_options():
+    parser = argparse.ArgumentParser(description='Critical path and queue wait analysis of a workflow run')
+    parser.add_argument('-i', '--input-dir', dest='metrics_dir', help='Metrics directory of a run (e.g. metrics/metrics1)')
+    parser.add_argument('--wf-path', dest='wf_path', help='Workflow .ga file run')
+    parser.add_argument('--metrics-file', default='wf_jobs_metrics.json', dest='metrics_file', help='Name of the workflow jobs metrics file')
+    parser.add_argument('--slots', default=None, type=int, dest='slots', help='Job slots available on the Galaxy server, used to compute the idle slot-time')
+    parser.add_argument('--table', default=None, dest='table_file', help='Output CSV file with one row per step (default: <input-dir>/critical_path.csv)')
+    parser.add_argument('-o', '--output', dest='output_file', help='Output file of the Gantt figure')
+    return parser.parse_args()
+
+
+
+################################################################################
+# DATA PREPROCESSING FUNCTIONS
+
+def load_workflow_dag(wf_path):
+    """Read the step DAG of a workflow from its .ga file
+
+    :param wf_path: Path to the .ga workflow file
+    :type wf_path: str
+    :return: For each step order index, its label, type, tool id and the order indexes of its parent steps
+    :rtype: dict
+    """
+    with open(wf_path, 'r') as f:
+        workflow = json.load(f)
+
+    dag = dict()
+    for step in workflow['steps'].values():
+        parents = set()
+        for connection in step.get('input_connections', dict()).values():
+            # Multiple inputs connected to the same parameter are listed
+            connections = connection if isinstance(connection, list) else [connection]
+            parents.update(c['id'] for c in connections)
+        dag[step['id']] = {
+            'label':step.get('label') or step.get('name'),
+            'type':step['type'],
+            'tool_id':step.get('tool_id'),
+            'parents':parents
+        }
+    return dag
+
+
+def job_epoch(job, epoch_field, legacy_field):
+    """Time of a job as seconds since the epoch, from the typed schema or from the legacy 'start'/'end' values"""
+    if job.get(epoch_field) is not None:
+        return float(job[epoch_field])
+    return datetime.strptime(job[legacy_field], '%Y-%m-%d %H:%M:%S').timestamp()
+
+
+def load_step_jobs(metrics_path, dag):
+    """Join the jobs of a workflow run to the steps of the workflow DAG.
+    Jobs written without the invocation order index are matched to the tool steps with the same tool id, in order.
+
+    :param metrics_path: Path to the .json jobs metrics of the workflow
+    :type metrics_path: str
+    :param dag: Workflow DAG returned by load_workflow_dag
+    :type dag: dict
+    :return: One row per job with step, tool, slots and creation, start and end times (seconds since the epoch)
+    :rtype: pd.DataFrame
+    """
+    with open(metrics_path, 'r') as f:
+        jobs = json.load(f)
+
+    unmatched = sorted(i for i, step in dag.items() if step['type'] == 'tool')
+    rows = []
+    for job_id, job in jobs.items():
+        order_index = job.get('order_index')
+        if order_index is None:
+            order_index = next((i for i in unmatched if dag[i]['tool_id'] == job['tool_id']), None)
+        if order_index in unmatched:
+            unmatched.remove(order_index)
+
+        # Galaxy reports creation times in UTC
+        create_time = job.get('create_time')
+        rows.append({
+            'job_id':job_id,
+            'order_index':order_index,
+            'label':job.get('step_label') or (dag[order_index]['label'] if order_index in dag else None),
+            'tool_id':job['tool_id'],
+            'slots':job.get('galaxy_slots') or 1,
+            'create':pd.Timestamp(create_time, tz='UTC').timestamp() if create_time else np.nan,
+            'start':job_epoch(job, 'start_epoch', 'start'),
+            'end':job_epoch(job, 'end_epoch', 'end')
+        })
+
+    return pd.DataFrame(rows)
+
+
+
+################################################################################
+# ANALYSIS FUNCTIONS
+
+def critical_path(steps_df, dag):
+    """Follow the DAG back from the last finished job, moving each time to the parent step which finished last
+
+    :param steps_df: Jobs joined to the DAG, as returned by load_step_jobs
+    :type steps_df: pd.DataFrame
+    :param dag: Workflow DAG returned by load_workflow_dag
+    :type dag: dict
+    :return: Job ids on the critical path, from the first to the last
+    :rtype: list
+    """
+    # If a step ran more than one job (e.g. mapped over a collection), the last one to finish is kept
+    last_jobs = steps_df.dropna(subset=['order_index']).sort_values('end').groupby('order_index').tail(1)
+    step_jobs = last_jobs.set_index('order_index')
+
+    path = [steps_df.loc[steps_df['end'].idxmax(), 'job_id']]
+    order_index = steps_df.loc[steps_df['end'].idxmax(), 'order_index']
+    while order_index in dag:
+        parents = [p for p in dag[order_index]['parents'] if p in step_jobs.index]
+        if not parents:
+            break
+        order_index = max(parents, key=lambda p: step_jobs.loc[p, 'end'])
+        path.insert(0, step_jobs.loc[order_index, 'job_id'])
+    return path
+
+
+def parallelism(steps_df):
+    """Number of jobs running over time, changing at each job start and end
+
+    :param steps_df: Jobs joined to the DAG, as returned by load_step_jobs
+    :type steps_df: pd.DataFrame
+    :return: Times (seconds from the first job start) and number of jobs and slots in use from each time on
+    :rtype: pd.DataFrame
+    """
+    times = np.concatenate([steps_df['start'].to_numpy(), steps_df['end'].to_numpy()])
+    jobs = np.concatenate([np.ones(len(steps_df)), -np.ones(len(steps_df))])
+    slots = np.concatenate([steps_df['slots'].to_numpy(), -steps_df['slots'].to_numpy()])
+
+    # Ends are sorted before starts at the same time, so back to back jobs are not counted as parallel
+    order = np.lexsort((jobs, times))
+    timeline = pd.DataFrame({'time':times[order], 'jobs':np.cumsum(jobs[order]), 'slots':np.cumsum(slots[order])})
+    timeline['time'] -= timeline['time'].min()
+    return timeline.groupby('time', as_index=False).last()
+
+
+def analyze_run(steps_df, dag, slots=None):
+    """Compute queue wait and run time of each step, the critical path, the parallelism and the idle slot-time
+
+    :param steps_df: Jobs joined to the DAG, as returned by load_step_jobs
+    :type steps_df: pd.DataFrame
+    :param dag: Workflow DAG returned by load_workflow_dag
+    :type dag: dict
+    :param slots: Job slots available on the Galaxy server, defaults to None (idle slot-time not computed)
+    :type slots: int, optional
+    :return: Per-step table, parallelism timeline and run summary
+    :rtype: tuple
+    """
+    table = steps_df.sort_values('start').reset_index(drop=True)
+    table['queue_wait'] = table['start'] - table['create']
+    table['run_time'] = table['end'] - table['start']
+    table['critical'] = table['job_id'].isin(critical_path(table, dag))
+
+    timeline = parallelism(table)
+    first = np.nanmin([table['create'].min(), table['start'].min()])
+    makespan = table['end'].max() - first
+    busy_time = table['end'].max() - table['start'].min()
+    used_slot_time = (table['run_time'] * table['slots']).sum()
+
+    # Time weighted average of the running jobs between the first start and the last end
+    durations = np.diff(timeline['time'].to_numpy(), append=timeline['time'].iloc[-1])
+    summary = {
+        'jobs':len(table),
+        'makespan':makespan,
+        'critical_path_time':table.loc[table['critical'], 'run_time'].sum(),
+        'critical_path_queue_wait':table.loc[table['critical'], 'queue_wait'].sum(),
+        'total_queue_wait':table['queue_wait'].sum(),
+        'max_parallelism':int(timeline['jobs'].max()),
+        'mean_parallelism':float((timeline['jobs'].to_numpy() * durations).sum() / busy_time) if busy_time > 0 else 1.0,
+        'used_slot_time':used_slot_time,
+        'idle_slot_time':slots * makespan - used_slot_time if slots else np.nan
+    }
+
+    return table, timeline, summary
+
+
+
+################################################################################
+# PLOT FUNCTIONS
+
+def gantt(table, timeline, title='', figsize=(20, 12), title_fontsize=20):
+    """Gantt-style figure: queue wait and run time of each job, critical path highlighted, and parallelism below
+
+    :param table: Per-step table returned by analyze_run
+    :type table: pd.DataFrame
+    :param timeline: Parallelism timeline returned by analyze_run
+    :type timeline: pd.DataFrame
+    :param title: Title of the figure, defaults to ''
+    :type title: str, optional
+    :param figsize: Figure size, defaults to (20, 12)
+    :type figsize: tuple, optional
+    :param title_fontsize: Title font size, defaults to 20
+    :type title_fontsize: int, optional
+    :return: The figure
+    :rtype: plt.Figure
+    """
+    fig, (ax, ax_parallel) = plt.subplots(2, 1, figsize=figsize, sharex=True, gridspec_kw={'height_ratios':[3, 1]})
+    origin = table['start'].min()
+    labels = [f"{int(row.order_index) if pd.notna(row.order_index) else '-'}: {row.label or row.tool_id}"
+              for row in table.itertuples()]
+
+    queued = table['create'].notna()
+    ax.barh(table.index[queued], table.loc[queued, 'queue_wait'], left=table.loc[queued, 'create'] - origin,
+            color='lightgrey', label='Queue wait')
+    ax.barh(table.index, table['run_time'], left=table['start'] - origin,
+            color=np.where(table['critical'], 'tab:red', 'tab:blue'), label='Run time')
+    ax.set_yticks(table.index)
+    ax.set_yticklabels(labels)
+    ax.invert_yaxis()
+    ax.legend(handles=[plt.Rectangle((0, 0), 1, 1, color=c) for c in ['lightgrey', 'tab:blue', 'tab:red']],
+              labels=['Queue wait', 'Run time', 'Run time (critical path)'])
+    ax.set_title(title, fontsize=title_fontsize)
+
+    ax_parallel.step(timeline['time'], timeline['jobs'], where='post', label='Jobs')
+    ax_parallel.step(timeline['time'], timeline['slots'], where='post', label='Slots')
+    ax_parallel.set_xlabel('Time from first job start (s)')
+    ax_parallel.set_ylabel('Running')
+    ax_parallel.legend()
+
+    return fig
+
+
+
+if __name__=='__main__':
+
+    options = cli_options()
+
+    dag = load_workflow_dag(options.wf_path)
+    steps_df = load_step_jobs(f'{options.metrics_dir}/{options.metrics_file}', dag)
+    table, timeline, summary = analyze_run(steps_df, dag, options.slots)
+
+    # Write the per-step table
+    table_file = options.table_file or f'{options.metrics_dir}/critical_path.csv'
+    columns = ['job_id', 'order_index', 'label', 'tool_id', 'slots', 'queue_wait', 'run_time', 'critical']
+    table[columns].to_csv(table_file, index=False)
+    print(table[columns].to_string(index=False, float_format='%.1f'))
+    print()
+    for key, value in summary.items():
+        print(f'{key}: {value:.1f}' if isinstance(value, float) else f'{key}: {value}')
+
+    if options.output_file:
+        fig = gantt(table, timeline, title=os.path.basename(options.wf_path))
+        fig.savefig(options.output_file, bbox_inches='tight')
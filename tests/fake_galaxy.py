@@ -0,0 +1,626 @@
+#!/usr/bin/env python3
+"""
+Local stand-in of the Galaxy API endpoints used by the harness, so that run_workflow.py, install_tools_from_wf.py and
+the other scripts can be exercised without a Galaxy VM, SSH access or internet URLs. It only depends on the Python
+standard library.
+
+Histories, datasets, uploads (tools, tools/fetch and the tus resumable upload endpoint), data libraries, workflow
+import and invocation, invocations, jobs and their metrics, the disk usage of the user and tool shed repositories are
+kept in memory. Nothing is downloaded or run: every job has simulated, deterministic times computed when it is
+created, and its state (and the state of its output datasets) follows the clock. Jobs wait 'queue_seconds' after they
+are ready (inputs available) and for a free slot among 'slots', then run for the time set for their tool. The times
+are configured with a JSON file, for example:
+
+{
+    "upload_seconds": 1,
+    "link_seconds": 0.2,
+    "queue_seconds": 0.5,
+    "tool_seconds": {"default": 2, "fastqc": 5, "bwa": 20},
+    "slots": 4,
+    "invocation_delay": 1,
+    "install_seconds": 3,
+    "dataset_bytes": 1048576,
+    "latency": 0.01
+}
+
+where "link_seconds" is the time taken to link a file of the Galaxy host into a data library, the keys of
+"tool_seconds" are matched against the tool ids, "dataset_bytes" is the size of every dataset and "latency" is added to
+every response. As in Galaxy, purged datasets no longer count in the history size and the user disk usage.
+
+Run the server, then point the scripts to it:
+
+    $ ./fake_galaxy.py --port 8080 --config fake_galaxy.json
+    $ ../run_workflow.py --endpoint http://localhost:8080 -i ./input_files.json --wf-path ../workflows/bwa_quality_and_mapping.ga
+"""
+
+# Dependencies
+import argparse
+import heapq
+import itertools
+import json
+import re
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+DEFAULT_CONFIG = {
+    'upload_seconds':1.0,
+    'link_seconds':0.2,
+    'queue_seconds':0.5,
+    'tool_seconds':{'default':2.0},
+    'slots':4,
+    'invocation_delay':1.0,
+    'install_seconds':3.0,
+    'dataset_bytes':1048576,
+    'latency':0.0
+}
+
+# Response without body of the resumable upload (tus) endpoints
+TusResponse = namedtuple('TusResponse', ['status', 'headers'])
+
+
+
+################################################################################
+# COMMAND LINE OPTIONS
+
+def cli_options():
+    parser = argparse.ArgumentParser(description='Local stand-in of the Galaxy API used by the harness')
+    parser.add_argument('--host', default='localhost', dest='host', help='Address to listen on')
+    parser.add_argument('--port', default=8080, type=int, dest='port', help='Port to listen on')
+    parser.add_argument('--config', default=None, dest='config', help='JSON file with the simulated times')
+    return parser.parse_args()
+
+
+
+################################################################################
+# SIMULATED GALAXY
+
+class FakeGalaxy:
+    """In-memory state of the fake Galaxy server. Every method is called with the lock held."""
+
+    def __init__(self, config=None):
+        self.config = {**DEFAULT_CONFIG, **(config or dict())}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.histories = dict()
+        self.datasets = dict()
+        self.jobs = dict()
+        self.workflows = dict()
+        self.invocations = dict()
+        self.repositories = dict()
+        self.libraries = dict()
+        self.library_datasets = dict()
+        # Length and received bytes of the resumable uploads
+        self.tus_uploads = dict()
+        # End times of the jobs holding each slot
+        self.slots = [0.0] * self.config['slots']
+        self.requests = 0
+
+    def new_id(self):
+        return f'{next(self.ids):016x}'
+
+    # Jobs
+
+    def tool_seconds(self, tool_id):
+        for key, seconds in self.config['tool_seconds'].items():
+            if key != 'default' and key in tool_id:
+                return seconds
+        return self.config['tool_seconds'].get('default', DEFAULT_CONFIG['tool_seconds']['default'])
+
+    def schedule_job(self, tool_id, history_id, create, ready, seconds):
+        # The job takes the first slot free after it is ready and queued
+        start = max(ready + self.config['queue_seconds'], heapq.heappop(self.slots))
+        end = start + seconds
+        heapq.heappush(self.slots, end)
+        job = {'id':self.new_id(), 'tool_id':tool_id, 'history_id':history_id, 'create':create, 'start':start, 'end':end,
+               'outputs':[]}
+        self.jobs[job['id']] = job
+        return job
+
+    def job_state(self, job, now):
+        if now < job['create']:
+            return 'new'
+        if now < job['start']:
+            return 'queued'
+        if now < job['end']:
+            return 'running'
+        return 'ok'
+
+    def show_job(self, job, now):
+        return {
+            'id':job['id'],
+            'tool_id':job['tool_id'],
+            'history_id':job['history_id'],
+            'state':self.job_state(job, now),
+            'create_time':datetime.utcfromtimestamp(job['create']).isoformat(),
+            'update_time':datetime.utcfromtimestamp(min(now, job['end'])).isoformat(),
+            'model_class':'Job'
+        }
+
+    def job_metrics(self, job):
+        runtime = job['end'] - job['start']
+        metric = lambda name, title, value, raw_value: {'plugin':'core', 'name':name, 'title':title, 'value':value,
+                                                        'raw_value':raw_value}
+        return [
+            metric('galaxy_slots', 'Cores Allocated', '1', '1'),
+            metric('start_epoch', 'Job Start Time', datetime.fromtimestamp(job['start']).strftime('%Y-%m-%d %H:%M:%S'),
+                   f"{job['start']:.7f}"),
+            metric('end_epoch', 'Job End Time', datetime.fromtimestamp(job['end']).strftime('%Y-%m-%d %H:%M:%S'),
+                   f"{job['end']:.7f}"),
+            metric('runtime_seconds', 'Job Runtime (Wall Clock)', f'{round(runtime)} seconds', f'{runtime:.7f}')
+        ]
+
+    # Datasets
+
+    def new_dataset(self, history_id, name, job, extension='data'):
+        # Copies of the dataset share its file, identified by file_id
+        dataset_id = self.new_id()
+        dataset = {'id':dataset_id, 'history_id':history_id, 'name':name, 'job_id':job['id'], 'extension':extension,
+                   'tags':[], 'deleted':False, 'visible':True, 'purged':None, 'file_id':dataset_id}
+        self.datasets[dataset['id']] = dataset
+        self.histories[history_id]['datasets'].append(dataset['id'])
+        job['outputs'].append(dataset['id'])
+        return dataset
+
+    def show_dataset(self, dataset, now):
+        return {
+            'id':dataset['id'],
+            'history_id':dataset['history_id'],
+            'name':dataset['name'],
+            'state':self.job_state(self.jobs[dataset['job_id']], now),
+            'extension':dataset['extension'],
+            'file_ext':dataset['extension'],
+            'tags':list(dataset['tags']),
+            'deleted':dataset['deleted'],
+            'purged':dataset['purged'] is not None,
+            'visible':dataset['visible'],
+            'file_size':self.config['dataset_bytes'],
+            'history_content_type':'dataset',
+            'model_class':'HistoryDatasetAssociation'
+        }
+
+    def upload(self, history_id, files, now):
+        # A single upload job per request, as Galaxy does, with one output for each file
+        job = self.schedule_job('upload1', history_id, now, now, self.config['upload_seconds'] * max(len(files), 1))
+        outputs = [self.show_dataset(self.new_dataset(history_id, name, job, extension), now) for name, extension in files]
+        return {'outputs':outputs, 'jobs':[self.show_job(job, now)]}
+
+    # Data libraries
+
+    def link_files(self, library, paths, extension, now):
+        # Files of the Galaxy host are linked, not copied, by a single job
+        job = self.schedule_job('upload1', None, now, now, self.config['link_seconds'])
+        datasets = list()
+        for path in paths:
+            dataset = {'id':self.new_id(), 'library_id':library['id'], 'name':path.rstrip('/').split('/')[-1],
+                       'file_name':path, 'job_id':job['id'], 'extension':extension, 'file_id':path}
+            self.library_datasets[dataset['id']] = dataset
+            library['datasets'].append(dataset['id'])
+            datasets.append({'id':dataset['id'], 'name':dataset['name'],
+                             'url':f"/api/libraries/{library['id']}/contents/{dataset['id']}"})
+        return datasets
+
+    def show_library_dataset(self, dataset, now):
+        return {'id':dataset['id'], 'name':dataset['name'], 'file_name':dataset['file_name'],
+                'state':self.job_state(self.jobs[dataset['job_id']], now), 'file_ext':dataset['extension'],
+                'file_size':self.config['dataset_bytes'], 'model_class':'LibraryDataset'}
+
+    # Histories
+
+    def show_history(self, history, now):
+        # The size counts each file of the datasets not purged once
+        state_ids = dict()
+        files = set()
+        for dataset_id in history['datasets']:
+            dataset = self.datasets[dataset_id]
+            if not dataset['deleted']:
+                state_ids.setdefault(self.show_dataset(dataset, now)['state'], []).append(dataset_id)
+            if dataset['purged'] is None:
+                files.add(dataset['file_id'])
+        size = len(files) * self.config['dataset_bytes']
+        states = set(state_ids)
+        state = 'ok' if states <= {'ok'} else 'running' if 'running' in states else 'queued'
+        return {'id':history['id'], 'name':history['name'], 'deleted':history['deleted'], 'purged':history['purged'],
+                'tags':list(history['tags']), 'size':size, 'state':state, 'state_ids':state_ids, 'model_class':'History'}
+
+    def disk_usage(self, now):
+        # A file is no longer counted once no dataset of a history nor of a data library uses it
+        files = {dataset['file_id'] for dataset in self.datasets.values() if dataset['purged'] is None}
+        files |= {dataset['file_id'] for dataset in self.library_datasets.values()}
+        return len(files) * self.config['dataset_bytes']
+
+    def purge_history(self, history, now):
+        history['deleted'] = history['purged'] = True
+        for dataset_id in history['datasets']:
+            dataset = self.datasets[dataset_id]
+            dataset['deleted'] = True
+            if dataset['purged'] is None:
+                dataset['purged'] = now
+
+    # Workflows
+
+    def import_workflow(self, workflow_dict):
+        workflow = {'id':self.new_id(), 'name':workflow_dict.get('name', 'Unnamed workflow'),
+                    'tags':list(workflow_dict.get('tags', [])), 'steps':dict()}
+        for step in workflow_dict['steps'].values():
+            parents = set()
+            for connection in step.get('input_connections', dict()).values():
+                connections = connection if isinstance(connection, list) else [connection]
+                parents.update(c['id'] for c in connections)
+            workflow['steps'][step['id']] = {'type':step['type'], 'tool_id':step.get('tool_id'),
+                                             'label':step.get('label') or step.get('name'), 'parents':parents}
+        self.workflows[workflow['id']] = workflow
+        return self.show_workflow(workflow)
+
+    def show_workflow(self, workflow):
+        inputs = {str(i): {'label':step['label'], 'value':'', 'uuid':f'{workflow["id"]}-{i}'}
+                  for i, step in workflow['steps'].items() if step['type'] == 'data_input'}
+        steps = {str(i): {'id':i, 'type':step['type'], 'tool_id':step['tool_id'], 'annotation':None,
+                          'input_steps':{str(p): {'source_step':p, 'step_output':'output'} for p in step['parents']}}
+                 for i, step in workflow['steps'].items()}
+        return {'id':workflow['id'], 'name':workflow['name'], 'tags':list(workflow['tags']), 'inputs':inputs,
+                'steps':steps, 'deleted':False, 'model_class':'StoredWorkflow', 'url':f'/api/workflows/{workflow["id"]}'}
+
+    def invoke_workflow(self, workflow, history_id, inputs, now):
+        # Jobs are created when the invocation is scheduled, in an order compatible with the DAG
+        scheduled = now + self.config['invocation_delay']
+        invocation = {'id':self.new_id(), 'workflow_id':workflow['id'], 'history_id':history_id, 'create':now,
+                      'scheduled':scheduled, 'steps':[]}
+        ends = dict()
+        done = set()
+        while len(done) < len(workflow['steps']):
+            for i, step in sorted(workflow['steps'].items()):
+                if i in done or not step['parents'] <= done:
+                    continue
+                done.add(i)
+                if step['type'] == 'data_input':
+                    dataset = self.datasets[inputs.get(str(i), dict()).get('id')]
+                    ends[i] = self.jobs[dataset['job_id']]['end']
+                    invocation['steps'].append({'order_index':i, 'job_id':None, 'workflow_step_label':step['label']})
+                    continue
+                ready = max([scheduled] + [ends[p] for p in step['parents']])
+                job = self.schedule_job(step['tool_id'], history_id, scheduled, ready, self.tool_seconds(step['tool_id']))
+                self.new_dataset(history_id, f"{step['label'] or step['tool_id'].split('/')[-2]} output", job)
+                ends[i] = job['end']
+                invocation['steps'].append({'order_index':i, 'job_id':job['id'], 'workflow_step_label':step['label']})
+        self.invocations[invocation['id']] = invocation
+        return self.show_invocation(invocation, now)
+
+    def show_invocation(self, invocation, now):
+        state = 'scheduled' if now >= invocation['scheduled'] else 'new'
+        steps = [{'id':f"{invocation['id']}-{step['order_index']}", 'state':state, **step} for step in invocation['steps']]
+        return {'id':invocation['id'], 'workflow_id':invocation['workflow_id'], 'history_id':invocation['history_id'],
+                'state':state, 'steps':steps if state == 'scheduled' else [], 'model_class':'WorkflowInvocation',
+                'create_time':datetime.utcfromtimestamp(invocation['create']).isoformat(),
+                'update_time':datetime.utcfromtimestamp(max(invocation['create'], min(now, invocation['scheduled']))).isoformat()}
+
+    # Tool shed repositories
+
+    def install_repository(self, payload, now):
+        key = (payload['name'], payload['owner'], payload['changeset_revision'])
+        if key not in self.repositories:
+            self.repositories[key] = {'id':self.new_id(), 'name':key[0], 'owner':key[1], 'changeset_revision':key[2],
+                                      'tool_shed':urlparse(payload['tool_shed_url']).netloc,
+                                      'installed':now + self.config['install_seconds']}
+        return [self.show_repository(self.repositories[key], now)]
+
+    def show_repository(self, repository, now):
+        status = 'Installed' if now >= repository['installed'] else 'Installing tool dependencies'
+        return {**{k: v for k, v in repository.items() if k != 'installed'}, 'status':status, 'deleted':False,
+                'model_class':'ToolShedRepository'}
+
+
+
+################################################################################
+# HTTP API
+
+class FakeGalaxyHandler(BaseHTTPRequestHandler):
+
+    # Routes: method, path regular expression, handler method name
+    ROUTES = [
+        ('GET', r'/api/version', 'get_version'),
+        ('GET', r'/api/histories', 'get_histories'),
+        ('POST', r'/api/histories', 'create_history'),
+        ('GET', r'/api/histories/(\w+)', 'get_history'),
+        ('PUT', r'/api/histories/(\w+)', 'update_history'),
+        ('DELETE', r'/api/histories/(\w+)', 'delete_history'),
+        ('GET', r'/api/histories/(\w+)/contents', 'get_history_contents'),
+        ('POST', r'/api/histories/(\w+)/contents', 'copy_content'),
+        ('PUT', r'/api/histories/(\w+)/contents/(\w+)', 'update_dataset'),
+        ('GET', r'/api/datasets/(\w+)', 'get_dataset'),
+        ('POST', r'/api/tools', 'run_tool'),
+        ('POST', r'/api/tools/fetch', 'fetch'),
+        ('POST', r'/api/upload/resumable_upload', 'tus_create'),
+        ('HEAD', r'/api/upload/resumable_upload/(\w+)', 'tus_offset'),
+        ('PATCH', r'/api/upload/resumable_upload/(\w+)', 'tus_patch'),
+        ('GET', r'/api/libraries', 'get_libraries'),
+        ('POST', r'/api/libraries', 'create_library'),
+        ('GET', r'/api/libraries/(\w+)', 'get_library'),
+        ('GET', r'/api/libraries/(\w+)/contents', 'get_library_contents'),
+        ('POST', r'/api/libraries/(\w+)/contents', 'link_library_files'),
+        ('GET', r'/api/libraries/(\w+)/contents/(\w+)', 'get_library_dataset'),
+        ('GET', r'/api/workflows', 'get_workflows'),
+        ('POST', r'/api/workflows(?:/upload)?', 'import_workflow'),
+        ('GET', r'/api/workflows/(\w+)', 'get_workflow'),
+        ('POST', r'/api/workflows/(\w+)/invocations', 'invoke_workflow'),
+        ('GET', r'/api/(?:workflows/\w+/)?invocations/(\w+)', 'get_invocation'),
+        ('GET', r'/api/jobs', 'get_jobs'),
+        ('GET', r'/api/jobs/(\w+)', 'get_job'),
+        ('GET', r'/api/jobs/(\w+)/metrics', 'get_job_metrics'),
+        ('GET', r'/api/jobs/(\w+)/outputs', 'get_job_outputs'),
+        ('GET', r'/api/users/current', 'get_current_user'),
+        ('GET', r'/api/tool_shed_repositories', 'get_repositories'),
+        ('POST', r'/api/tool_shed_repositories/new/install_repository_revision', 'install_repository')
+    ]
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def do_PATCH(self):
+        self.dispatch('PATCH')
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        self.params = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.body = body
+        try:
+            self.payload = json.loads(body) if body else dict()
+        except ValueError:
+            self.payload = dict()
+
+        galaxy = self.server.galaxy
+        time.sleep(galaxy.config['latency'])
+        for route_method, pattern, handler in self.ROUTES:
+            match = re.fullmatch(pattern, url.path.rstrip('/'))
+            if route_method == method and match:
+                with galaxy.lock:
+                    galaxy.requests += 1
+                    try:
+                        status, response = 200, getattr(self, handler)(galaxy, time.time(), *match.groups())
+                    except KeyError as e:
+                        status, response = 404, {'err_msg':f'Object not found: {e}', 'err_code':404001}
+                break
+        else:
+            status, response = 404, {'err_msg':f'No route for {method} {url.path}', 'err_code':404001}
+
+        if isinstance(response, TusResponse):
+            self.send_response(response.status)
+            for header, value in {'Tus-Resumable':'1.0.0', 'Content-Length':'0', **response.headers}.items():
+                self.send_header(header, value)
+            self.end_headers()
+            return
+
+        data = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def param(self, name, default=None):
+        return self.params.get(name, [default])[0]
+
+    # Handlers, called with the galaxy lock held
+
+    def get_version(self, galaxy, now):
+        return {'version_major':'23.0', 'version_minor':'1'}
+
+    def get_histories(self, galaxy, now):
+        deleted = 'deleted' in self.params.get('q', []) and self.params.get('qv', ['False'])[0] == 'True'
+        return [galaxy.show_history(h, now) for h in galaxy.histories.values() if h['deleted'] == deleted]
+
+    def create_history(self, galaxy, now):
+        history = {'id':galaxy.new_id(), 'name':self.payload.get('name', 'Unnamed history'), 'deleted':False,
+                   'purged':False, 'tags':[], 'datasets':[]}
+        galaxy.histories[history['id']] = history
+        return galaxy.show_history(history, now)
+
+    def get_history(self, galaxy, now, history_id):
+        return galaxy.show_history(galaxy.histories[history_id], now)
+
+    def update_history(self, galaxy, now, history_id):
+        history = galaxy.histories[history_id]
+        for key in ('name', 'tags'):
+            if key in self.payload:
+                history[key] = self.payload[key]
+        return galaxy.show_history(history, now)
+
+    def delete_history(self, galaxy, now, history_id):
+        history = galaxy.histories[history_id]
+        if self.payload.get('purge') or self.param('purge') == 'True':
+            galaxy.purge_history(history, now)
+        else:
+            history['deleted'] = True
+        return galaxy.show_history(history, now)
+
+    def get_history_contents(self, galaxy, now, history_id):
+        datasets = [galaxy.show_dataset(galaxy.datasets[d], now) for d in galaxy.histories[history_id]['datasets']]
+        if self.param('deleted') is not None:
+            datasets = [d for d in datasets if d['deleted'] == (self.param('deleted') == 'True')]
+        if self.param('visible') is not None:
+            datasets = [d for d in datasets if d['visible'] == (self.param('visible') == 'True')]
+        return datasets
+
+    def copy_content(self, galaxy, now, history_id):
+        # Datasets are copied from another history or imported from a data library, in both cases without their data
+        if self.payload.get('source') == 'library':
+            source = {**galaxy.library_datasets[self.payload['content']], 'deleted':False, 'visible':True}
+        else:
+            source = galaxy.datasets[self.payload['content']]
+        dataset = {**source, 'id':galaxy.new_id(), 'history_id':history_id, 'tags':[], 'deleted':False, 'purged':None}
+        galaxy.datasets[dataset['id']] = dataset
+        galaxy.histories[history_id]['datasets'].append(dataset['id'])
+        return galaxy.show_dataset(dataset, now)
+
+    def update_dataset(self, galaxy, now, history_id, dataset_id):
+        dataset = galaxy.datasets[dataset_id]
+        for key in ('tags', 'name', 'visible', 'deleted'):
+            if key in self.payload:
+                dataset[key] = self.payload[key]
+        return galaxy.show_dataset(dataset, now)
+
+    def get_dataset(self, galaxy, now, dataset_id):
+        return galaxy.show_dataset(galaxy.datasets[dataset_id], now)
+
+    def run_tool(self, galaxy, now):
+        # Only the upload tool is simulated
+        inputs = self.payload.get('inputs', dict())
+        inputs = json.loads(inputs) if isinstance(inputs, str) else inputs
+        name = inputs.get('files_0|NAME') or inputs.get('files_0|url_paste', 'upload').split('/')[-1]
+        return galaxy.upload(self.payload['history_id'], [(name, inputs.get('file_type', 'auto'))], now)
+
+    def fetch(self, galaxy, now):
+        files = [(element.get('name') or element.get('url', element.get('path', 'upload')).split('/')[-1], element.get('ext', 'auto'))
+                 for target in self.payload.get('targets', []) for element in target.get('elements', [])]
+        return galaxy.upload(self.payload['history_id'], files, now)
+
+    def tus_create(self, galaxy, now):
+        upload_id = galaxy.new_id()
+        galaxy.tus_uploads[upload_id] = {'length':int(self.headers['Upload-Length']), 'offset':0}
+        return TusResponse(201, {'Location':f'/api/upload/resumable_upload/{upload_id}'})
+
+    def tus_offset(self, galaxy, now, upload_id):
+        upload = galaxy.tus_uploads[upload_id]
+        return TusResponse(200, {'Upload-Offset':str(upload['offset']), 'Upload-Length':str(upload['length']),
+                                 'Cache-Control':'no-store'})
+
+    def tus_patch(self, galaxy, now, upload_id):
+        upload = galaxy.tus_uploads[upload_id]
+        if int(self.headers['Upload-Offset']) != upload['offset']:
+            return TusResponse(409, dict())
+        upload['offset'] += len(self.body)
+        return TusResponse(204, {'Upload-Offset':str(upload['offset'])})
+
+    def get_libraries(self, galaxy, now):
+        return [{'id':l['id'], 'name':l['name'], 'root_folder_id':l['root_folder_id'], 'deleted':False}
+                for l in galaxy.libraries.values()]
+
+    def create_library(self, galaxy, now):
+        library = {'id':galaxy.new_id(), 'name':self.payload['name'], 'root_folder_id':'F' + galaxy.new_id(), 'datasets':[]}
+        galaxy.libraries[library['id']] = library
+        return {'id':library['id'], 'name':library['name'], 'root_folder_id':library['root_folder_id'], 'deleted':False}
+
+    def get_library(self, galaxy, now, library_id):
+        library = galaxy.libraries[library_id]
+        return {'id':library['id'], 'name':library['name'], 'root_folder_id':library['root_folder_id'], 'deleted':False}
+
+    def get_library_contents(self, galaxy, now, library_id):
+        library = galaxy.libraries[library_id]
+        return [{'id':library['root_folder_id'], 'name':'/', 'type':'folder'}] + [
+            {'id':d, 'name':'/' + galaxy.library_datasets[d]['name'], 'type':'file'} for d in library['datasets']]
+
+    def link_library_files(self, galaxy, now, library_id):
+        paths = [path for path in self.payload.get('filesystem_paths', '').splitlines() if path.strip()]
+        return galaxy.link_files(galaxy.libraries[library_id], paths, self.payload.get('file_type', 'auto'), now)
+
+    def get_library_dataset(self, galaxy, now, library_id, dataset_id):
+        return galaxy.show_library_dataset(galaxy.library_datasets[dataset_id], now)
+
+    def get_workflows(self, galaxy, now):
+        return [{'id':w['id'], 'name':w['name'], 'tags':list(w['tags']), 'deleted':False, 'model_class':'StoredWorkflow'}
+                for w in galaxy.workflows.values()]
+
+    def import_workflow(self, galaxy, now):
+        return galaxy.import_workflow(self.payload['workflow'])
+
+    def get_workflow(self, galaxy, now, workflow_id):
+        return galaxy.show_workflow(galaxy.workflows[workflow_id])
+
+    def invoke_workflow(self, galaxy, now, workflow_id):
+        history = self.payload.get('history', '')
+        history_id = history[len('hist_id='):] if history.startswith('hist_id=') else self.payload['history_id']
+        return galaxy.invoke_workflow(galaxy.workflows[workflow_id], history_id, self.payload.get('inputs', dict()), now)
+
+    def get_invocation(self, galaxy, now, invocation_id):
+        return galaxy.show_invocation(galaxy.invocations[invocation_id], now)
+
+    def get_jobs(self, galaxy, now):
+        history_id = self.param('history_id')
+        invocation_id = self.param('invocation_id')
+        job_ids = None
+        if invocation_id is not None:
+            job_ids = {step['job_id'] for step in galaxy.invocations[invocation_id]['steps']}
+        return [galaxy.show_job(job, now) for job in galaxy.jobs.values()
+                if (history_id is None or job['history_id'] == history_id) and (job_ids is None or job['id'] in job_ids)]
+
+    def get_job(self, galaxy, now, job_id):
+        return galaxy.show_job(galaxy.jobs[job_id], now)
+
+    def get_job_metrics(self, galaxy, now, job_id):
+        return galaxy.job_metrics(galaxy.jobs[job_id])
+
+    def get_job_outputs(self, galaxy, now, job_id):
+        return [{'name':f'output{i}', 'dataset':{'id':dataset_id, 'src':'hda'}}
+                for i, dataset_id in enumerate(galaxy.jobs[job_id]['outputs'])]
+
+    def get_current_user(self, galaxy, now):
+        usage = galaxy.disk_usage(now)
+        return {'id':'0000000000000000', 'email':'admin@example.org', 'username':'admin', 'is_admin':True,
+                'total_disk_usage':usage, 'nice_total_disk_usage':f'{usage / 1e6:.1f} MB', 'model_class':'User'}
+
+    def get_repositories(self, galaxy, now):
+        return [galaxy.show_repository(repository, now) for repository in galaxy.repositories.values()]
+
+    def install_repository(self, galaxy, now):
+        return galaxy.install_repository(self.payload, now)
+
+
+def serve(host='localhost', port=0, config=None):
+    """Start the fake Galaxy server in a background thread
+
+    :param host: Address to listen on, defaults to 'localhost'
+    :type host: str, optional
+    :param port: Port to listen on, defaults to 0 (any free port)
+    :type port: int, optional
+    :param config: Simulated times, overriding DEFAULT_CONFIG, defaults to None
+    :type config: dict, optional
+    :return: The server, with the FakeGalaxy state in its 'galaxy' attribute and its URL in 'url'
+    :rtype: ThreadingHTTPServer
+    """
+    server = ThreadingHTTPServer((host, port), FakeGalaxyHandler)
+    server.daemon_threads = True
+    server.galaxy = FakeGalaxy(config)
+    server.url = f'http://{host}:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+
+if __name__=='__main__':
+
+    options = cli_options()
+
+    config = None
+    if options.config:
+        with open(options.config, 'r') as f:
+            config = json.load(f)
+
+    server = ThreadingHTTPServer((options.host, options.port), FakeGalaxyHandler)
+    server.galaxy = FakeGalaxy(config)
+    print(f'Fake Galaxy listening on http://{options.host}:{options.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
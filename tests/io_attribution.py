@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Attribution of the disk I/O recorded by dstat (or by the diskstats sampler) to the Galaxy jobs running at the time.
+For each iteration collected with run_workflow.py, the samples of the whole run are joined with the intervals of the
+upload and workflow jobs: job intervals are sorted and the samples running inside each of them are found with a
+binary search over the sample timestamps, so that the join scales to the millions of samples of a full campaign.
+
+For each job (and then for each tool) the following metrics are computed:
+1. Read and write MB transferred while the job was running, and the MB attributed to the job when the samples are
+   shared evenly between the jobs running at the same time
+2. Peak read and write speed
+3. Share of the job samples during which other jobs were running too
+"""
+
+# Dependencies
+import argparse
+import csv
+import itertools
+import os
+import re
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from plots import parse_dstat_time, GROUPS
+
+# Seconds between two dstat samples: run_workflow.py runs dstat with its default delay
+DSTAT_INTERVAL = 1
+
+
+
+################################################################################
+# COMMAND LINE OPTIONS
+
+def cli_options():
+    parser = argparse.ArgumentParser(description='Attribute disk I/O to the Galaxy jobs running at the time')
+    parser.add_argument('-i', '--input-dir', dest='basedir', help='Base directory containing metrics and metrics_encrypted directory, each with metrics inside')
+    parser.add_argument('--workers', default=None, type=int, dest='workers', help='Number of processes used to parse the metrics (default: number of CPUs)')
+    parser.add_argument('--jobs-output', default=None, dest='jobs_output_file', help='Output CSV file with one row per job')
+    parser.add_argument('-o', '--output', dest='output_file', help='Output CSV file with one row per tool')
+    return parser.parse_args()
+
+
+
+################################################################################
+# DATA PREPROCESSING FUNCTIONS
+
+def load_jobs(directory, jobs_metrics_files=('upload_jobs_metrics.json', 'wf_jobs_metrics.json')):
+    """Load the intervals of the jobs of an iteration
+
+    :param directory: Directory containing the metrics of the iteration (e.g. metrics/metrics1)
+    :type directory: str
+    :param jobs_metrics_files: Names of the jobs metrics files, defaults to ('upload_jobs_metrics.json', 'wf_jobs_metrics.json')
+    :type jobs_metrics_files: tuple of str, optional
+    :return: One row per job with job id, tool, phase, start and end time
+    :rtype: pd.DataFrame
+    """
+    rows = []
+    for jobs_metrics_file in jobs_metrics_files:
+        if not os.path.exists(f'{directory}/{jobs_metrics_file}'):
+            continue
+        with open(f'{directory}/{jobs_metrics_file}', 'r') as f:
+            jobs_info = json.load(f)
+        phase = jobs_metrics_file.split('_')[0]
+        rows += [{'job_id':k, 'tool_id':v['tool_id'], 'phase':phase, 'start':v['start'], 'end':v['end']}
+                 for k, v in jobs_info.items()]
+
+    jobs = pd.DataFrame(rows, columns=['job_id', 'tool_id', 'phase', 'start', 'end'])
+    jobs['start'] = pd.to_datetime(jobs['start'], format='%Y-%m-%d %H:%M:%S')
+    jobs['end'] = pd.to_datetime(jobs['end'], format='%Y-%m-%d %H:%M:%S')
+    # Short tool name, e.g. 'fastqc' for toolshed.g2.bx.psu.edu/repos/devteam/fastqc/fastqc/0.72+galaxy1
+    jobs['tool'] = jobs['tool_id'].map(lambda x: x.split('/')[-2] if '/' in x else x)
+    return jobs
+
+
+def read_dstat_header(path):
+    """Read the "key:","value" pairs of the header written by dstat or diskstats.py (e.g. 'Date', 'Rate')
+
+    :param path: Path of the dstat CSV file
+    :type path: str
+    :return: Header values by key, without the colon
+    :rtype: dict
+    """
+    header = dict()
+    with open(path, 'r', newline='') as f:
+        for row in itertools.islice(csv.reader(f), 4):
+            for key, value in zip(row, row[1:]):
+                if key.endswith(':'):
+                    header[key[:-1]] = value
+    return header
+
+
+def sample_interval(header):
+    # diskstats.py writes its sample rate, dstat samples once per second
+    if 'Rate' in header:
+        return 1 / float(header['Rate'])
+    return DSTAT_INTERVAL
+
+
+def header_date(header):
+    # e.g. "25 Mar 2022 13:20:05 CET", the time zone is dropped
+    return pd.to_datetime(' '.join(header.get('Date', '').split()[:4]), format='%d %b %Y %H:%M:%S', errors='coerce')
+
+
+def load_samples(directory, index, reference=None):
+    """Load the disk samples of a whole iteration: the streamed dstat_out.csv if present, otherwise the per-phase files
+
+    :param directory: Directory containing the metrics of the iteration (e.g. metrics/metrics1)
+    :type directory: str
+    :param index: Iteration number
+    :type index: str
+    :param reference: Reference time used to get the year of the dstat timestamps, defaults to None (the date in the
+        dstat header, e.g. for an iteration without jobs)
+    :type reference: pd.Timestamp, optional
+    :return: Sample times (seconds since the epoch), read and write speeds (MB/s), sorted by time, and the seconds
+        between two samples
+    :rtype: tuple
+    """
+    dstat_dir = f'{directory}/dstat_out{index}'
+    if os.path.exists(f'{dstat_dir}/dstat_out.csv'):
+        paths = [f'{dstat_dir}/dstat_out.csv']
+    else:
+        paths = [f'{dstat_dir}/{name}' for name in ['dstat_out_upload.csv', 'dstat_out_wf.csv'] if os.path.exists(f'{dstat_dir}/{name}')]
+    if not paths:
+        raise FileNotFoundError(f'No dstat output in {dstat_dir}')
+
+    dstat_df = pd.concat([pd.read_csv(path, header=[0,1], skiprows=5) for path in paths])
+    dstat_df = dstat_df.set_axis(['read_tps', 'write_tps', 'rMB/s', 'wMB/s', 'time'], axis=1)
+
+    # The sample interval is taken from the sampler, timestamps of samples taken within one second may be equal
+    header = read_dstat_header(paths[0])
+    interval = sample_interval(header)
+    if reference is None or pd.isna(reference):
+        reference = header_date(header)
+        if pd.isna(reference):
+            raise ValueError(f'No jobs and no date in the dstat header of {dstat_dir}: the year of the samples is unknown')
+
+    times = parse_dstat_time(dstat_df['time'].to_numpy(), reference)
+    valid = ~times.isna()
+    if len(times) and not valid.any():
+        raise ValueError(f'No valid timestamp in the dstat output of {dstat_dir}')
+    seconds = times[valid].asi8 / 1e9
+    order = np.argsort(seconds, kind='stable')
+    read = dstat_df['rMB/s'].to_numpy(dtype=np.float64)[valid][order] / 1e6
+    write = dstat_df['wMB/s'].to_numpy(dtype=np.float64)[valid][order] / 1e6
+    return seconds[order], read, write, interval
+
+
+
+################################################################################
+# INTERVAL JOIN
+
+def range_max(values, first, last):
+    """Maximum of values[first[i]:last[i]] for each i, NaN for empty ranges
+
+    :param values: Values
+    :type values: np.ndarray
+    :param first: First index of each range
+    :type first: np.ndarray
+    :param last: Index after the last one of each range
+    :type last: np.ndarray
+    :return: Maximum of each range
+    :rtype: np.ndarray
+    """
+    if len(values) == 0:
+        return np.full(len(first), np.nan)
+    # reduceat reduces values[indices[2i]:indices[2i + 1]] at even positions, a sentinel makes every index valid
+    padded = np.append(values, np.nan)
+    indices = np.column_stack([first, last]).ravel()
+    maxima = np.fmax.reduceat(padded, indices)[::2]
+    return np.where(last > first, maxima, np.nan)
+
+
+def attribute_io(jobs, times, read, write, interval=DSTAT_INTERVAL):
+    """Join samples and job intervals and compute the disk I/O of each job
+
+    :param jobs: Job intervals, as returned by load_jobs
+    :type jobs: pd.DataFrame
+    :param times: Sample times in seconds, sorted
+    :type times: np.ndarray
+    :param read: Read speed (MB/s) of each sample
+    :type read: np.ndarray
+    :param write: Write speed (MB/s) of each sample
+    :type write: np.ndarray
+    :param interval: Seconds between two samples, defaults to DSTAT_INTERVAL
+    :type interval: float, optional
+    :return: Jobs with samples, read and write MB (total and attributed), peak speeds and overlapped share of samples
+    :rtype: pd.DataFrame
+    """
+    jobs = jobs.copy()
+    starts = jobs['start'].to_numpy().astype('datetime64[ns]').astype(np.int64) / 1e9
+    ends = jobs['end'].to_numpy().astype('datetime64[ns]').astype(np.int64) / 1e9
+
+    # Each sample holds the speed over one sample interval
+    durations = np.full(len(times), interval, dtype=np.float64)
+
+    # Jobs running at each sample: started at or before it, minus the ones ended before it
+    running = np.searchsorted(np.sort(starts), times, side='right') - np.searchsorted(np.sort(ends), times, side='left')
+    shares = 1 / np.maximum(running, 1)
+
+    # Samples inside each job interval
+    first = np.searchsorted(times, starts, side='left')
+    last = np.searchsorted(times, ends, side='right')
+
+    # Range sums from cumulative sums
+    def range_sum(values):
+        cumulative = np.concatenate([[0], np.cumsum(values)])
+        return cumulative[last] - cumulative[first]
+
+    jobs['samples'] = last - first
+    jobs['read_MB'] = range_sum(read * durations)
+    jobs['write_MB'] = range_sum(write * durations)
+    jobs['attributed_read_MB'] = range_sum(read * durations * shares)
+    jobs['attributed_write_MB'] = range_sum(write * durations * shares)
+    jobs['peak_rMB/s'] = range_max(read, first, last)
+    jobs['peak_wMB/s'] = range_max(write, first, last)
+    jobs['overlapped_samples'] = range_sum((running > 1).astype(np.int64))
+    return jobs
+
+
+def attribute_iteration(directory, index):
+    """Attribute the disk I/O of a single iteration to its jobs
+
+    :param directory: Directory containing the metrics of the iteration (e.g. metrics/metrics1)
+    :type directory: str
+    :param index: Iteration number
+    :type index: str
+    :return: Jobs of the iteration with their disk I/O
+    :rtype: pd.DataFrame
+    """
+    jobs = load_jobs(directory)
+    times, read, write, interval = load_samples(directory, index, jobs['start'].min())
+    jobs = attribute_io(jobs, times, read, write, interval)
+    jobs['iteration'] = int(index)
+    return jobs
+
+
+def attribute_campaign(basedir, workers=None):
+    """Attribute the disk I/O of all the iterations of both VMs to their jobs, parsing iterations in parallel
+
+    :param basedir: Main base directory in which all the metrics are stored.
+    :type basedir: str
+    :param workers: Number of processes used to parse the iterations, defaults to None (number of CPUs)
+    :type workers: int, optional
+    :return: One row per job of every iteration, with the 'encrypted' group
+    :rtype: pd.DataFrame
+    """
+    iterations = []
+    for group, vm_dir in zip(GROUPS, ['metrics_encrypted', 'metrics']):
+        if not os.path.isdir(f'{basedir}/{vm_dir}'):
+            continue
+        for directory in os.listdir(f'{basedir}/{vm_dir}'):
+            index = re.findall(r'\d+', directory)[0]
+            iterations.append((group, f'{basedir}/{vm_dir}/{directory}', index))
+
+    frames = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [(group, executor.submit(attribute_iteration, directory, index)) for group, directory, index in iterations]
+        for group, future in futures:
+            try:
+                jobs = future.result()
+            except (FileNotFoundError, ValueError) as e:
+                print(e)
+                continue
+            jobs['encrypted'] = group
+            frames.append(jobs)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def summarize_tools(jobs_df):
+    """Aggregate the disk I/O of the jobs by VM group and tool
+
+    :param jobs_df: Jobs with their disk I/O, as returned by attribute_campaign
+    :type jobs_df: pd.DataFrame
+    :return: One row per group and tool with jobs, mean MB per job, peak speeds and overlapped share of samples
+    :rtype: pd.DataFrame
+    """
+    grouped = jobs_df.groupby(['encrypted', 'phase', 'tool'])
+    summary = grouped.agg(**{
+        'jobs':('job_id', 'count'),
+        'read_MB':('read_MB', 'mean'),
+        'write_MB':('write_MB', 'mean'),
+        'attributed_read_MB':('attributed_read_MB', 'mean'),
+        'attributed_write_MB':('attributed_write_MB', 'mean'),
+        'peak_rMB/s':('peak_rMB/s', 'max'),
+        'peak_wMB/s':('peak_wMB/s', 'max'),
+        'samples':('samples', 'sum'),
+        'overlapped_samples':('overlapped_samples', 'sum')
+    })
+    summary['overlapped_share'] = summary['overlapped_samples'] / summary['samples'].where(summary['samples'] > 0)
+    return summary.drop(columns=['overlapped_samples']).reset_index()
+
+
+
+if __name__=='__main__':
+
+    options = cli_options()
+    options.basedir = options.basedir.rstrip('/')
+
+    jobs_df = attribute_campaign(options.basedir, options.workers)
+    tools_df = summarize_tools(jobs_df)
+    print(tools_df.to_string(index=False, float_format='%.2f'))
+
+    if options.jobs_output_file:
+        jobs_df.to_csv(options.jobs_output_file, index=False)
+    if options.output_file:
+        tools_df.to_csv(options.output_file, index=False)
@@ -13,17 +13,33 @@ The main function in this module will produce three plots:
 
 # Dependencies
 import argparse
+import numpy as np
 import pandas as pd
 import json
-from datetime import datetime
 import matplotlib.pyplot as plt
 import seaborn as sns
 from scipy import stats
 import os
 import re
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from statannotations.Annotator import Annotator
 
 
+# Version of the preprocessed metrics cache, to be increased when the preprocessing changes
+CACHE_VERSION = 3
+
+# Disk metrics used by the plots and groups compared
+PLOT_COLUMNS = ['rMB/s', 'wMB/s']
+GROUPS = ['Encrypted', 'Non encrypted']
+
+
+class NoJobsError(Exception):
+    """Raised for a jobs metrics file without jobs (e.g. the upload jobs of a run whose inputs were all cached) or whose
+    jobs all lack start and end times (e.g. failed jobs)"""
+    pass
+
+
 
 ################################################################################
 # COMMAND LINE OPTIONS
@@ -36,6 +52,10 @@ def cli_options():
     parser.add_argument('--notch', default=False, dest='notch', action='store_true', help='If set, notches are shown in boxplots')
     parser.add_argument('--pvalues', default=False, dest='pvalues', action='store_true', help='If set, pvalues are shown in boxplots')
     parser.add_argument('--all-plots', default=False, dest='all_plots', action='store_true', help='If set, all the plots will be produced (also histograms for plain disk I/O metrics)')
+    parser.add_argument('--cache-dir', default=None, dest='cache_dir', help='Directory of the preprocessed metrics cache (default: <input-dir>/.plots_cache)')
+    parser.add_argument('--no-cache', default=False, dest='no_cache', action='store_true', help='If set, metrics are always parsed again and not cached')
+    parser.add_argument('--workers', default=None, type=int, dest='workers', help='Number of processes used to parse the metrics (default: number of CPUs)')
+    parser.add_argument('--histogram-width', default=0.01, type=float, dest='histogram_width', help='Width (MB/s) of the bins in which read and write speeds are accumulated')
     parser.add_argument('-o', '--output', dest='output_file', help='Output file')
     return parser.parse_args()
 
@@ -44,6 +64,47 @@ def cli_options():
 ################################################################################
 # DATA PREPROCESSING FUNCTIONS
 
+def get_time_window(metrics_path):
+    """Get the time window in which the jobs of a workflow run, from the first start to the last end
+
+    :param metrics_path: Path to the .json runtime metrics of the workflow
+    :type metrics_path: str
+    :return: Start and end time of the workflow
+    :rtype: tuple of pd.Timestamp
+    """
+    with open(metrics_path,'r') as f:
+        jobs_info = json.load(f)
+    if not jobs_info:
+        raise NoJobsError(f'No jobs in {metrics_path}')
+    start_times = pd.to_datetime([v['start'] for v in jobs_info.values()], format='%Y-%m-%d %H:%M:%S')
+    end_times = pd.to_datetime([v['end'] for v in jobs_info.values()], format='%Y-%m-%d %H:%M:%S')
+    # Failed jobs, or jobs without core metrics, have no start and end
+    if pd.isna(start_times.min()) or pd.isna(end_times.max()):
+        raise NoJobsError(f'No job with start and end time in {metrics_path}')
+    return start_times.min(), end_times.max()
+
+
+def parse_dstat_time(time_values, reference):
+    """Parse dstat timestamps, which have no year, taking the year from a reference time.
+    Samples more than half a year away from the reference are moved to the previous or next year,
+    so that data recorded across New Year is parsed correctly.
+
+    :param time_values: dstat timestamps in the '%d-%m %H:%M:%S' format, with milliseconds if written by diskstats.py
+    :type time_values: array-like of str
+    :param reference: Reference time, e.g. the start of the workflow
+    :type reference: pd.Timestamp
+    :return: Parsed timestamps
+    :rtype: pd.DatetimeIndex
+    """
+    time_values = pd.Index(time_values, dtype=str)
+    time_values = time_values.where(time_values.str.contains('.', regex=False), time_values + '.000')
+    times = pd.to_datetime(f'{reference.year}-' + time_values, format='%Y-%d-%m %H:%M:%S.%f', errors='coerce')
+    half_year = pd.Timedelta(days=183)
+    times = times.where(times - reference < half_year, times - pd.DateOffset(years=1))
+    times = times.where(reference - times < half_year, times + pd.DateOffset(years=1))
+    return times
+
+
 def filter_time(df, metrics_path):
     """Filter the dstat output dataframe removing measurements outside the time range in which the workflow run
 
@@ -56,40 +117,189 @@ def filter_time(df, metrics_path):
     """
     
     # Set column names
-    df.set_axis(['read_tps', 'write_tps', 'rMB/s', 'wMB/s', 'time'], axis=1, inplace=True)
-    
-    # Convert time to datetime object
-    df.loc[:,('time')] = df['time'].apply(lambda x: datetime.strptime(x,'%d-%m %H:%M:%S').replace(year=datetime.now().year))
-    
-    # Load jobs metrics
-    with open(metrics_path,'r') as f:
-        jobs_info = json.load(f)
+    df = df.set_axis(['read_tps', 'write_tps', 'rMB/s', 'wMB/s', 'time'], axis=1)
 
     # Take start and end time
-    start_times = []
-    end_times = []
-    for k,v in jobs_info.items():
-        start_times.append(datetime.strptime(v['start'], '%Y-%m-%d %H:%M:%S'))
-        end_times.append(datetime.strptime(v['end'], '%Y-%m-%d %H:%M:%S'))
-    start_time = min(start_times)
-    end_time = max(end_times)
-    
-    # Filter dstat
-    df = df[(df['time'] <= end_time) & (df['time'] >= start_time)].copy(deep=True)
+    start_time, end_time = get_time_window(metrics_path)
+
+    # Convert time to datetime, with the year of the workflow run
+    times = parse_dstat_time(df['time'].to_numpy(), start_time)
+
+    # Filter dstat, samples are in time order so the window is found with a binary search
+    if times.is_monotonic_increasing:
+        first, last = times.searchsorted(start_time, side='left'), times.searchsorted(end_time, side='right')
+        df = df.iloc[first:last].copy(deep=True)
+    else:
+        df = df[(times >= start_time) & (times <= end_time)].copy(deep=True)
 
     # Use relative time
-    df.loc[:,('time')] = list(range(0,len(df)))
+    df['time'] = np.arange(len(df))
     
     return df
 
 
-def get_metrics(basedir, encrypted, time_metrics_file='wf_jobs_metrics.json', dstat_metrics_file='dstat_out_wf.csv'):
+def parse_iteration(directory, index, time_metrics_file='wf_jobs_metrics.json', dstat_metrics_file='dstat_out_wf.csv'):
+    """Parse and preprocess the metrics of a single iteration of the workflow
+
+    :param directory: Directory containing the metrics of the iteration (e.g. metrics/metrics1)
+    :type directory: str
+    :param index: Iteration number
+    :type index: str
+    :param time_metrics_file: Name of the file containing time metrics, defaults to 'wf_jobs_metrics.json'
+    :type time_metrics_file: str, optional
+    :param dstat_metrics_file: Name of the file containing dstat output, defaults to 'dstat_out_wf.csv'
+    :type dstat_metrics_file: str, optional
+    :return: Runtimes of the jobs and dataframe with the read and write speed recorded while the workflow was running
+    :rtype: tuple of list and pd.DataFrame
+    """
+
+    # times
+    with open(f'{directory}/{time_metrics_file}','r') as f:
+        jobs_info = json.load(f)
+        times = [float(v['runtime_raw_value']) for k,v in jobs_info.items() if v.get('runtime_raw_value') is not None]
+
+    # read/write velocity
+    dstat_df = pd.read_csv(f'{directory}/dstat_out{index}/{dstat_metrics_file}',header=[0,1],skiprows=5)
+    dstat_df = filter_time(dstat_df, f'{directory}/{time_metrics_file}')
+
+    dstat_df['rMB/s'] = dstat_df['rMB/s'].div(1000000)
+    dstat_df['wMB/s'] = dstat_df['wMB/s'].div(1000000)
+
+    # Keep only the columns used by the plots
+    return times, dstat_df[PLOT_COLUMNS].astype(np.float32)
+
+
+def iteration_cache_key(paths):
+    """Build the cache key of an iteration from path, modification time and size of its input files
+
+    :param paths: Paths of the files read to build the metrics of the iteration
+    :type paths: list of str
+    :return: Cache key
+    :rtype: str
+    """
+    stats = [(os.path.abspath(path), os.stat(path)) for path in paths]
+    return f'v{CACHE_VERSION};' + ';'.join(f'{path}:{stat.st_mtime_ns}:{stat.st_size}' for path, stat in stats)
+
+
+def iteration_cache_path(cache_dir, directory, dstat_metrics_file):
+    name = hashlib.sha1(f'{os.path.abspath(directory)}/{dstat_metrics_file}'.encode()).hexdigest()
+    return f'{cache_dir}/{name}.npz'
+
+
+def load_cached_iteration(path, key):
+    """Load the metrics of an iteration from the cache
+
+    :param path: Path of the cache file
+    :type path: str
+    :param key: Cache key of the iteration
+    :type key: str
+    :return: Runtimes and dstat dataframe, or None if the iteration is not cached or has changed
+    :rtype: tuple of list and pd.DataFrame, or None
+    """
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if str(data['key']) != key:
+                return None
+            return list(data['times']), pd.DataFrame(data['samples'], columns=list(data['columns']))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def store_cached_iteration(path, key, times, dstat_df):
+    """Store the metrics of an iteration in the cache, as one column array per dstat metric
+
+    :param path: Path of the cache file
+    :type path: str
+    :param key: Cache key of the iteration
+    :type key: str
+    :param times: Runtimes of the jobs
+    :type times: list of float
+    :param dstat_df: Preprocessed dstat dataframe
+    :type dstat_df: pd.DataFrame
+    """
+    # Write to a temporary file first, so an interrupted run never leaves a broken cache entry
+    with open(f'{path}.tmp', 'wb') as f:
+        np.savez(f, key=np.array(key), times=np.array(times, dtype=float),
+                 samples=dstat_df.to_numpy(dtype=np.float32), columns=np.array(dstat_df.columns, dtype=str))
+    os.replace(f'{path}.tmp', path)
+
+
+class HistogramAccumulator:
+    """Histogram with fixed width bins starting from 0, filled one chunk of samples at a time.
+    It can be rebinned on any set of bin edges, so that samples never need to be kept in memory.
+    """
+
+    def __init__(self, width=0.01):
+        self.width = width
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        indexes = np.floor(np.clip(values[np.isfinite(values)], 0, None) / self.width).astype(np.int64)
+        counts = np.bincount(indexes)
+        if len(counts) > len(self.counts):
+            self.counts = np.pad(self.counts, (0, len(counts) - len(self.counts)))
+        self.counts[:len(counts)] += counts
+
+    def min(self):
+        nonzero = np.flatnonzero(self.counts)
+        return nonzero[0] * self.width if nonzero.size else 0.0
+
+    def max(self):
+        nonzero = np.flatnonzero(self.counts)
+        return (nonzero[-1] + 1) * self.width if nonzero.size else 0.0
+
+    def rebin(self, edges):
+        centers = (np.arange(len(self.counts)) + 0.5) * self.width
+        counts, _ = np.histogram(centers, bins=edges, weights=self.counts)
+        return counts
+
+
+def summarize_iteration(iteration, encrypted, plain='frame', histograms=None):
+    """Summarize the metrics of an iteration: runtimes, averaged disk metrics and plain disk metrics
+
+    :param iteration: Runtimes and dstat dataframe returned by 'parse_iteration'
+    :type iteration: tuple of list and pd.DataFrame
+    :param encrypted: String to be placed in the 'encrypted' column, should be either 'Encrypted' or 'Non encrypted'
+    :type encrypted: str
+    :param plain: Representation of the plain disk metrics: 'frame', 'histogram' or 'none', defaults to 'frame'
+    :type plain: str, optional
+    :param histograms: HistogramAccumulator for each column, filled when plain is 'histogram', defaults to None
+    :type histograms: dict, optional
+    :return: Runtimes, averaged disk metrics and compact dataframe of the plain disk metrics (None unless plain is 'frame')
+    :rtype: tuple
+    """
+    times, dstat_df = iteration
+
+    # Build averaged data
+    means = pd.Series({column: dstat_df[column].to_numpy().mean(dtype=np.float64) for column in PLOT_COLUMNS})
+    means['encrypted'] = encrypted
+
+    # Build plain data
+    frame = None
+    if plain == 'frame':
+        frame = dstat_df[PLOT_COLUMNS].astype(np.float32)
+        frame['encrypted'] = pd.Categorical.from_codes(np.full(len(frame), GROUPS.index(encrypted), dtype=np.int8), categories=GROUPS)
+    elif plain == 'histogram':
+        for column in PLOT_COLUMNS:
+            histograms[column].add(dstat_df[column].to_numpy())
+
+    return times, means, frame
+
+
+def get_metrics(basedir, encrypted, time_metrics_file='wf_jobs_metrics.json', dstat_metrics_file='dstat_out_wf.csv',
+                cache_dir=None, workers=None, plain='frame', histogram_width=0.01):
     """Import all the dstat outputs contained inside 'basedir', preprocess them and return three preprocessed dataframes:
     
     1. Pandas serie containing runtime of the workflow at each iteration.
     2. Dataframe containing plain disk metrics (from dstat output).
     3. Dataframe containing disk metrics averaged at each iteration of the workflow.
 
+    Iterations are parsed in parallel with a process pool. If 'cache_dir' is given, each preprocessed iteration is
+    stored there and only new or changed iterations are parsed again.
+    Plain disk metrics can be returned as a compact dataframe (float32 columns and categorical 'encrypted' column),
+    as histograms accumulated one iteration at a time, or not returned at all.
+
     :param basedir: Base directory in which there are the subdirectories containing the metrics.
     :type basedir: str
     :param encrypted: String to be placed in the 'Encrypted' column of the dataframe, should be either 'Encrypted' or 'Non encrypted'
@@ -98,50 +308,85 @@ def get_metrics(basedir, encrypted, time_metrics_file='wf_jobs_metrics.json', ds
     :type time_metrics_file: str, optional
     :param dstat_metrics_file: Name of the file inside each subdirectory containing dstat output, defaults to 'dstat_out_wf.csv'
     :type dstat_metrics_file: str, optional
-    :return: The three dataframes containing runtime, plain and averaged disk metrics
-    :rtype: Tuple of pd.DataFrame
+    :param cache_dir: Directory of the preprocessed iterations cache, defaults to None (no cache)
+    :type cache_dir: str, optional
+    :param workers: Number of processes used to parse the iterations, defaults to None (number of CPUs)
+    :type workers: int, optional
+    :param plain: Representation of the plain disk metrics: 'frame', 'histogram' or 'none', defaults to 'frame'
+    :type plain: str, optional
+    :param histogram_width: Width of the histogram bins (MB/s) when plain is 'histogram', defaults to 0.01
+    :type histogram_width: float, optional
+    :return: Runtimes, plain disk metrics (dataframe, dictionary of HistogramAccumulator for each column or None) and averaged disk metrics
+    :rtype: Tuple
     """
     
     times = []
     list_of_metrics = []
     list_of_avg_metrics = []
 
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Summarize iterations one at a time, so that only the requested representation of the samples is kept
+    summaries = dict()
+    histograms = {column: HistogramAccumulator(histogram_width) for column in PLOT_COLUMNS} if plain == 'histogram' else None
+
+    # Find the iterations to be parsed, summarizing the cached ones as soon as they are loaded
+    iterations = dict()
+    cached = set()
     for directory in os.listdir(basedir):
-        
+
         # get interation number
         index = re.findall(r'\d+', directory)[0]
-        
-        # times
         directory = f'{basedir}/{directory}'
-        try:
-            with open(f'{directory}/{time_metrics_file}','r') as f:
-                jobs_info = json.load(f)
-                time = [float(v['runtime_raw_value']) for k,v in jobs_info.items()]
-                times += time
-
-            # read/write velocity
-            dstat_df = pd.read_csv(f'{directory}/dstat_out{index}/{dstat_metrics_file}',header=[0,1],skiprows=5)
-            dstat_df = filter_time(dstat_df, f'{directory}/{time_metrics_file}')
-            
-            dstat_df['rMB/s'] = dstat_df['rMB/s'].div(1000000)
-            dstat_df['wMB/s'] = dstat_df['wMB/s'].div(1000000)
-
-            # Build plain data
-            dstat_df['encrypted'] = [encrypted]*len(dstat_df)
-            list_of_metrics.append(dstat_df)
-            
-            # Build averaged data
-            means = dstat_df.describe().loc['mean',:]
-            means['encrypted'] = encrypted
-            list_of_avg_metrics.append(means)
 
+        try:
+            key = iteration_cache_key([f'{directory}/{time_metrics_file}', f'{directory}/dstat_out{index}/{dstat_metrics_file}'])
         except FileNotFoundError as e:
             print(e)
+            continue
+
+        iterations[directory] = (index, key)
+        iteration = load_cached_iteration(iteration_cache_path(cache_dir, directory, dstat_metrics_file), key) if cache_dir is not None else None
+        if iteration is not None:
+            cached.add(directory)
+            summaries[directory] = summarize_iteration(iteration, encrypted, plain, histograms)
+
+    # Parse new or changed iterations in parallel
+    to_parse = {directory: value for directory, value in iterations.items() if directory not in cached}
+    if to_parse:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(parse_iteration, directory, index, time_metrics_file, dstat_metrics_file): directory
+                       for directory, (index, key) in to_parse.items()}
+            for future in as_completed(futures):
+                # Drop the reference to the future, releasing the parsed samples once summarized
+                directory = futures.pop(future)
+                try:
+                    iteration = future.result()
+                except (FileNotFoundError, NoJobsError) as e:
+                    print(e)
+                    continue
+                if cache_dir is not None:
+                    store_cached_iteration(iteration_cache_path(cache_dir, directory, dstat_metrics_file), to_parse[directory][1],
+                                           *iteration)
+                summaries[directory] = summarize_iteration(iteration, encrypted, plain, histograms)
+
+    for directory in iterations:
+        if directory not in summaries:
+            continue
+        iteration_times, means, frame = summaries[directory]
+        times += iteration_times
+        list_of_avg_metrics.append(means)
+        if frame is not None:
+            list_of_metrics.append(frame)
     
     avg_df = pd.DataFrame(list_of_avg_metrics)
-    plain_df = pd.concat(list_of_metrics)
+    if plain == 'frame':
+        plain_data = pd.concat(list_of_metrics)
+    else:
+        plain_data = histograms
             
-    return times, plain_df, avg_df
+    return times, plain_data, avg_df
 
 
 def build_time_df(encrypted_time, nonencrypted_time):
@@ -161,7 +406,8 @@ def build_time_df(encrypted_time, nonencrypted_time):
     return time_df
 
 
-def build_dataframes(basedir, time_metrics_file='wf_jobs_metrics.json', dstat_metrics_file='dstat_out_wf.csv'):
+def build_dataframes(basedir, time_metrics_file='wf_jobs_metrics.json', dstat_metrics_file='dstat_out_wf.csv', cache_dir=None,
+                     workers=None, plain='frame', histogram_width=0.01):
     """Main function for data preprocessing, build metrics dataframes used to plot data.
 
     :param basedir: Main base directory in which all the metrics are stored.
@@ -170,24 +416,45 @@ def build_dataframes(basedir, time_metrics_file='wf_jobs_metrics.json', dstat_me
     :type time_metrics_file: str, optional
     :param dstat_metrics_file: Name of the file containing the dstat output, defaults to 'dstat_out_wf.csv'
     :type dstat_metrics_file: str, optional
-    :return: Three dataframes containing runtime, plain and averaged disk metrics used to plot data
-    :rtype: tuple of pd.DataFrames
+    :param cache_dir: Directory of the preprocessed iterations cache, defaults to None (no cache)
+    :type cache_dir: str, optional
+    :param workers: Number of processes used to parse the iterations, defaults to None (number of CPUs)
+    :type workers: int, optional
+    :param plain: Representation of the plain disk metrics: 'frame', 'histogram' or 'none', defaults to 'frame'
+    :type plain: str, optional
+    :param histogram_width: Width of the histogram bins (MB/s) when plain is 'histogram', defaults to 0.01
+    :type histogram_width: float, optional
+    :return: Runtime dataframe, plain disk metrics (dataframe, dictionary of histograms for each group or None) and averaged disk metrics dataframe
+    :rtype: tuple
     """
     
     encrypted_time, encrypted_df, avg_encrypted_df = get_metrics(basedir=f'{basedir}/metrics_encrypted',
                                                                  encrypted='Encrypted',
                                                                  time_metrics_file=time_metrics_file,
-                                                                 dstat_metrics_file=dstat_metrics_file)
+                                                                 dstat_metrics_file=dstat_metrics_file,
+                                                                 cache_dir=cache_dir,
+                                                                 workers=workers,
+                                                                 plain=plain,
+                                                                 histogram_width=histogram_width)
     nonencrypted_time, nonencrypted_df, avg_nonencrypted_df = get_metrics(basedir=f'{basedir}/metrics',
                                                                           encrypted='Non encrypted',
                                                                           time_metrics_file=time_metrics_file,
-                                                                          dstat_metrics_file=dstat_metrics_file)
+                                                                          dstat_metrics_file=dstat_metrics_file,
+                                                                          cache_dir=cache_dir,
+                                                                          workers=workers,
+                                                                          plain=plain,
+                                                                          histogram_width=histogram_width)
     
     # runtime dataframe
     time_df = build_time_df(encrypted_time, nonencrypted_time)
 
-    # Disk metrics dataframe
-    dstat_df = pd.concat([encrypted_df, nonencrypted_df])
+    # Disk metrics dataframe or histograms
+    if plain == 'frame':
+        dstat_df = pd.concat([encrypted_df, nonencrypted_df])
+    elif plain == 'histogram':
+        dstat_df = {'Encrypted':encrypted_df, 'Non encrypted':nonencrypted_df}
+    else:
+        dstat_df = None
 
     # Average disk metrics dataframe
     avg_dstat_df = pd.concat([avg_encrypted_df, avg_nonencrypted_df])
@@ -243,8 +510,8 @@ def boxplot(data, column, ax=0, title='', title_fontsize=40, figsize=None, showf
 def hist(data, column, ax=0, title='', title_fontsize=40, figsize=None, bins=50, logscale=True, stat='probability'):
     """Histogram to compare metrics between encrypted and non encrypted VMs
 
-    :param data: Dataframe
-    :type data: pd.DataFrame
+    :param data: Dataframe, or histograms pre-binned for each group and column (as built by 'build_dataframes' with plain='histogram')
+    :type data: pd.DataFrame or dict
     :param column: Column used for the X axis
     :type column: str
     :param ax: Axis to put histogram in a subplot, defaults to 0
@@ -265,12 +532,20 @@ def hist(data, column, ax=0, title='', title_fontsize=40, figsize=None, bins=50,
     if figsize is not None:
         plt.figure(figsize=figsize)
     
-    binrange = (min(data[column]), max(data[column]))
-    
-    sns.histplot(ax=ax, data=data[data['encrypted']=='Encrypted'][column], bins=bins, binrange=binrange,
-                 stat=stat, color=sns.color_palette()[0])
-    sns.histplot(ax=ax, data=data[data['encrypted']=='Non encrypted'][column], bins=bins, binrange=binrange,
-                 stat=stat, color=sns.color_palette()[1])
+    if isinstance(data, pd.DataFrame):
+        binrange = (min(data[column]), max(data[column]))
+
+        sns.histplot(ax=ax, data=data[data['encrypted']=='Encrypted'][column], bins=bins, binrange=binrange,
+                     stat=stat, color=sns.color_palette()[0])
+        sns.histplot(ax=ax, data=data[data['encrypted']=='Non encrypted'][column], bins=bins, binrange=binrange,
+                     stat=stat, color=sns.color_palette()[1])
+    else:
+        # Rebin the accumulated histograms on common bins
+        edges = np.linspace(min(data[group][column].min() for group in GROUPS),
+                            max(data[group][column].max() for group in GROUPS), bins + 1)
+        for i, group in enumerate(GROUPS):
+            sns.histplot(ax=ax, x=edges[:-1], weights=data[group][column].rebin(edges), bins=edges,
+                         stat=stat, color=sns.color_palette()[i])
     
     ax.set_title(title, fontsize=title_fontsize, pad=40)
     
@@ -292,7 +567,7 @@ def all_plots(time_df, dstat_df, avg_dstat_df, main_title='', figsize=(40, 25),
     :param time_df: Dataframe containing runtimes of encrypted and non encrypted VM.
     :type time_df: pd.DataFrame
     :param dstat_df: Dataframe containing plain dstat output of encrypted and non encrypted VM.
-    :type dstat_df: pd.DataFrame
+    :type dstat_df: pd.DataFrame or dict of pre-binned histograms
     :param avg_dstat_df: Dataframe containing dstat output averaged for each iteration of encrypted and non encrypted VM.
     :type avg_dstat_df: pd.DataFrame
     :param main_title: Main title of the figure, defaults to ''
@@ -388,7 +663,11 @@ if __name__=='__main__':
     options.basedir = options.basedir.rstrip('/')
 
     # Build dataframes
-    time_df, dstat_df, avg_dstat_df = build_dataframes(basedir=options.basedir)
+    cache_dir = None if options.no_cache else (options.cache_dir or f'{options.basedir}/.plots_cache')
+    # Plain disk metrics are only needed, as histograms, for the histogram plots
+    plain = 'histogram' if options.all_plots else 'none'
+    time_df, dstat_df, avg_dstat_df = build_dataframes(basedir=options.basedir, cache_dir=cache_dir, workers=options.workers,
+                                                       plain=plain, histogram_width=options.histogram_width)
 
     sns.set(font_scale=options.font_scale)
 